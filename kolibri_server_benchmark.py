@@ -0,0 +1,519 @@
+#!/usr/bin/python3
+"""
+Load test of a kolibri-server installation, run against its nginx front end
+on localhost.
+
+Virtual users, each one with its own keep-alive connections and cookies like
+a browser, run a mix of scenarios for a fixed time:
+
+- login: learners logging in all at once at the start of a lesson, then at random
+- browse: listing channels and browsing their topics
+- video: range requests on the videos of the content storage, as a video player does
+- html5: fetching many files of an HTML5 archive at once from the zip content port
+- exercise: starting an exercise and logging attempts, for users who logged in
+
+The throughput, latency percentiles and errors of every request, and the
+number of uwsgi workers running during the test, are reported, so uwsgi and
+nginx configurations can be compared on the same hardware. Run it as the user
+running Kolibri, with the same KOLIBRI_HOME:
+
+    /usr/share/kolibri-server/kolibri_server_benchmark.py --users 40 --duration 60 \\
+        --username learner --password secret
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import zipfile
+from collections import Counter
+from collections import defaultdict
+from urllib.parse import quote
+
+from kolibri_server_metrics import read_uwsgi_stats
+
+# Scenarios and how often users choose them
+SCENARIOS = {
+    "login": 1,
+    "browse": 4,
+    "video": 2,
+    "html5": 2,
+    "exercise": 3,
+}
+
+# Concurrent connections a browser opens to a host
+BROWSER_CONNECTIONS = 6
+
+# Size of every range requested from a video
+VIDEO_RANGE_SIZE = 1024 * 1024
+
+# Maximum files of an archive fetched by an html5 scenario
+HTML5_FILES = 30
+
+# Maximum files of each kind found in the content storage
+MAX_CONTENT_FILES = 200
+
+VIDEO_EXTENSIONS = (".mp4", ".webm")
+# the only archives Kolibri's zip content application serves
+ZIP_EXTENSIONS = (".zip",)
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, label, seconds, error=False):
+        self.latencies[label].append(seconds)
+        if error:
+            self.errors[label] += 1
+
+    def summary(self, duration):
+        """
+        Returns the number of requests, errors, requests per second and latency
+        percentiles in milliseconds of every request label, and of all of them
+        """
+        labels = dict(self.latencies)
+        labels["all"] = [seconds for latencies in self.latencies.values() for seconds in latencies]
+        errors = dict(self.errors)
+        errors["all"] = sum(self.errors.values())
+        summary = {}
+        for label, latencies in labels.items():
+            latencies = sorted(latencies)
+            summary[label] = {
+                "requests": len(latencies),
+                "errors": errors.get(label, 0),
+                "rps": len(latencies) / duration if duration else 0,
+            }
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                value = percentile(latencies, fraction)
+                summary[label][name] = value * 1000 if value is not None else None
+        return summary
+
+
+class Connection(object):
+    """
+    HTTP/1.1 connection to a local port, kept alive between requests
+    """
+
+    def __init__(self, port, cookies, timeout=30):
+        self.port = port
+        self.cookies = cookies
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        """
+        Returns the status, headers and body of the response. A connection
+        closed by the server while idle is opened again.
+        """
+        for attempt in range(2):
+            reused = self.writer is not None
+            try:
+                return await asyncio.wait_for(self._request(method, path, body, headers), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused or attempt:
+                    raise
+            except BaseException:
+                self.close()
+                raise
+
+    async def _request(self, method, path, body, headers):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        request_headers = {"Host": "localhost", "Connection": "keep-alive", "Accept-Encoding": "identity"}
+        if self.cookies:
+            request_headers["Cookie"] = "; ".join("{}={}".format(name, value) for name, value in self.cookies.items())
+        if body is not None:
+            body = json.dumps(body).encode("utf-8")
+            request_headers["Content-Type"] = "application/json"
+            request_headers["Content-Length"] = str(len(body))
+        request_headers.update(headers or {})
+        head = "{} {} HTTP/1.1\r\n".format(method, path)
+        head += "".join("{}: {}\r\n".format(name, value) for name, value in request_headers.items())
+        self.writer.write(head.encode("latin-1") + b"\r\n" + (body or b""))
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            if name == "set-cookie":
+                cookie_name, _, cookie_value = value.split(";", 1)[0].partition("=")
+                self.cookies[cookie_name.strip()] = cookie_value.strip()
+            response_headers[name] = value
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            response_body = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            response_body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if not size:
+                    await self.reader.readline()
+                    break
+                response_body += await self.reader.readexactly(size)
+                await self.reader.readline()
+        elif "content-length" in response_headers:
+            response_body = await self.reader.readexactly(int(response_headers["content-length"]))
+        else:
+            response_body = await self.reader.read()
+            response_headers["connection"] = "close"
+        if response_headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, response_headers, response_body
+
+
+class VirtualUser(object):
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+        self.cookies = {}
+        self.connection = Connection(benchmark.port, self.cookies)
+        self.zip_connections = [Connection(benchmark.zip_port, self.cookies) for _ in range(BROWSER_CONNECTIONS)]
+        self.logged_in = False
+
+    def close(self):
+        for connection in [self.connection] + self.zip_connections:
+            connection.close()
+
+    async def fetch(self, label, path, method="GET", body=None, headers=None, connection=None):
+        """
+        Sends a request, recording its latency under label. Returns the status
+        and body of the response, or None if it failed.
+        """
+        connection = connection or self.connection
+        if self.cookies.get("kolibri_csrftoken") and method not in ("GET", "HEAD"):
+            headers = dict(headers or {}, **{"X-CSRFToken": self.cookies["kolibri_csrftoken"]})
+        start = time.perf_counter()
+        try:
+            status, _, response_body = await connection.request(method, path, body, headers)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            self.benchmark.stats.record(label, time.perf_counter() - start, error=True)
+            return None
+        self.benchmark.stats.record(label, time.perf_counter() - start, error=status >= 400)
+        if status >= 400:
+            return None
+        return status, response_body
+
+    async def fetch_json(self, label, path, method="GET", body=None):
+        response = await self.fetch(label, path, method, body)
+        if response is None:
+            return None
+        try:
+            return json.loads(response[1].decode("utf-8"))
+        except ValueError:
+            return None
+
+    async def login(self):
+        benchmark = self.benchmark
+        if not benchmark.username:
+            return
+        credentials = {"username": benchmark.username, "password": benchmark.password}
+        if benchmark.facility:
+            credentials["facility"] = benchmark.facility
+        session = await self.fetch_json("POST api/auth/session/", benchmark.api("auth/session/"), "POST", credentials)
+        self.logged_in = session is not None
+        if self.logged_in:
+            await self.fetch("GET api/auth/session/current/", benchmark.api("auth/session/current/"))
+
+    async def browse(self):
+        benchmark = self.benchmark
+        channels = await self.fetch_json("GET api/content/channel/", benchmark.api("content/channel/?available=true"))
+        if not channels:
+            return
+        root = random.choice(channels)["root"]
+        await self.fetch(
+            "GET api/content/contentnode_tree/", benchmark.api("content/contentnode_tree/{}/".format(root))
+        )
+        await self.fetch("GET api/content/contentnode/", benchmark.api("content/contentnode/?parent={}".format(root)))
+
+    async def video(self):
+        benchmark = self.benchmark
+        if not benchmark.videos:
+            return
+        filename, size = random.choice(benchmark.videos)
+        path = benchmark.storage_url(filename)
+        start = 0
+        for _ in range(3):
+            end = min(size, start + VIDEO_RANGE_SIZE) - 1
+            await self.fetch("GET content/storage/ (range)", path, headers={"Range": "bytes={}-{}".format(start, end)})
+            start = random.randrange(0, max(1, size - VIDEO_RANGE_SIZE))
+
+    async def html5(self):
+        benchmark = self.benchmark
+        if not benchmark.archives:
+            return
+        filename, members = random.choice(benchmark.archives)
+        queue = asyncio.Queue()
+        for member in members:
+            queue.put_nowait(member)
+
+        async def fetch_members(connection):
+            while not queue.empty():
+                member = queue.get_nowait()
+                await self.fetch(
+                    "GET zipcontent/",
+                    benchmark.zip_content_url(filename, member),
+                    connection=connection,
+                )
+
+        await asyncio.gather(*(fetch_members(connection) for connection in self.zip_connections))
+
+    async def exercise(self):
+        benchmark = self.benchmark
+        if not self.logged_in:
+            return
+        nodes = await self.fetch_json(
+            "GET api/content/contentnode/?kind=exercise",
+            benchmark.api("content/contentnode/?kind=exercise&max_results=20"),
+        )
+        if isinstance(nodes, dict):
+            nodes = nodes.get("results")
+        if not nodes:
+            return
+        node = random.choice(nodes)
+        mastery_model = (node.get("assessmentmetadata") or {}).get("mastery_model") or {"type": "do_all"}
+        session = await self.fetch_json(
+            "POST api/logger/trackprogress/",
+            benchmark.api("logger/trackprogress/"),
+            "POST",
+            {
+                "node_id": node["id"],
+                "content_id": node["content_id"],
+                "channel_id": node["channel_id"],
+                "kind": node["kind"],
+                "mastery_model": mastery_model,
+            },
+        )
+        if not session:
+            return
+        for item in range(3):
+            interaction = {
+                "item": "benchmark:{}".format(item),
+                "correct": random.choice((0, 1)),
+                "complete": True,
+                "time_spent": random.uniform(5, 30),
+                "answer": {},
+            }
+            await self.fetch_json(
+                "PUT api/logger/trackprogress/",
+                benchmark.api("logger/trackprogress/{}/".format(session["session_id"])),
+                "PUT",
+                {"time_spent_delta": interaction["time_spent"], "interactions": [interaction]},
+            )
+
+
+class Benchmark(object):
+    def __init__(
+        self,
+        port,
+        zip_port,
+        path_prefix="/",
+        zip_base_path="/zipcontent/",
+        username="",
+        password="",
+        facility="",
+        uwsgi_stats_sockets=None,
+    ):
+        self.port = port
+        self.zip_port = zip_port
+        self.path_prefix = path_prefix
+        self.zip_base_path = zip_base_path
+        self.username = username
+        self.password = password
+        self.facility = facility
+        self.uwsgi_stats_sockets = uwsgi_stats_sockets or {}
+        self.videos = []
+        self.archives = []
+        self.stats = Stats()
+        self.workers = defaultdict(list)
+
+    def api(self, path):
+        return "{}api/{}".format(self.path_prefix, path)
+
+    def storage_url(self, filename):
+        return "{}content/storage/{}/{}/{}".format(self.path_prefix, filename[0], filename[1], filename)
+
+    def zip_content_url(self, filename, member):
+        return "{}{}/{}".format(self.zip_base_path, filename, quote(member))
+
+    def find_content(self, content_dir):
+        """
+        Finds videos and HTML5 archives in the content storage
+        """
+        for root, _, filenames in os.walk(os.path.join(content_dir, "storage")):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(VIDEO_EXTENSIONS) and len(self.videos) < MAX_CONTENT_FILES:
+                    self.videos.append((filename, os.path.getsize(path)))
+                elif filename.endswith(ZIP_EXTENSIONS) and len(self.archives) < MAX_CONTENT_FILES:
+                    try:
+                        with zipfile.ZipFile(path) as zf:
+                            members = [info.filename for info in zf.infolist() if not info.is_dir()]
+                    except (OSError, zipfile.BadZipFile):
+                        continue
+                    if members:
+                        self.archives.append((filename, members[:HTML5_FILES]))
+
+    async def run_user(self, deadline, weights):
+        user = VirtualUser(self)
+        try:
+            # every user logs in at once, like a class at the start of a lesson
+            await user.login()
+            scenarios = list(weights)
+            while time.monotonic() < deadline:
+                scenario = random.choices(scenarios, [weights[name] for name in scenarios])[0]
+                await getattr(user, scenario)()
+        finally:
+            user.close()
+
+    async def sample_workers(self):
+        while True:
+            for instance, count in count_uwsgi_workers(self.uwsgi_stats_sockets).items():
+                self.workers[instance].append(count)
+            await asyncio.sleep(1)
+
+    async def run(self, users, duration, weights):
+        """
+        Runs the virtual users until duration seconds have elapsed, and
+        returns the seconds they took to finish
+        """
+        start = time.monotonic()
+        sampler = asyncio.ensure_future(self.sample_workers())
+        try:
+            await asyncio.gather(*(self.run_user(start + duration, weights) for _ in range(users)))
+        finally:
+            sampler.cancel()
+        return time.monotonic() - start
+
+
+def count_uwsgi_workers(uwsgi_stats_sockets):
+    """
+    Returns the number of workers running in each uwsgi instance whose stats
+    socket could be read
+    """
+    workers = {}
+    for instance, path in uwsgi_stats_sockets.items():
+        try:
+            stats = read_uwsgi_stats(path)
+        except (OSError, ValueError):
+            continue
+        # the cheaper algorithm keeps the workers it stopped in the stats
+        workers[instance] = sum(
+            1 for worker in stats.get("workers", []) if worker.get("pid") and worker.get("status") != "cheap"
+        )
+    return workers
+
+
+def print_report(summary, workers, duration):
+    print(
+        "{:<48} {:>8} {:>7} {:>8} {:>9} {:>9} {:>9}".format(
+            "request", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for label in sorted(summary, key=lambda label: (label == "all", label)):
+        entry = summary[label]
+        print(
+            "{:<48} {:>8} {:>7} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                label,
+                entry["requests"],
+                entry["errors"],
+                entry["rps"],
+                entry["p50"] or 0,
+                entry["p95"] or 0,
+                entry["p99"] or 0,
+            )
+        )
+    print("\nDuration: {:.1f}s".format(duration))
+    for instance, counts in sorted(workers.items()):
+        print("uwsgi {} workers: {} to {}".format(instance, min(counts), max(counts)))
+
+
+def parse_weights(values):
+    weights = dict(SCENARIOS)
+    for value in values or []:
+        name, _, weight = value.partition("=")
+        if name not in SCENARIOS:
+            raise ValueError("Unknown scenario {}".format(name))
+        weights[name] = float(weight or 1)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+if __name__ == "__main__":
+    # only importable where Kolibri is installed, unlike the rest of the tool
+    from kolibri.core.content.utils.paths import get_zip_content_base_path
+    from kolibri.utils.conf import OPTIONS
+
+    import kolibri_server_setup
+
+    parser = argparse.ArgumentParser(description="Load test kolibri-server on localhost")
+    parser.add_argument("--users", type=int, default=20, help="Number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds the test lasts")
+    parser.add_argument("--username", default="", help="Learner the virtual users log in as")
+    parser.add_argument("--password", default="", help="Password of the learner")
+    parser.add_argument("--facility", default="", help="Facility id of the learner, for devices with several")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        help="Weight of a scenario, as name=weight, 0 to disable it. Default: {}".format(
+            ", ".join("{}={}".format(name, weight) for name, weight in SCENARIOS.items())
+        ),
+    )
+    parser.add_argument("--json", default="", help="File to save the results to")
+    args = parser.parse_args()
+
+    try:
+        weights = parse_weights(args.scenario)
+    except ValueError as e:
+        sys.exit(str(e))
+    path_prefix = OPTIONS["Deployment"]["URL_PATH_PREFIX"].strip("/")
+    benchmark = Benchmark(
+        OPTIONS["Deployment"]["HTTP_PORT"],
+        OPTIONS["Deployment"]["ZIP_CONTENT_PORT"],
+        "/" + path_prefix + "/" if path_prefix else "/",
+        get_zip_content_base_path(),
+        args.username,
+        args.password,
+        args.facility,
+        kolibri_server_setup.get_uwsgi_stats_sockets(),
+    )
+    benchmark.find_content(OPTIONS["Paths"]["CONTENT_DIR"])
+    # asyncio.run needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        duration = loop.run_until_complete(benchmark.run(args.users, args.duration, weights))
+    finally:
+        loop.close()
+    summary = benchmark.stats.summary(duration)
+    print_report(summary, benchmark.workers, duration)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"summary": summary, "workers": benchmark.workers, "duration": duration}, json_file, indent=2)
@@ -0,0 +1,118 @@
+"""
+Redis cache backend of the main uwsgi instance, with a cache private to every
+worker in front of it for the keys Kolibri reads on most requests and rarely
+changes.
+
+Kolibri's content API responses, channel statistics, content cache key and
+device settings are served from the worker's own memory, see
+kolibri_server_localcache, instead of a round trip to Redis. At most once per
+GENERATION_INTERVAL, the content cache key and device settings are read
+from Redis: when either changed, because channels were imported, updated or
+deleted, or device settings were saved, by any process, everything the
+worker cached is dropped. Writes go to Redis, and drop the worker's copy.
+Every other key is left to Redis alone.
+"""
+
+import os
+import pickle
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from redis_cache import RedisCache
+
+from kolibri_server_localcache import LocalCache
+
+# All set by kolibri_server_setup.py in the generated uwsgi.ini
+LOCAL_CACHE_SIZE = int(os.environ.get("KOLIBRI_SERVER_LOCAL_CACHE_SIZE", "0"))
+LOCAL_CACHE_TTL = int(os.environ.get("KOLIBRI_SERVER_LOCAL_CACHE_TTL", "10"))
+
+# Keys Kolibri replaces whenever channels or device settings change
+GENERATION_KEYS = ("content_cache_key", "device_settings_cache_key")
+
+# Seconds between two reads of the generation keys by the same worker
+GENERATION_INTERVAL = 1
+
+# Keys cached by the workers: besides the generation keys, the cached content
+# API responses, whose keys include the content cache key, and the channel
+# statistics
+LOCAL_KEY_PREFIXES = GENERATION_KEYS + ("views.decorators.cache.", "CHANNEL_STATS_CACHED_KEYS")
+
+MISSING = object()
+
+
+class TwoTierRedisCache(RedisCache):
+    def __init__(self, server, params):
+        super(TwoTierRedisCache, self).__init__(server, params)
+        self.local_cache = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+        self.generation = {}
+        self.generation_time = 0
+
+    def is_local(self, key, version):
+        return version is None and isinstance(key, str) and key.startswith(LOCAL_KEY_PREFIXES)
+
+    def check_generation(self):
+        if time.monotonic() - self.generation_time < GENERATION_INTERVAL:
+            return
+        values = super(TwoTierRedisCache, self).get_many(GENERATION_KEYS)
+        self.generation = {key: pickle.dumps(values[key]) for key in GENERATION_KEYS if key in values}
+        self.local_cache.set_generation(tuple(self.generation.get(key) for key in GENERATION_KEYS))
+        self.generation_time = time.monotonic()
+
+    def forget(self, key):
+        self.local_cache.delete(key)
+        if key in GENERATION_KEYS:
+            # read them again on the next lookup
+            self.generation_time = 0
+
+    def get(self, key, default=None, version=None):
+        if not self.is_local(key, version):
+            return super(TwoTierRedisCache, self).get(key, default=default, version=version)
+        self.check_generation()
+        data = self.generation.get(key) if key in GENERATION_KEYS else self.local_cache.get(key)
+        if data is not None:
+            return pickle.loads(data)
+        value = super(TwoTierRedisCache, self).get(key, default=MISSING)
+        if value is MISSING:
+            return default
+        self.local_cache.set(key, pickle.dumps(value))
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.forget(key)
+        return super(TwoTierRedisCache, self).set(key, value, timeout=timeout, version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.forget(key)
+        return super(TwoTierRedisCache, self).add(key, value, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        self.forget(key)
+        return super(TwoTierRedisCache, self).delete(key, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key in data:
+            self.forget(key)
+        return super(TwoTierRedisCache, self).set_many(data, timeout=timeout, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self.forget(key)
+        return super(TwoTierRedisCache, self).delete_many(keys, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self.forget(key)
+        return super(TwoTierRedisCache, self).incr(key, delta=delta, version=version)
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.forget(key)
+        return super(TwoTierRedisCache, self).get_or_set(key, default, timeout=timeout, **kwargs)
+
+    def delete_pattern(self, pattern, version=None):
+        self.local_cache.clear()
+        self.generation_time = 0
+        return super(TwoTierRedisCache, self).delete_pattern(pattern, version=version)
+
+    def clear(self, version=None):
+        self.local_cache.clear()
+        self.generation_time = 0
+        return super(TwoTierRedisCache, self).clear(version=version)
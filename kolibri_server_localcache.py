@@ -0,0 +1,67 @@
+"""
+Cache private to a uwsgi worker, in front of the Redis cache Kolibri shares
+between all of them.
+
+Values are kept pickled, so callers can not change them for each other, in
+least recently used order, up to a maximum number of bytes. Every value
+expires after a few seconds, and all of them are dropped at once when the
+generation of the cache changes: the values of the keys Kolibri replaces
+whenever channels or device settings change.
+
+This module must not depend on Kolibri or Django, to be tested on its own.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the pickled value of key, or None if it is not cached or expired
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self.delete(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, data):
+        self.delete(key)
+        if len(data) > self.max_size:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def set_generation(self, generation):
+        """
+        Drops every value when generation differs from the one they were cached in
+        """
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+"""
+Latency of every Kolibri endpoint, from the nginx access log.
+
+Reads the uwsgi_timed_combined access log of kolibri-server, rotated and
+gzipped files included, or follows it as nginx writes it. URLs are reduced to
+routes, replacing ids, content files and query values, and for every route
+the number of requests, their status and cache status, and the percentiles
+of their total and upstream times are reported. Percentiles are estimated
+with a sketch of bounded size, so memory does not grow with the log.
+
+The log is only readable by root and the adm group:
+
+    sudo /usr/share/kolibri-server/kolibri_server_logstats.py
+    sudo /usr/share/kolibri-server/kolibri_server_logstats.py --follow --interval 60
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+
+ACCESS_LOG = "/var/log/nginx/kolibri_uwsgi.log"
+
+# uwsgi_timed_combined in /etc/kolibri/dist/nginx.conf, whose cache status
+# is missing from logs written before it was added
+LOG_LINE_REGEX = re.compile(
+    r'^\S+ - \S+ \[[^\]]*\] "(?P<method>[A-Z]+) (?P<url>\S+)[^"]*" (?P<status>\d{3}) \d+ '
+    r'"[^"]*" "[^"]*" (?P<request_time>[\d.]+) (?P<upstream_time>\S+(?:(?:, | : )\S+)*) \S+'
+    r"(?: (?P<cache_status>\S+))?\s*$"
+)
+
+# Between the times of the upstream servers tried for a request, and before
+# the time of an internal redirect to another location
+UPSTREAM_TIME_SEPARATOR = re.compile(r", | : ")
+
+# Seconds between two reads of the end of the log when following it
+FOLLOW_POLL_INTERVAL = 0.2
+
+# Parts of URLs replaced to group requests by route
+ROUTE_PATTERNS = (
+    (re.compile(r"^(.*?/content/storage/).*"), r"\1*"),
+    (re.compile(r"^(.*?/static/[^/]+/).*"), r"\1*"),
+    (re.compile(r"^(.*?/zipcontent/)[^/]+(/.*)?$"), r"\1{archive}/*"),
+    (re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"), "{uuid}"),
+    (re.compile(r"(?<![0-9a-zA-Z])[0-9a-f]{32}(?![0-9a-zA-Z])"), "{id}"),
+    (re.compile(r"/\d+(?=/|$)"), "/{n}"),
+)
+
+# Routes over this number are reported together as "other"
+MAX_ROUTES = 1000
+
+# Relative accuracy of the percentiles, and the smallest time told apart
+SKETCH_ACCURACY = 0.02
+SKETCH_MIN_SECONDS = 0.0001
+
+
+def get_route(method, url):
+    """
+    Returns the route of a request: its method and path with ids replaced,
+    and the names of its query parameters
+    """
+    parts = urlsplit(url)
+    path = parts.path
+    for pattern, replacement in ROUTE_PATTERNS:
+        path = pattern.sub(replacement, path)
+    names = sorted({name for name, _ in parse_qsl(parts.query, keep_blank_values=True)})
+    return "{} {}{}".format(method, path, "?" + "&".join(names) if names else "")
+
+
+def parse_line(line):
+    """
+    Returns the route, status, cache status, total and upstream time of a
+    log line, or None if it is not one of uwsgi_timed_combined
+    """
+    match = LOG_LINE_REGEX.match(line)
+    if match is None:
+        return None
+    upstream_times = [
+        float(value) for value in UPSTREAM_TIME_SEPARATOR.split(match.group("upstream_time")) if value != "-"
+    ]
+    return {
+        "route": get_route(match.group("method"), match.group("url")),
+        "status": match.group("status"),
+        "cache_status": match.group("cache_status") or "-",
+        "request_time": float(match.group("request_time")),
+        "upstream_time": sum(upstream_times) if upstream_times else None,
+    }
+
+
+class Sketch(object):
+    """
+    Streaming estimate of the quantiles of positive values: values are counted
+    in buckets growing geometrically, so any quantile is known within
+    SKETCH_ACCURACY of its value with one counter per bucket
+    """
+
+    def __init__(self, accuracy=SKETCH_ACCURACY, min_value=SKETCH_MIN_SECONDS):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.buckets[math.ceil(math.log(max(value, self.min_value)) / self.log_gamma)] += 1
+
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # middle of the bucket
+                return 2 * self.gamma**index / (self.gamma + 1)
+        return None
+
+
+class RouteStats(object):
+    def __init__(self):
+        self.statuses = Counter()
+        self.cache_statuses = Counter()
+        self.request_time = Sketch()
+        self.upstream_time = Sketch()
+
+    def add(self, entry):
+        self.statuses[entry["status"][0] + "xx"] += 1
+        self.cache_statuses[entry["cache_status"]] += 1
+        self.request_time.add(entry["request_time"])
+        if entry["upstream_time"] is not None:
+            self.upstream_time.add(entry["upstream_time"])
+
+    def summary(self):
+        return {
+            "requests": self.request_time.count,
+            "seconds": self.request_time.total,
+            "p50": self.request_time.quantile(0.5),
+            "p95": self.request_time.quantile(0.95),
+            "p99": self.request_time.quantile(0.99),
+            "upstream_requests": self.upstream_time.count,
+            "upstream_p50": self.upstream_time.quantile(0.5),
+            "upstream_p95": self.upstream_time.quantile(0.95),
+            "upstream_p99": self.upstream_time.quantile(0.99),
+            "statuses": dict(self.statuses),
+            "cache_statuses": dict(self.cache_statuses),
+        }
+
+
+class LogStats(object):
+    def __init__(self, max_routes=MAX_ROUTES):
+        self.max_routes = max_routes
+        self.routes = {}
+        self.skipped = 0
+
+    def add_line(self, line):
+        entry = parse_line(line)
+        if entry is None:
+            self.skipped += 1
+            return
+        route = entry["route"]
+        if route not in self.routes and len(self.routes) >= self.max_routes:
+            route = "other"
+        if route not in self.routes:
+            self.routes[route] = RouteStats()
+        self.routes[route].add(entry)
+
+    def summary(self):
+        return {route: stats.summary() for route, stats in self.routes.items()}
+
+
+def get_log_files(path=ACCESS_LOG):
+    """
+    Returns the access log and its rotated files, oldest first
+    """
+
+    def rotation(rotated_path):
+        number = rotated_path[len(path) + 1 :].split(".")[0]
+        return int(number) if number.isdigit() else 0
+
+    rotated = [rotated_path for rotated_path in glob.glob(path + ".*") if rotation(rotated_path)]
+    return sorted(rotated, key=rotation, reverse=True) + [path]
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def get_rotation(path, log_file):
+    """
+    Returns how logrotate rotated log_file, the log at path: "replaced" when
+    path is another file, "truncated" when it was truncated, None if it was not
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # moved away, and not created again yet
+        return None
+    if stat.st_ino != os.fstat(log_file.fileno()).st_ino:
+        return "replaced"
+    if stat.st_size < log_file.tell():
+        return "truncated"
+    return None
+
+
+def follow(path, interval, callback):
+    """
+    Calls callback with every line written to the log at path from now on,
+    and yields every interval seconds, until interrupted. The log is opened
+    again when logrotate replaces or truncates it.
+    """
+    log_file = open_log(path)
+    try:
+        log_file.seek(0, os.SEEK_END)
+        deadline = time.monotonic() + interval
+        while True:
+            line = log_file.readline()
+            if line:
+                callback(line)
+                continue
+            rotation = get_rotation(path, log_file)
+            if rotation == "truncated":
+                log_file.seek(0)
+                continue
+            if rotation == "replaced":
+                # nginx writes to the rotated log until it opens the new one
+                for line in log_file:
+                    callback(line)
+                log_file.close()
+                log_file = open_log(path)
+                continue
+            if time.monotonic() >= deadline:
+                yield
+                deadline = time.monotonic() + interval
+            time.sleep(FOLLOW_POLL_INTERVAL)
+    finally:
+        log_file.close()
+
+
+def print_report(summary, sort, top):
+    def milliseconds(value):
+        return "{:9.1f}".format(value * 1000) if value is not None else "        -"
+
+    routes = sorted(summary.items(), key=lambda item: item[1][sort] or 0, reverse=True)[:top]
+    print(
+        "{:>8} {:>9} {:>9} {:>9} {:>9} {:>9}  {:<24} {}".format(
+            "requests", "total s", "p50 ms", "p95 ms", "p99 ms", "up p95 ms", "status", "route"
+        )
+    )
+    for route, entry in routes:
+        print(
+            "{:8d} {:9.1f} {} {} {} {}  {:<24} {}".format(
+                entry["requests"],
+                entry["seconds"],
+                milliseconds(entry["p50"]),
+                milliseconds(entry["p95"]),
+                milliseconds(entry["p99"]),
+                milliseconds(entry["upstream_p95"]),
+                " ".join("{}:{}".format(key, value) for key, value in sorted(entry["statuses"].items())),
+                route,
+            )
+        )
+        cache_statuses = {key: value for key, value in entry["cache_statuses"].items() if key != "-"}
+        if cache_statuses:
+            print(
+                "{:>58}  cache {}".format(
+                    "", " ".join("{}:{}".format(key, value) for key, value in sorted(cache_statuses.items()))
+                )
+            )
+    print("")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the latency of every Kolibri endpoint from the nginx log")
+    parser.add_argument("files", nargs="*", help="Log files to read, the access log and its rotated files by default")
+    parser.add_argument("--follow", action="store_true", help="Follow the access log, reporting every --interval")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between two reports when following")
+    parser.add_argument(
+        "--sort", default="seconds", choices=("seconds", "requests", "p95", "p99"), help="Order of the routes"
+    )
+    parser.add_argument("--top", type=int, default=30, help="Number of routes reported")
+    parser.add_argument("--json", default="", help="File to save the statistics of every route to")
+    args = parser.parse_args()
+
+    stats = LogStats()
+    try:
+        if args.follow:
+            path = args.files[0] if args.files else ACCESS_LOG
+            for _ in follow(path, args.interval, stats.add_line):
+                print_report(stats.summary(), args.sort, args.top)
+        else:
+            for path in args.files or get_log_files():
+                with open_log(path) as log_file:
+                    for line in log_file:
+                        stats.add_line(line)
+    except OSError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        pass
+
+    summary = stats.summary()
+    print_report(summary, args.sort, args.top)
+    if stats.skipped:
+        print("{} lines not in the uwsgi_timed_combined format were skipped".format(stats.skipped))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(summary, json_file, indent=2)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+"""
+Exports metrics of kolibri-server in the Prometheus text format.
+
+On every scrape, the stats sockets of the uwsgi instances, the stub_status
+page of nginx and the INFO of Redis are read, and reported as:
+
+- per uwsgi worker: its status, requests, average response time, RSS and respawns
+- per uwsgi instance: its listen queue and the requests it refused
+- nginx connections by state, and the connections and requests it handled
+- Redis hits, misses, hit rate, evictions and memory
+
+uwsgi instances are labelled pool, as Prometheus labels every metric with the
+instance it scraped.
+
+A source that can not be read is reported as down, the others still are.
+The init script runs it in the background, as configured in the [Metrics]
+section of /etc/kolibri/kolibri-server.ini. Run by hand, as the user running
+Kolibri, --once prints the metrics and exits:
+
+    /usr/share/kolibri-server/kolibri_server_metrics.py --once
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import socket
+import ssl
+import sys
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger("kolibri_server_metrics")
+
+# Set in the uwsgi.ini generated by kolibri_server_setup.py, along with those
+# of the other main instances
+UWSGI_STATS_SOCKETS = {
+    "main": "/tmp/kolibri_uwsgi_stats.sock",
+    "hashi": "/tmp/kolibri_hashi_uwsgi_stats.sock",
+    "long": "/tmp/kolibri_long_uwsgi_stats.sock",
+}
+NGINX_STATUS_PATH = "/kolibri_server_nginx_status"
+
+# Seconds after which a source is reported as down
+SOURCE_TIMEOUT = 2
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STUB_STATUS_REGEX = re.compile(
+    r"Active connections:\s*(\d+).*?(\d+)\s+(\d+)\s+(\d+)\s+Reading:\s*(\d+)\s+Writing:\s*(\d+)\s+Waiting:\s*(\d+)",
+    re.DOTALL,
+)
+
+
+class Metrics(object):
+    """
+    Metrics of a scrape, with their help and type, in the order they are added
+    """
+
+    def __init__(self):
+        self.families = {}
+
+    def add(self, name, kind, help_text, value, **labels):
+        family = self.families.setdefault(name, {"kind": kind, "help": help_text, "samples": []})
+        family["samples"].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, family in self.families.items():
+            lines.append("# HELP kolibri_server_{} {}".format(name, family["help"]))
+            lines.append("# TYPE kolibri_server_{} {}".format(name, family["kind"]))
+            for labels, value in family["samples"]:
+                label_text = ",".join('{}="{}"'.format(key, labels[key]) for key in sorted(labels))
+                lines.append("kolibri_server_{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+        return "\n".join(lines) + "\n"
+
+
+def read_uwsgi_stats(path, timeout=SOURCE_TIMEOUT):
+    """
+    Returns the stats uwsgi writes to its stats socket on every connection
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return json.loads(b"".join(chunks).decode("utf-8", "replace"))
+
+
+def add_uwsgi_metrics(metrics, instance, stats):
+    if stats is None:
+        metrics.add("uwsgi_up", "gauge", "Whether the uwsgi stats socket could be read", 0, pool=instance)
+        return
+    metrics.add("uwsgi_up", "gauge", "Whether the uwsgi stats socket could be read", 1, pool=instance)
+    metrics.add(
+        "uwsgi_listen_queue",
+        "gauge",
+        "Requests waiting for a worker in the listen queue",
+        stats.get("listen_queue", 0),
+        pool=instance,
+    )
+    metrics.add(
+        "uwsgi_listen_queue_errors_total",
+        "counter",
+        "Requests refused because the listen queue was full",
+        stats.get("listen_queue_errors", 0),
+        pool=instance,
+    )
+    workers = stats.get("workers", [])
+    statuses = Counter(worker.get("status", "unknown") for worker in workers)
+    for status in ("idle", "busy", "cheap"):
+        statuses.setdefault(status, 0)
+    for status, count in sorted(statuses.items()):
+        metrics.add("uwsgi_workers", "gauge", "Workers by status", count, pool=instance, status=status)
+    for worker in workers:
+        if worker.get("status") == "cheap":
+            # stopped by the cheaper algorithm
+            continue
+        labels = {"pool": instance, "worker": worker["id"]}
+        metrics.add(
+            "uwsgi_worker_requests_total", "counter", "Requests served by a worker", worker["requests"], **labels
+        )
+        metrics.add(
+            "uwsgi_worker_busy",
+            "gauge",
+            "Whether a worker is serving a request",
+            int(worker.get("status") == "busy"),
+            **labels,
+        )
+        metrics.add(
+            "uwsgi_worker_avg_response_seconds",
+            "gauge",
+            "Average response time of a worker",
+            worker.get("avg_rt", 0) / 1000000,
+            **labels,
+        )
+        metrics.add("uwsgi_worker_rss_bytes", "gauge", "Resident memory of a worker", worker.get("rss", 0), **labels)
+        metrics.add(
+            "uwsgi_worker_respawns_total",
+            "counter",
+            "Times a worker was respawned",
+            worker.get("respawn_count", 0),
+            **labels,
+        )
+
+
+def parse_stub_status(text):
+    """
+    Returns the counters of the nginx stub_status page, or None if text is not one
+    """
+    match = STUB_STATUS_REGEX.search(text)
+    if match is None:
+        return None
+    names = ("active", "accepts", "handled", "requests", "reading", "writing", "waiting")
+    return dict(zip(names, (int(value) for value in match.groups())))
+
+
+def add_nginx_metrics(metrics, status):
+    metrics.add("nginx_up", "gauge", "Whether the nginx stub_status page could be read", int(status is not None))
+    if status is None:
+        return
+    for state in ("reading", "writing", "waiting"):
+        metrics.add("nginx_connections", "gauge", "Client connections by state", status[state], state=state)
+    for name in ("accepts", "handled", "requests"):
+        metrics.add(
+            "nginx_{}_total".format(name),
+            "counter",
+            "Client connections accepted and handled, and requests handled",
+            status[name],
+        )
+
+
+def add_redis_metrics(metrics, info):
+    metrics.add("redis_up", "gauge", "Whether Redis answered INFO", int(info is not None))
+    if info is None:
+        return
+    hits = info.get("keyspace_hits", 0)
+    misses = info.get("keyspace_misses", 0)
+    metrics.add("redis_keyspace_hits_total", "counter", "Lookups of keys found in Redis", hits)
+    metrics.add("redis_keyspace_misses_total", "counter", "Lookups of keys missing from Redis", misses)
+    if hits + misses:
+        metrics.add("redis_hit_ratio", "gauge", "Fraction of lookups found since Redis started", hits / (hits + misses))
+    metrics.add(
+        "redis_evicted_keys_total", "counter", "Keys evicted to stay under maxmemory", info.get("evicted_keys", 0)
+    )
+    metrics.add("redis_used_memory_bytes", "gauge", "Memory used by Redis", info.get("used_memory", 0))
+    metrics.add("redis_maxmemory_bytes", "gauge", "Memory Redis can use, 0 if unlimited", info.get("maxmemory", 0))
+
+
+class Exporter(object):
+    def __init__(self, nginx_url, redis_client=None, uwsgi_stats_sockets=UWSGI_STATS_SOCKETS):
+        self.nginx_url = nginx_url
+        self.redis_client = redis_client
+        self.uwsgi_stats_sockets = uwsgi_stats_sockets
+        self.context = None
+        if nginx_url.startswith("https:"):
+            # nginx on this server, whose certificate is for the name clients use
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+    def collect(self):
+        metrics = Metrics()
+        for instance, path in sorted(self.uwsgi_stats_sockets.items()):
+            try:
+                stats = read_uwsgi_stats(path)
+            except (OSError, ValueError) as e:
+                logger.debug("Could not read {}: {}".format(path, e))
+                stats = None
+            add_uwsgi_metrics(metrics, instance, stats)
+
+        try:
+            with urllib.request.urlopen(self.nginx_url, timeout=SOURCE_TIMEOUT, context=self.context) as response:
+                status = parse_stub_status(response.read().decode("utf-8", "replace"))
+        except (OSError, ValueError) as e:
+            logger.debug("Could not read {}: {}".format(self.nginx_url, e))
+            status = None
+        add_nginx_metrics(metrics, status)
+
+        info = None
+        if self.redis_client is not None:
+            try:
+                info = self.redis_client.info()
+            except Exception as e:
+                # any error of the redis client, which this module does not import
+                logger.debug("Could not read the INFO of redis: {}".format(e))
+        add_redis_metrics(metrics, info)
+        return metrics.render()
+
+
+def serve(exporter, address, port, pidfile=None):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = exporter.collect().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    if pidfile:
+        # only once it listens, so a disabled or failing exporter has none
+        with open(pidfile, "w") as pid_file:
+            pid_file.write("{}\n".format(os.getpid()))
+    logger.info("Serving metrics on http://{}:{}/metrics".format(address, port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    # reads the options of Kolibri when imported, which the tests of this
+    # module do without
+    import kolibri_server_setup as setup
+
+    parser = argparse.ArgumentParser(description="Export metrics of kolibri-server for Prometheus")
+    parser.add_argument("--once", action="store_true", help="Print the metrics and exit")
+    parser.add_argument("--pidfile", help="File the pid is written to once the exporter listens")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    host = setup.listen_address if setup.listen_address != "0.0.0.0" else "127.0.0.1"
+    redis_client = None
+    if setup.OPTIONS["Cache"]["CACHE_BACKEND"] == "redis":
+        redis_client = setup.get_redis_client(setup.redis_db, timeout=SOURCE_TIMEOUT)
+    exporter = Exporter(
+        "{}://{}:{}{}".format(setup.get_nginx_scheme(), host, setup.port, NGINX_STATUS_PATH),
+        redis_client,
+        setup.get_uwsgi_stats_sockets(),
+    )
+    if args.once:
+        sys.stdout.write(exporter.collect())
+        sys.exit(0)
+    options = setup.server_options["Metrics"]
+    if not options["ENABLED"]:
+        logger.info("The metrics exporter is disabled")
+        sys.exit(0)
+    serve(exporter, options["LISTEN_ADDRESS"], options["PORT"], args.pidfile)
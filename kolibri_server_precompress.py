@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""
+Precompresses the static files of Kolibri for nginx.
+
+Every text file of a directory, the static files Kolibri collects by
+default, gets .gz and, when python3-brotli is installed, .br siblings
+compressed at the highest level, which nginx sends as they are with
+gzip_static and brotli_static instead of compressing files on every request.
+Files are compressed in parallel on every core. A manifest keeps the hash
+of every file compressed, so files left unchanged, even when Kolibri copied
+them again on upgrade, are skipped, and the siblings of files gone or no
+longer worth compressing are removed.
+
+The init script runs it in the background on every start, once Kolibri
+answers, unless PRECOMPRESS is false in [Compression] of
+/etc/kolibri/kolibri-server.ini. It can also be run by hand as the user
+running Kolibri:
+
+    /usr/share/kolibri-server/kolibri_server_precompress.py
+
+or as root on other directories, such as the error pages of the package:
+
+    /usr/share/kolibri-server/kolibri_server_precompress.py /usr/share/kolibri/error_pages \\
+        --manifest /var/cache/kolibri-server/error_pages.json
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    # python3-brotli is not installed: only .gz files are written
+    brotli = None
+
+logger = logging.getLogger("kolibri_server_precompress")
+
+# Files worth compressing, and the smallest one compressed, as in the gzip
+# options of the nginx configuration
+EXTENSIONS = (".js", ".mjs", ".css", ".json", ".map", ".svg", ".html", ".txt", ".xml", ".ttf", ".otf", ".eot", ".ico")
+MIN_SIZE = 1024
+
+# Compressed files larger than this fraction of their file are not kept
+MAX_RATIO = 0.9
+
+# Pages holding server side includes, which nginx can not run on compressed files
+SSI_MARKER = b"<!--#"
+
+ENCODINGS = (".gz", ".br")
+
+
+def compress_gzip(data):
+    # without a timestamp, so unchanged files compress to the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+def get_compressors():
+    compressors = {".gz": compress_gzip}
+    if brotli is not None:
+        compressors[".br"] = compress_brotli
+    return compressors
+
+
+def write_file(path, data, mtime):
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "wb") as output_file:
+        output_file.write(data)
+    # same modification time as the file, which nginx sends as Last-Modified
+    os.utime(temporary_path, ns=(mtime, mtime))
+    os.replace(temporary_path, path)
+
+
+def remove_siblings(path):
+    for extension in ENCODINGS:
+        try:
+            os.remove(path + extension)
+        except FileNotFoundError:
+            pass
+
+
+def precompress_file(path):
+    """
+    Writes the compressed siblings of path, and returns the hash of path, the
+    extensions of the siblings kept and the size and modification time of
+    path, or None if it could not be compressed
+    """
+    try:
+        with open(path, "rb") as source_file:
+            data = source_file.read()
+        mtime = os.stat(path).st_mtime_ns
+        if SSI_MARKER in data:
+            remove_siblings(path)
+            return hashlib.sha1(data).hexdigest(), [], [len(data), mtime]
+        kept = []
+        for extension, compress in sorted(get_compressors().items()):
+            compressed = compress(data)
+            if len(compressed) > len(data) * MAX_RATIO:
+                remove_siblings(path)
+                kept = []
+                break
+            write_file(path + extension, compressed, mtime)
+            kept.append(extension)
+    except OSError:
+        return None
+    return hashlib.sha1(data).hexdigest(), kept, [len(data), mtime]
+
+
+def get_files(directory):
+    """
+    Returns the paths, relative to directory, of the files worth compressing
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if not name.endswith(EXTENSIONS) or os.path.islink(path):
+                continue
+            try:
+                if os.path.getsize(path) < MIN_SIZE:
+                    continue
+            except OSError:
+                continue
+            files.append(os.path.relpath(path, directory))
+    return sorted(files)
+
+
+def get_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def is_unchanged(path, entry, extensions):
+    """
+    Returns whether the siblings of path written for entry of the manifest
+    are still those of its content
+    """
+    if entry is None or entry["compressors"] != extensions:
+        return False
+    if not all(os.path.exists(path + extension) for extension in entry["encodings"]):
+        return False
+    stat = os.stat(path)
+    if [stat.st_size, stat.st_mtime_ns] == entry["stat"]:
+        return True
+    return get_digest(path) == entry["sha1"]
+
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    temporary_path = "{}.tmp".format(manifest_path)
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_path, manifest_path)
+
+
+def precompress(directory, manifest_path=None, workers=None):
+    """
+    Compresses the files of directory that changed since the manifest was
+    saved, and returns the numbers of files compressed and skipped
+    """
+    start = time.time()
+    previous = read_manifest(manifest_path) if manifest_path else {}
+    extensions = sorted(get_compressors())
+    manifest = {}
+    pending = []
+    for relative_path in get_files(directory):
+        path = os.path.join(directory, relative_path)
+        entry = previous.get(relative_path)
+        try:
+            if is_unchanged(path, entry, extensions):
+                # copied again by Kolibri, the hash is not computed next time
+                stat = os.stat(path)
+                manifest[relative_path] = dict(entry, stat=[stat.st_size, stat.st_mtime_ns])
+                continue
+        except OSError:
+            continue
+        pending.append(relative_path)
+
+    # siblings written for files gone, or too small now
+    for relative_path in set(previous) - set(manifest) - set(pending):
+        remove_siblings(os.path.join(directory, relative_path))
+
+    unchanged = len(manifest)
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            paths = [os.path.join(directory, relative_path) for relative_path in pending]
+            for relative_path, path, result in zip(pending, paths, executor.map(precompress_file, paths, chunksize=8)):
+                if result is None:
+                    logger.warning("Could not compress {}".format(path))
+                    continue
+                manifest[relative_path] = {
+                    "sha1": result[0],
+                    "stat": result[2],
+                    "compressors": extensions,
+                    "encodings": result[1],
+                }
+
+    if manifest_path:
+        save_manifest(manifest_path, manifest)
+    logger.info(
+        "Compressed {} files of {} to {} in {:.1f}s, {} unchanged".format(
+            len(pending), directory, " and ".join(extensions), time.time() - start, unchanged
+        )
+    )
+    return len(pending), unchanged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompress the static files of Kolibri for nginx")
+    parser.add_argument("directory", nargs="?", help="Directory to compress, the static files of Kolibri by default")
+    parser.add_argument("--manifest", help="File keeping the hash of every file compressed")
+    parser.add_argument("--workers", type=int, help="Number of files compressed at once, one per core by default")
+    parser.add_argument("--force", action="store_true", help="Compress even if disabled in kolibri-server.ini")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    if args.directory:
+        directory, manifest_path = args.directory, args.manifest
+    else:
+        # reads the options of Kolibri when imported, which compressing a
+        # directory given on the command line does without
+        import kolibri_server_setup as setup
+
+        if not setup.server_options["Compression"]["PRECOMPRESS"] and not args.force:
+            logger.info("Precompression is disabled")
+            sys.exit(0)
+        directory, manifest_path = setup.get_static_root(), args.manifest or setup.PRECOMPRESS_MANIFEST
+    if not os.path.isdir(directory):
+        sys.exit("{} is not a directory".format(directory))
+    if brotli is None:
+        logger.info("python3-brotli is not installed, only writing .gz files")
+    precompress(directory, manifest_path, args.workers)
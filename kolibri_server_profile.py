@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+"""
+Measures the time a uwsgi worker of kolibri-server takes to be ready.
+
+Each Kolibri WSGI application served by kolibri-server is loaded in a new
+Python process, under -X importtime and cProfile, then answers its first
+requests. The slowest imports, Django app ready hooks, functions and the
+latency of these requests are reported, and can be saved as JSON to compare
+Kolibri releases or servers.
+
+Run it as the user running Kolibri, with the same KOLIBRI_HOME:
+
+    /usr/share/kolibri-server/kolibri_server_profile.py --json profile.json
+"""
+
+import argparse
+import cProfile
+import importlib
+import io
+import json
+import os
+import pstats
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from wsgiref.util import setup_testing_defaults
+
+# Module and WSGI application of each uwsgi instance
+APPLICATIONS = {
+    "main": ("kolibri.deployment.default.wsgi", "application"),
+    "hashi": ("kolibri.deployment.default.alt_wsgi", "alt_application"),
+}
+
+# Functions of the import machinery, which include every import in their time
+IMPORT_MACHINERY = ("<frozen importlib", "~")
+
+# Line written to stderr by -X importtime for every imported module
+IMPORT_TIME_REGEX = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$")
+
+
+def parse_import_times(lines):
+    """
+    Returns the module, self time and cumulative time, in microseconds, of
+    every import reported by -X importtime
+    """
+    imports = []
+    for line in lines:
+        match = IMPORT_TIME_REGEX.match(line)
+        if match is not None:
+            self_time, cumulative_time, _, module = match.groups()
+            imports.append({"module": module, "self_us": int(self_time), "cumulative_us": int(cumulative_time)})
+    return imports
+
+
+def rank(entries, key, top):
+    return sorted(entries, key=lambda entry: entry[key], reverse=True)[:top]
+
+
+def time_app_ready_hooks(ready_times):
+    """
+    Records in ready_times the seconds the ready() method of every Django app takes
+    """
+    # patched before Kolibri sets up Django, which is timed
+    from django.apps.config import AppConfig  # noqa: PLC0415
+
+    create = AppConfig.create
+
+    def timed_create(cls, entry):
+        app_config = create(entry)
+        ready = app_config.ready
+
+        def timed_ready():
+            start = time.perf_counter()
+            ready()
+            ready_times[app_config.name] = time.perf_counter() - start
+
+        app_config.ready = timed_ready
+        return app_config
+
+    AppConfig.create = classmethod(timed_create)
+
+
+def request(application, path):
+    """
+    Sends a GET request for path to a WSGI application, and returns its
+    status and the seconds taken to answer it
+    """
+    environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET"}
+    setup_testing_defaults(environ)
+    status = []
+
+    def start_response(response_status, headers, exc_info=None):
+        status.append(response_status)
+
+    start = time.perf_counter()
+    response = application(environ, start_response)
+    try:
+        for _ in response:
+            pass
+    finally:
+        if hasattr(response, "close"):
+            response.close()
+    return {"path": path, "status": status[0] if status else None, "seconds": time.perf_counter() - start}
+
+
+def get_request_paths(name):
+    """
+    Returns the paths requested from an application once it is loaded
+    """
+    if name == "main":
+        # Kolibri is only imported in the profiled child process
+        from kolibri.utils.conf import OPTIONS  # noqa: PLC0415
+
+        path_prefix = OPTIONS["Deployment"]["URL_PATH_PREFIX"]
+        path_prefix = "/" + path_prefix.strip("/") + "/" if path_prefix.strip("/") else "/"
+        return [path_prefix + "api/public/info/"] * 2
+    # Kolibri is only imported in the profiled child process
+    from kolibri.core.content.utils.paths import get_zip_content_base_path  # noqa: PLC0415
+
+    base_path = get_zip_content_base_path()
+    return [base_path + "0" * 32 + ".zip/index.js"] * 2
+
+
+def profile_application(name, top):
+    """
+    Loads an application in this process and returns its measurements, to be
+    run under -X importtime
+    """
+    module_name, application_name = APPLICATIONS[name]
+    ready_times = {}
+    profile = cProfile.Profile()
+
+    # sets up the paths of the Python packages Kolibri ships
+    import kolibri  # noqa: F401, PLC0415
+
+    time_app_ready_hooks(ready_times)
+    start = time.perf_counter()
+    profile.enable()
+    # the module is named by APPLICATIONS
+    application = getattr(importlib.import_module(module_name), application_name)
+    profile.disable()
+    load_time = time.perf_counter() - start
+
+    requests = [request(application, path) for path in get_request_paths(name)]
+
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    functions = [
+        {
+            "function": "{}:{}({})".format(*function),
+            "calls": calls,
+            "self_seconds": self_time,
+            "cumulative_seconds": cumulative_time,
+        }
+        for function, (_, calls, self_time, cumulative_time, _) in stats.stats.items()
+        if not function[0].startswith(IMPORT_MACHINERY) and not function[0].endswith("importlib/__init__.py")
+    ]
+    return {
+        "load_seconds": load_time,
+        "app_ready": rank(
+            [{"app": app, "seconds": seconds} for app, seconds in ready_times.items()],
+            "seconds",
+            top,
+        ),
+        "functions": rank(functions, "cumulative_seconds", top),
+        "requests": requests,
+    }
+
+
+def run_profile(name, top):
+    """
+    Profiles an application in a new Python process, and returns its report
+    """
+    with tempfile.NamedTemporaryFile(mode="r", suffix=".json") as result_file:
+        child = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                os.path.abspath(__file__),
+                "--child",
+                name,
+                "--top",
+                str(top),
+                "--json",
+                result_file.name,
+            ],
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if child.returncode:
+            lines = [line for line in child.stderr.splitlines() if not IMPORT_TIME_REGEX.match(line)]
+            raise RuntimeError("Could not load the {} application:\n{}".format(name, "\n".join(lines[-20:])))
+        report = json.load(result_file)
+    imports = parse_import_times(child.stderr.splitlines())
+    report["imports"] = {
+        "count": len(imports),
+        "cumulative": rank(imports, "cumulative_us", top),
+        "self": rank(imports, "self_us", top),
+    }
+    return report
+
+
+def print_report(name, report):
+    print("== {} application: loaded in {:.2f}s ==".format(name, report["load_seconds"]))
+    print("\nSlowest imports, with the modules they import ({} modules imported):".format(report["imports"]["count"]))
+    for entry in report["imports"]["cumulative"]:
+        print("  {:10.1f} ms  {}".format(entry["cumulative_us"] / 1000, entry["module"]))
+    print("\nSlowest imports, by themselves:")
+    for entry in report["imports"]["self"]:
+        print("  {:10.1f} ms  {}".format(entry["self_us"] / 1000, entry["module"]))
+    print("\nSlowest Django app ready hooks:")
+    for entry in report["app_ready"]:
+        print("  {:10.1f} ms  {}".format(entry["seconds"] * 1000, entry["app"]))
+    print("\nSlowest functions while loading:")
+    for entry in report["functions"]:
+        print("  {:10.1f} ms  {}".format(entry["cumulative_seconds"] * 1000, entry["function"]))
+    print("\nFirst requests:")
+    for entry in report["requests"]:
+        print("  {:10.1f} ms  {} {}".format(entry["seconds"] * 1000, entry["status"], entry["path"]))
+    print("")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the startup of the Kolibri applications of kolibri-server")
+    parser.add_argument(
+        "-a",
+        "--application",
+        action="append",
+        choices=sorted(APPLICATIONS),
+        help="Application to profile, all of them by default",
+    )
+    parser.add_argument("--top", type=int, default=20, help="Number of entries of each ranking")
+    parser.add_argument("--json", default="", help="File to save the report to")
+    parser.add_argument("--child", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        report = profile_application(args.child, args.top)
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file)
+        sys.exit(0)
+
+    reports = {}
+    for name in args.application or sorted(APPLICATIONS):
+        try:
+            reports[name] = run_profile(name, args.top)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        print_report(name, reports[name])
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(reports, json_file, indent=2)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""
+Reloads the uwsgi instances of kolibri-server one after the other, without
+refusing a request.
+
+The master of every instance gets SIGHUP in turn: it lets its workers finish
+their requests and runs again, with the configuration kolibri_server_setup.py
+wrote and the Kolibri now installed, keeping its socket open, so requests
+wait in its listen queue instead of failing. The next instance is only
+reloaded once all the workers of this one were replaced by workers accepting
+requests, read from its stats socket, so with several INSTANCES in [uWSGI]
+of /etc/kolibri/kolibri-server.ini nginx sends requests to the others
+meanwhile. With a single instance serving Kolibri, requests wait for it in
+its listen queue while it is reloaded, which is warned about. If an instance is not ready in time, or the whole reload takes
+too long, the instances left are left as they are.
+
+`service kolibri-server reload` runs it after writing the configuration
+again. It reads the instances, and their stats sockets, from the uwsgi.ini
+written by kolibri_server_setup.py, and their masters from their pidfiles,
+or from systemd with --systemd when kolibri-server-native.target runs them:
+
+    /usr/share/kolibri-server/kolibri_server_reload.py $KOLIBRI_HOME/uwsgi.ini
+"""
+
+import argparse
+import configparser
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+from kolibri_server_metrics import read_uwsgi_stats
+
+logger = logging.getLogger("kolibri_server_reload")
+
+# Written by the init script
+PIDFILE_DIR = "/var/run/kolibri-server"
+
+# Units of the uwsgi instances of kolibri-server-native.target
+SYSTEMD_UNIT = "kolibri-server-uwsgi@{}.service"
+
+# Seconds an instance has to finish its requests and start all its workers,
+# and all the instances have, within TimeoutStartSec of kolibri-server.service
+RELOAD_TIMEOUT = 180
+RELOAD_TOTAL_TIMEOUT = 600
+
+# Seconds between two reads of the stats of an instance being reloaded
+POLL_INTERVAL = 0.5
+
+# Instances serving Kolibri, main, main2, main3..., as opposed to hashi and long
+MAIN_INSTANCE_REGEX = re.compile(r"^main\d*$")
+
+
+def get_instances(uwsgi_conf):
+    """
+    Returns the stats socket of every uwsgi instance of uwsgi_conf, in the
+    order they are reloaded
+    """
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    if not parser.read(uwsgi_conf):
+        raise OSError("Could not read {}".format(uwsgi_conf))
+    return [(section, parser[section]["stats"]) for section in parser.sections() if "stats" in parser[section]]
+
+
+def get_pidfile(instance, pidfile_dir=PIDFILE_DIR):
+    if instance == "main":
+        return os.path.join(pidfile_dir, "uwsgi.pid")
+    return os.path.join(pidfile_dir, "uwsgi_{}.pid".format(instance))
+
+
+def get_master_pid(pidfile):
+    """
+    Returns the pid of the uwsgi master written to pidfile, or None if it is
+    not running
+    """
+    try:
+        with open(pidfile) as pid_file:
+            pid = int(pid_file.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def get_systemd_pid(instance):
+    """
+    Returns the pid of the uwsgi master systemd runs for instance, or None if
+    it is not running
+    """
+    try:
+        output = subprocess.check_output(
+            ["systemctl", "show", "--property=MainPID", "--value", SYSTEMD_UNIT.format(instance)]
+        )
+        return int(output.strip()) or None
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def get_reload_progress(stats, old_pids, since):
+    """
+    Returns the numbers of workers of stats replaced since the reload started,
+    of those accepting requests, and of the workers running
+    """
+    workers = [worker for worker in stats.get("workers", []) if worker.get("pid")]
+    replaced = [
+        worker for worker in workers if worker["pid"] not in old_pids and worker.get("last_spawn", 0) >= int(since)
+    ]
+    ready = [worker for worker in replaced if worker.get("accepting")]
+    return len(replaced), len(ready), len(workers)
+
+
+def reload_instance(instance, pid, stats_socket, timeout=RELOAD_TIMEOUT):
+    """
+    Reloads the uwsgi instance whose master is pid, and returns whether all
+    its workers were replaced by workers accepting requests within timeout
+    seconds
+    """
+    try:
+        old_pids = {worker.get("pid") for worker in read_uwsgi_stats(stats_socket).get("workers", [])}
+    except (OSError, ValueError):
+        old_pids = set()
+    start = time.time()
+    try:
+        os.kill(pid, signal.SIGHUP)
+    except ProcessLookupError:
+        # stopped since its pid was read
+        logger.warning("{} is not running, not reloaded".format(instance))
+        return True
+    logger.info("Reloading {}".format(instance))
+    progress = None
+    while time.time() - start < timeout:
+        time.sleep(POLL_INTERVAL)
+        try:
+            stats = read_uwsgi_stats(stats_socket)
+        except (OSError, ValueError):
+            # the stats server starts again with the master
+            continue
+        replaced, ready, workers = get_reload_progress(stats, old_pids, start)
+        if (replaced, ready, workers) != progress:
+            progress = (replaced, ready, workers)
+            logger.info("{}: {} of {} workers replaced, {} ready".format(instance, replaced, workers, ready))
+        if workers and ready == workers:
+            logger.info("{} reloaded in {:.1f}s".format(instance, time.time() - start))
+            return True
+    logger.error("{} was not reloaded within {}s".format(instance, timeout))
+    return False
+
+
+def reload(
+    instances, pidfile_dir=PIDFILE_DIR, timeout=RELOAD_TIMEOUT, systemd=False, total_timeout=RELOAD_TOTAL_TIMEOUT
+):
+    """
+    Reloads the running uwsgi instances one after the other, within
+    total_timeout seconds, and returns whether they all were
+    """
+    if len([instance for instance, _ in instances if MAIN_INSTANCE_REGEX.match(instance)]) < 2:
+        logger.warning(
+            "A single uwsgi instance serves Kolibri, so requests wait while it is reloaded: "
+            "set INSTANCES to 2 or more in [uWSGI] of /etc/kolibri/kolibri-server.ini to keep answering them"
+        )
+    deadline = time.time() + total_timeout
+    for instance, stats_socket in instances:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logger.error(
+                "Reloading took more than {}s, {} and the next instances were not".format(total_timeout, instance)
+            )
+            return False
+        if systemd:
+            pid = get_systemd_pid(instance)
+        else:
+            pid = get_master_pid(get_pidfile(instance, pidfile_dir))
+        if pid is None:
+            logger.warning("{} is not running, not reloaded".format(instance))
+            continue
+        if not reload_instance(instance, pid, stats_socket, min(timeout, remaining)):
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reload the uwsgi instances of kolibri-server one after the other")
+    parser.add_argument("uwsgi_conf", help="uwsgi.ini written by kolibri_server_setup.py")
+    parser.add_argument("--pidfile-dir", default=PIDFILE_DIR, help="Directory of the pidfiles of the uwsgi masters")
+    parser.add_argument("--systemd", action="store_true", help="Reload the instances run by systemd units")
+    parser.add_argument(
+        "--timeout", type=int, default=RELOAD_TIMEOUT, help="Seconds every instance has to be ready again"
+    )
+    parser.add_argument(
+        "--total-timeout", type=int, default=RELOAD_TOTAL_TIMEOUT, help="Seconds all the instances have to be reloaded"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    try:
+        instances = get_instances(args.uwsgi_conf)
+    except (OSError, configparser.Error) as e:
+        sys.exit(str(e))
+    if not reload(instances, args.pidfile_dir, args.timeout, args.systemd, args.total_timeout):
+        sys.exit(1)
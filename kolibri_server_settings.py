@@ -0,0 +1,15 @@
+"""
+Django settings of the main uwsgi instance: Kolibri's own, with its Redis
+cache backend replaced by kolibri_server_cache, which keeps the keys read on
+most requests in every worker, when kolibri_server_setup.py enables it.
+"""
+
+import os
+
+from kolibri.deployment.default.settings.base import *  # noqa: F401,F403
+from kolibri.deployment.default.settings.base import CACHES
+
+if CACHES["default"]["BACKEND"].startswith("redis_cache") and int(
+    os.environ.get("KOLIBRI_SERVER_LOCAL_CACHE_SIZE", "0")
+):
+    CACHES["default"] = dict(CACHES["default"], BACKEND="kolibri_server_cache.TwoTierRedisCache")
@@ -1,14 +1,106 @@
 #!/usr/bin/python3
 import argparse
+import configparser
+import glob
+import hashlib
+import json
+import logging
 import os
+import re
+import shutil
+import sqlite3
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
+import kolibri
 import kolibri.utils.pskolibri as psutil
+import redis
 from kolibri.core.utils.cache import RedisSettingsHelper
-from kolibri.core.utils.cache import process_cache
 from kolibri.utils.conf import KOLIBRI_HOME
 from kolibri.utils.conf import OPTIONS
 from kolibri.utils.options import update_options_file
+from redis_cache.utils import parse_connection_kwargs
+
+from kolibri_server_metrics import NGINX_STATUS_PATH
+from kolibri_server_metrics import UWSGI_STATS_SOCKETS
+from kolibri_server_zipcache import ZipContentCache
+
+logger = logging.getLogger("kolibri_server_setup")
+
+# Options of kolibri-server itself, by section, with their default values.
+# They can not be kept in Kolibri's options.ini, as Kolibri drops any section
+# it does not know about whenever it rewrites that file.
+SERVER_OPTIONS_FILE = "/etc/kolibri/kolibri-server.ini"
+SERVER_OPTION_DEFAULTS = {
+    "ZipContent": {
+        "OFFLOAD": True,
+        "CACHE_DISK_FRACTION": 0.1,
+    },
+    "uWSGI": {
+        "WORKERS": 0,
+        "INSTANCES": 1,
+        "HASHI_WORKERS": 0,
+        "CHEAPER_ALGO": "busyness",
+        "CHEAPER_STEP": 0,
+        "CHEAPER_OVERLOAD": 2,
+        "BUSYNESS_MIN": 25,
+        "BUSYNESS_MAX": 50,
+        "BACKLOG_ALERT": 8,
+        "IDLE_TIME": 60,
+        "WARM_START": True,
+        "HARAKIRI": 60,
+        "HASHI_HARAKIRI": 60,
+        "LONG_REQUESTS": True,
+        "LONG_WORKERS": 0,
+        "LONG_HARAKIRI": 1800,
+        "LONG_REQUEST_PATHS": "",
+    },
+    "Redis": {
+        "AUTO_SIZE": True,
+        "HIT_RATE_FLOOR": 0.9,
+        "MAX_MEMORY_FRACTION": 0.25,
+        "MAXMEMORY_POLICY": "auto",
+        "UNIX_SOCKET": True,
+        "POOL_SIZE": 8,
+        "MAX_LATENCY_MS": 5.0,
+        "LOCAL_CACHE_SIZE": 16,
+        "LOCAL_CACHE_TTL": 10,
+    },
+    "Metrics": {
+        "ENABLED": True,
+        "LISTEN_ADDRESS": "127.0.0.1",
+        "PORT": 9180,
+    },
+    "Warmup": {
+        "ENABLED": True,
+        "TIMEOUT": 120,
+        "CONCURRENCY": 4,
+        "PATHS": "",
+    },
+    "Nginx": {
+        "KEEPALIVE_TIMEOUT": 75,
+        "KEEPALIVE_REQUESTS": 1000,
+        "REUSEPORT": True,
+        "HTTP2": True,
+        "SSL_CERTIFICATE": "",
+        "SSL_CERTIFICATE_KEY": "",
+        "UWSGI_BUFFERS": 16,
+    },
+    "Compression": {
+        "GZIP": True,
+        "GZIP_LEVEL": 6,
+        "PRECOMPRESS": True,
+    },
+    "Profiling": {
+        "SLOW_REQUESTS": False,
+        "SLOW_REQUEST_SECONDS": 5.0,
+        "SAMPLE_INTERVAL_MS": 100,
+        "LOG_SIZE": 10,
+        "LOG_BACKUPS": 5,
+    },
+}
 
 # read the config file options
 port = OPTIONS["Deployment"]["HTTP_PORT"]
@@ -16,10 +108,261 @@ zip_content_port = OPTIONS["Deployment"]["ZIP_CONTENT_PORT"]
 path_prefix = OPTIONS["Deployment"]["URL_PATH_PREFIX"]
 redis_db = OPTIONS["Cache"]["CACHE_REDIS_DB"]
 listen_address = OPTIONS["Deployment"]["LISTEN_ADDRESS"]
+content_dir = OPTIONS["Paths"]["CONTENT_DIR"]
 
 if path_prefix != "/":
     path_prefix = "/" + path_prefix
 
+# Redis on this server, as Kolibri connects to it by default, and the unix
+# sockets it is usually configured to listen on
+REDIS_TCP_LOCATION = "localhost:6379"
+REDIS_LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+REDIS_SOCKETS = (
+    "/run/redis/redis-server.sock",
+    "/run/redis/redis.sock",
+    "/var/run/redis/redis.sock",
+    "/tmp/redis.sock",
+)
+
+# PINGs sent to measure the latency of a connection to Redis, and seconds
+# after which a connection or command is given up while probing Redis
+REDIS_PING_COUNT = 200
+REDIS_PROBE_TIMEOUT = 2
+
+# Fraction of its maxmemory left under which Redis refusing writes is too
+# close to refuse Kolibri's
+REDIS_MIN_HEADROOM = 0.05
+
+# TCP location Kolibri used before being moved to the unix socket, to go back
+# to it when the socket is gone
+REDIS_CONNECTION_FILE = os.path.join(KOLIBRI_HOME, "redis_connection.json")
+
+# Keys of Kolibri's cache deleted when the service starts, with the offset of
+# their Redis database from CACHE_REDIS_DB
+REDIS_PURGE_PATTERNS = (
+    (0, ":1:views.decorators.*"),
+    (0, ":1:CHANNEL_STATS_CACHED_KEYS*"),
+    (0, ":1:*_dataset"),
+    (0, ":1:content_cache_key"),
+    (0, ":1:device_settings_cache_key"),
+    (1, "built_files:1:*"),
+)
+
+# Keys examined by every SCAN while deleting them, and patterns deleted at once
+REDIS_SCAN_COUNT = 10000
+REDIS_PURGE_THREADS = 8
+
+# What Kolibri's cache depended on when it was last invalidated
+REDIS_FINGERPRINT_FILE = os.path.join(KOLIBRI_HOME, "redis_fingerprint.json")
+
+# Redis starts with this fraction of the server memory, and grows by REDIS_GROWTH
+# on every start when keys were evicted and its hit rate is under the floor.
+# Hit rates are only trusted after REDIS_MIN_LOOKUPS lookups.
+REDIS_DEFAULT_MEMORY_FRACTION = 0.1
+REDIS_GROWTH = 1.5
+REDIS_MIN_LOOKUPS = 1000
+
+# Keys sampled to estimate the memory used by each kind of key
+REDIS_SAMPLE_KEYS = 1000
+
+# Counters of the previous start, to measure the hit rate since then
+REDIS_SIZING_FILE = os.path.join(KOLIBRI_HOME, "redis_sizing.json")
+
+# Policies Kolibri accepts for CACHE_REDIS_MAXMEMORY_POLICY. Any other policy
+# is set on Redis directly, leaving the Kolibri option empty so it is kept.
+KOLIBRI_MAXMEMORY_POLICIES = ("allkeys-lru", "volatile-lru", "allkeys-random", "volatile-random", "volatile-ttl")
+
+# Kolibri endpoints whose anonymous GET responses are cached by nginx, with
+# the time a response is considered fresh when Kolibri does not send its own
+# caching headers. Content metadata responses carry an Etag, so expired
+# entries are revalidated cheaply instead of being rendered again.
+CACHEABLE_LOCATIONS = (
+    ("api/content/channel/", "1m"),
+    ("api/content/contentnode/", "1m"),
+    ("api/content/contentnode_tree/", "1m"),
+    ("api/content/contentnode_search/", "1m"),
+    ("api/public/", "5m"),
+)
+
+# Same test Kolibri uses to mark static files as immutable: names carrying a
+# semantic version number or a 32 digit hash never change their content.
+IMMUTABLE_FILE_REGEX = r"(\d+\.\d+\.\d+|[a-f0-9]{32})"
+
+# Kolibri endpoints known to run for minutes: facility data synced with other
+# devices, CSV exports of logs and users, and the class summaries of coach
+# reports. They are served by the long uwsgi instance, with a timeout of their
+# own, so they do not hold the workers answering interactive requests. Kolibri
+# serves the API of each plugin below the URL slug of the plugin.
+LONG_REQUEST_LOCATIONS = (
+    "api/morango/",
+    "facility/api/downloadcsvfile/",
+    "coach/api/classsummary/",
+)
+
+# Sockets of the uwsgi instances, the first main instance keeping the socket
+# Kolibri was always served on. The main instances are balanced by nginx
+# through NGINX_UPSTREAM.
+UWSGI_SOCKET = "/tmp/kolibri_uwsgi.sock"
+UWSGI_INSTANCE_SOCKET = "/tmp/kolibri_{}_uwsgi.sock"
+UWSGI_INSTANCE_STATS_SOCKET = "/tmp/kolibri_{}_uwsgi_stats.sock"
+UWSGI_MAX_INSTANCES = 8
+NGINX_UPSTREAM = "kolibri_uwsgi"
+
+# A main instance failing this many requests in NGINX_UPSTREAM_FAIL_TIMEOUT
+# seconds is given none for as long, and requests it refused are passed to
+# the next one if they failed within NGINX_UPSTREAM_RETRY_TIMEOUT seconds, so
+# requests killed by harakiri are not run again
+NGINX_UPSTREAM_MAX_FAILS = 3
+NGINX_UPSTREAM_FAIL_TIMEOUT = 10
+NGINX_UPSTREAM_RETRY_TIMEOUT = 5
+
+# Seconds nginx waits for uwsgi beyond its harakiri, so uwsgi kills the request
+# instead of nginx giving up while the worker keeps running
+NGINX_READ_TIMEOUT_MARGIN = 5
+
+# Size of the buffer of a request of each uwsgi instance, buffer-size in
+# /etc/kolibri/dist/*uwsgi.ini. nginx reads responses with buffers as large.
+UWSGI_BUFFER_SIZE = {"main": 32768, "hashi": 8192}
+
+# nginx version from which http2 is enabled by its own directive instead of a
+# parameter of listen, which it deprecates
+NGINX_HTTP2_DIRECTIVE_VERSION = (1, 25, 1)
+
+# Client connections nginx needs for a classroom of 100 tablets, opening up to
+# 6 connections each to both Kolibri ports, with one more to uwsgi per request
+NGINX_MIN_WORKER_CONNECTIONS = 2048
+NGINX_MAIN_CONF = "/etc/nginx/nginx.conf"
+
+# Responses nginx compresses on the fly, besides HTML: the JSON of the API and
+# the text files it does not find precompressed. Smaller ones are not worth it.
+NGINX_GZIP_TYPES = (
+    "application/json",
+    "application/javascript",
+    "text/javascript",
+    "text/css",
+    "text/plain",
+    "text/xml",
+    "application/xml",
+    "image/svg+xml",
+)
+NGINX_GZIP_MIN_LENGTH = 1024
+
+# brotli_static is only known to nginx with libnginx-mod-http-brotli-static
+NGINX_MODULES_DIR = "/etc/nginx/modules-enabled"
+NGINX_BROTLI_STATIC_MODULE = "ngx_http_brotli_static_module"
+
+# Hashes of the static files compressed by kolibri_server_precompress.py
+PRECOMPRESS_MANIFEST = os.path.join(KOLIBRI_HOME, "precompress_manifest.json")
+
+# Files are sent by the kernel straight from the page cache, and their
+# descriptors are kept open for the next requests.
+NGINX_FILE_DIRECTIVES = (
+    "  sendfile on;\n"
+    "  sendfile_max_chunk 1m;\n"
+    "  tcp_nopush on;\n"
+    "  open_file_cache max=10000 inactive=5m;\n"
+    "  open_file_cache_valid 1m;\n"
+    "  open_file_cache_min_uses 2;\n\n"
+)
+
+# Files embedded in zip content are copied here by the hashi uwsgi workers
+# and sent by nginx from the internal location below.
+ZIPCONTENT_CACHE_DIR = "/var/cache/kolibri-server/zipcontent"
+ZIPCONTENT_CACHE_URL = "/kolibri_server_zipcontent/"
+
+# Estimated memory in MB used by a worker of each uwsgi instance, and fraction
+# of the server memory the workers of each instance can use together. Kolibri
+# workers mostly wait on the database, so they can outnumber the cores.
+UWSGI_WORKER_MEMORY = {"main": 200, "hashi": 120, "long": 200}
+UWSGI_MEMORY_SHARE = {"main": 0.5, "hashi": 0.15, "long": 0.1}
+UWSGI_WORKERS_PER_CORE = {"main": 4, "hashi": 2, "long": 1}
+UWSGI_MAX_WORKERS = 64
+
+# Debian ships the busyness cheaper algorithm as a plugin of uwsgi-core. Its
+# options are rejected by uwsgi when it is not loaded.
+UWSGI_PLUGINS_DIR = "/usr/lib/uwsgi/plugins"
+
+# Workers are recycled after these, from /etc/kolibri/dist/*uwsgi.ini, and the
+# first uwsgi version that can stagger the recycling of its workers
+UWSGI_MAX_REQUESTS = 1000
+UWSGI_MAX_WORKER_LIFETIME = 3600
+UWSGI_STAGGERING_VERSION = (2, 0, 20)
+
+# When kolibri-server runs as the native systemd units of SYSTEMD_TARGET,
+# systemd listens on the sockets of the uwsgi instances in SYSTEMD_SOCKET_DIR,
+# with a listen queue as long as net.core.somaxconn allows, and passes them to
+# the uwsgi instances it starts, which log to their own files.
+# kolibri-server-setup.service sets KOLIBRI_SERVER_SOCKET_DIR; otherwise, as
+# when the package is upgraded, the target tells whether it is running
+SYSTEMD_TARGET = "kolibri-server-native.target"
+SYSTEMD_SOCKET_DIR = "/run/kolibri-server"
+SYSTEMD_SOCKET = "{}_uwsgi.sock"
+UWSGI_DIST_CONF = {
+    "hashi": "/etc/kolibri/dist/hashi_uwsgi.ini",
+    "long": "/etc/kolibri/dist/long_uwsgi.ini",
+}
+UWSGI_MAIN_DIST_CONF = "/etc/kolibri/dist/uwsgi.ini"
+
+# Written by the uwsgi workers serving Kolibri, see kolibri_server_slowlog.py.
+# The init script tells where stacks are dumped.
+SLOW_REQUEST_LOG = os.path.join(KOLIBRI_HOME, "logs", "kolibri_server_slow_requests.log")
+STACK_DUMP_FILE = os.path.join(KOLIBRI_HOME, "logs", "kolibri_server_stacks.log")
+
+
+def read_server_options(options_file=SERVER_OPTIONS_FILE):
+    """
+    Reads kolibri-server options, using the default value of any option
+    missing from the file or holding an invalid value
+    """
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    try:
+        parser.read(options_file)
+    except configparser.Error as e:
+        logger.warning("Ignoring {}: {}".format(options_file, e))
+
+    options = {}
+    for section, defaults in SERVER_OPTION_DEFAULTS.items():
+        options[section] = {}
+        for key, default in defaults.items():
+            if isinstance(default, bool):
+                getter = parser.getboolean
+            elif isinstance(default, int):
+                getter = parser.getint
+            elif isinstance(default, float):
+                getter = parser.getfloat
+            else:
+                getter = parser.get
+            try:
+                options[section][key] = getter(section, key, fallback=default)
+            except ValueError:
+                logger.warning(
+                    "Invalid value for {} in [{}] of {}, using {}".format(key, section, options_file, default)
+                )
+                options[section][key] = default
+    return options
+
+
+server_options = read_server_options()
+
+
+def get_systemd_socket_dir():
+    """
+    Returns the directory of the sockets systemd listens on for the uwsgi
+    instances, or "" when kolibri-server does not run as native systemd units
+    """
+    if "KOLIBRI_SERVER_SOCKET_DIR" in os.environ:
+        return os.environ["KOLIBRI_SERVER_SOCKET_DIR"]
+    try:
+        running = subprocess.call(["systemctl", "is-active", "--quiet", SYSTEMD_TARGET], stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        # not run by systemd
+        running = False
+    return SYSTEMD_SOCKET_DIR if running else ""
+
+
+systemd_socket_dir = get_systemd_socket_dir()
+
 
 def start_debconf_dialog():
     """
@@ -70,25 +413,444 @@ def set_zip_content_port(port):
     update_options_file("Deployment", "ZIP_CONTENT_PORT", port)
 
 
-def delete_redis_cache():
+def get_redis_client(db, location=None, timeout=None):
+    """
+    Returns a client of the Redis server used by Kolibri, connected to
+    database db the same way Kolibri's cache is, or at another location
+    """
+    kwargs = parse_connection_kwargs(
+        location or OPTIONS["Cache"]["CACHE_LOCATION"],
+        db=db,
+        password=OPTIONS["Cache"]["CACHE_PASSWORD"] or None,
+    )
+    if timeout is not None:
+        kwargs.update(socket_timeout=timeout, socket_connect_timeout=timeout)
+    return redis.Redis(**kwargs)
+
+
+def is_redis_socket(location):
+    return location.startswith(("unix://", "/"))
+
+
+def is_redis_local(location):
+    """
+    Returns whether a TCP location of Redis, such as localhost:6379 or
+    redis://:password@127.0.0.1:6379/0, is on this server
+    """
+    if "://" not in location:
+        location = "redis://" + location
+    try:
+        return urlsplit(location).hostname in REDIS_LOCAL_HOSTS
+    except ValueError:
+        return False
+
+
+def get_redis_tcp_location():
+    """
+    Returns the TCP location of Redis: the one Kolibri uses, or the one it
+    used before being moved to the unix socket
+    """
+    location = OPTIONS["Cache"]["CACHE_LOCATION"]
+    if not is_redis_socket(location):
+        return location
+    try:
+        with open(REDIS_CONNECTION_FILE) as connection_file:
+            return json.load(connection_file)["tcp_location"]
+    except (OSError, ValueError, KeyError):
+        return REDIS_TCP_LOCATION
+
+
+def get_redis_sockets(client):
+    """
+    Returns the unix sockets this user can connect to, starting with the one
+    Kolibri uses and the one Redis says it listens on
+    """
+    sockets = []
+    location = OPTIONS["Cache"]["CACHE_LOCATION"]
+    if is_redis_socket(location):
+        sockets.append(location.split("://", 1)[-1].split("?", 1)[0])
+    try:
+        sockets.append(client.config_get("unixsocket").get("unixsocket"))
+    except redis.RedisError:
+        # CONFIG may be renamed or disabled
+        pass
+    sockets += REDIS_SOCKETS
+    return [
+        path
+        for i, path in enumerate(sockets)
+        if path and path not in sockets[:i] and os.access(path, os.R_OK | os.W_OK)
+    ]
+
+
+def measure_redis_latency(client, count=REDIS_PING_COUNT):
+    """
+    Returns the median time in seconds of a PING round trip to Redis
+    """
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        client.ping()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def get_redis_pool_size(client):
+    """
+    Returns the size of the connection pool of every Kolibri process, small
+    enough for the largest number of uwsgi workers to stay under the
+    connection limit of Redis
+    """
+    try:
+        max_clients = int(client.config_get("maxclients").get("maxclients", 10000))
+    except (redis.RedisError, ValueError):
+        max_clients = 10000
+    return max(2, min(server_options["Redis"]["POOL_SIZE"], max_clients // (2 * UWSGI_MAX_WORKERS)))
+
+
+def get_redis_connection():
+    """
+    Returns the location Kolibri should connect to Redis at, and its TCP
+    location: its unix socket when this server runs Redis with one and it
+    answers faster than TCP, TCP otherwise
+    """
+    tcp_location = get_redis_tcp_location()
+    location = tcp_location
+    tcp_client = get_redis_client(redis_db, tcp_location, REDIS_PROBE_TIMEOUT)
+    try:
+        tcp_latency = measure_redis_latency(tcp_client)
+        run_id = tcp_client.info(section="server")["run_id"]
+    except redis.RedisError as e:
+        logger.info("Could not connect to redis at {}: {}".format(tcp_location, e))
+        tcp_latency = run_id = None
+
+    if server_options["Redis"]["UNIX_SOCKET"] and is_redis_local(tcp_location):
+        # Kolibri is given plain paths, as the password of unix:// locations
+        # is only read from them
+        for path in get_redis_sockets(tcp_client):
+            socket_client = get_redis_client(redis_db, path, REDIS_PROBE_TIMEOUT)
+            try:
+                socket_latency = measure_redis_latency(socket_client)
+                # the socket must lead to the same Redis server
+                if run_id is not None and socket_client.info(section="server")["run_id"] != run_id:
+                    continue
+            except redis.RedisError as e:
+                logger.info("Could not connect to redis at {}: {}".format(path, e))
+                continue
+            logger.info(
+                "Redis PING takes {:.0f} us over {} and {} over TCP".format(
+                    socket_latency * 1000000,
+                    path,
+                    "{:.0f} us".format(tcp_latency * 1000000) if tcp_latency is not None else "fails",
+                )
+            )
+            if tcp_latency is None or socket_latency <= tcp_latency:
+                location = path
+            break
+    return location, tcp_location
+
+
+def save_redis_connection(location, tcp_location):
+    """
+    Connects Kolibri to Redis at location, and bounds the connection pool of
+    every Kolibri process
+    """
+    logger.info("Kolibri connects to redis at {}".format(location))
+    update_options_file("Cache", "CACHE_LOCATION", location)
+    # so the clients created from now on use it too
+    OPTIONS["Cache"]["CACHE_LOCATION"] = location
+    pool_size = get_redis_pool_size(get_redis_client(redis_db, timeout=REDIS_PROBE_TIMEOUT))
+    update_options_file("Cache", "CACHE_REDIS_MAX_POOL_SIZE", pool_size)
+    try:
+        with open(REDIS_CONNECTION_FILE, "w") as connection_file:
+            json.dump({"tcp_location": tcp_location}, connection_file)
+    except OSError as e:
+        logger.warning("Could not save {}: {}".format(REDIS_CONNECTION_FILE, e))
+
+
+def delete_redis_keys(client, pattern):
+    """
+    Deletes the keys of a database matching a pattern, and returns their number.
+    Every batch of keys found is unlinked in the same round trip as the scan
+    for the next one.
+    """
+    if not any(character in pattern for character in "*?["):
+        return client.unlink(pattern)
+    deleted = 0
+    cursor, keys = client.scan(0, match=pattern, count=REDIS_SCAN_COUNT)
+    while keys or cursor:
+        pipe = client.pipeline(transaction=False)
+        if keys:
+            pipe.unlink(*keys)
+        if cursor:
+            pipe.scan(cursor, match=pattern, count=REDIS_SCAN_COUNT)
+        results = pipe.execute()
+        if keys:
+            deleted += results.pop(0)
+        cursor, keys = results[0] if cursor else (0, [])
+    return deleted
+
+
+def delete_redis_cache(patterns=REDIS_PURGE_PATTERNS):
     """
     Delete previous cache in redis to reset it when the service starts.
     The purpose is avoiding redis memory usage growing infinitely.
+    All patterns are deleted concurrently, and this returns once they are
+    all deleted, so uwsgi never starts with a partially deleted cache.
+    Returns the number of keys deleted, or None if any pattern failed.
     """
-    redis_args = [
-        (str(redis_db), ":1:views.decorators.*"),
-        (str(redis_db), ":1:CHANNEL_STATS_CACHED_KEYS*"),
-        (str(redis_db), ":1:*_dataset"),
-        (str(redis_db), ":1:content_cache_key"),
-        (str(redis_db), ":1:device_settings_cache_key"),
-        (str(redis_db + 1), "built_files:1:*"),
-    ]
+    start = time.time()
+    clients = {}
+    for db_offset, _ in patterns:
+        if db_offset not in clients:
+            clients[db_offset] = get_redis_client(redis_db + db_offset)
+
+    def delete(db_offset, pattern):
+        try:
+            deleted = delete_redis_keys(clients[db_offset], pattern)
+        except redis.RedisError as e:
+            logger.warning("Could not delete {} from redis database {}: {}".format(pattern, redis_db + db_offset, e))
+            return None
+        logger.info("Deleted {} keys matching {} from redis database {}".format(deleted, pattern, redis_db + db_offset))
+        return deleted
+
+    with ThreadPoolExecutor(max_workers=min(len(patterns), REDIS_PURGE_THREADS)) as executor:
+        results = list(executor.map(lambda args: delete(*args), patterns))
+    deleted = sum(result for result in results if result is not None)
+    logger.info("Deleted {} keys from redis in {:.2f}s".format(deleted, time.time() - start))
+    if None in results:
+        return None
+    return deleted
 
-    for arg in redis_args:
-        search = ["redis-cli", "-n", arg[0], "--scan", "--pattern", arg[1]]
-        delete = ["xargs", "--no-run-if-empty", "redis-cli", "-n", arg[0], "unlink"]
-        exe_search = subprocess.Popen(search, stdout=subprocess.PIPE)
-        subprocess.Popen(delete, stdin=exe_search.stdout)
+
+def get_cache_fingerprint():
+    """
+    Returns what Kolibri's cache depends on: the Kolibri version, the content
+    cache key Kolibri updates whenever channels are imported, updated or
+    deleted, the version of every channel and the device settings. Values that
+    can not be read from the database are None.
+    """
+    fingerprint = {
+        "kolibri_version": kolibri.__version__,
+        "content_cache_key": None,
+        "channels": None,
+        "device_settings": None,
+    }
+    if OPTIONS["Database"]["DATABASE_ENGINE"] != "sqlite":
+        return fingerprint
+    database = os.path.join(KOLIBRI_HOME, OPTIONS["Database"]["DATABASE_NAME"] or "db.sqlite3")
+    try:
+        connection = sqlite3.connect("file:{}?mode=ro".format(database), uri=True, timeout=10)
+    except sqlite3.Error as e:
+        logger.warning("Could not read {}: {}".format(database, e))
+        return fingerprint
+    queries = (
+        ("content_cache_key", "SELECT key FROM device_contentcachekey"),
+        ("channels", "SELECT id, version, last_updated FROM content_channelmetadata"),
+        ("device_settings", "SELECT * FROM device_devicesettings"),
+    )
+    try:
+        for name, query in queries:
+            try:
+                rows = connection.execute(query).fetchall()
+            except sqlite3.Error as e:
+                logger.warning("Could not read {} from {}: {}".format(name, database, e))
+                continue
+            if name == "channels":
+                fingerprint[name] = {row[0]: "{}:{}".format(row[1], row[2]) for row in rows}
+            else:
+                fingerprint[name] = hashlib.sha1(repr(rows).encode("utf-8")).hexdigest()
+    finally:
+        connection.close()
+    return fingerprint
+
+
+def get_invalidated_patterns(previous, fingerprint):
+    """
+    Returns the patterns of the keys of Kolibri's cache made stale by the
+    changes between two fingerprints
+    """
+
+    def changed(name):
+        return fingerprint[name] is None or previous.get(name) != fingerprint[name]
+
+    if changed("kolibri_version"):
+        return list(REDIS_PURGE_PATTERNS)
+    patterns = []
+    if changed("content_cache_key") or changed("channels"):
+        patterns += [(0, ":1:views.decorators.*"), (0, ":1:content_cache_key")]
+        if fingerprint["channels"] is None or previous.get("channels") is None:
+            patterns.append((0, ":1:CHANNEL_STATS_CACHED_KEYS*"))
+        else:
+            channels = set(fingerprint["channels"]) | set(previous["channels"])
+            patterns += [
+                (0, ":1:CHANNEL_STATS_CACHED_KEYS_{}".format(channel_id))
+                for channel_id in sorted(channels)
+                if fingerprint["channels"].get(channel_id) != previous["channels"].get(channel_id)
+            ]
+    if changed("device_settings"):
+        patterns += [(0, ":1:views.decorators.*"), (0, ":1:device_settings_cache_key")]
+    # without duplicates, in order
+    return list(dict.fromkeys(patterns))
+
+
+def invalidate_redis_cache():
+    """
+    Deletes the keys of Kolibri's cache made stale by what changed since the
+    last time it was invalidated, keeping the rest of the cache warm
+    """
+    fingerprint = get_cache_fingerprint()
+    try:
+        with open(REDIS_FINGERPRINT_FILE) as fingerprint_file:
+            previous = json.load(fingerprint_file)
+    except (OSError, ValueError):
+        previous = {}
+
+    patterns = get_invalidated_patterns(previous, fingerprint)
+    if not patterns:
+        logger.info("Nothing changed since the redis cache was last invalidated, keeping it")
+        return
+    if delete_redis_cache(patterns) is None:
+        # try again next time
+        return
+    try:
+        with open(REDIS_FINGERPRINT_FILE, "w") as fingerprint_file:
+            json.dump(fingerprint, fingerprint_file)
+    except OSError as e:
+        logger.warning("Could not save {}: {}".format(REDIS_FINGERPRINT_FILE, e))
+
+
+def get_redis_key_kind(key):
+    """
+    Returns the kind of a key of Kolibri's cache, as a pattern
+    """
+    if key.startswith(":1:views.decorators."):
+        return ":1:views.decorators.*"
+    if key.startswith(":1:CHANNEL_STATS_CACHED_KEYS"):
+        return ":1:CHANNEL_STATS_CACHED_KEYS*"
+    if key.endswith("_dataset"):
+        return ":1:*_dataset"
+    if key.startswith("built_files:"):
+        return "built_files:*"
+    return "other"
+
+
+def sample_redis_keys(client):
+    """
+    Returns the estimated number of keys and bytes of each kind of key in a database
+    """
+    pipe = client.pipeline(transaction=False)
+    for _ in range(REDIS_SAMPLE_KEYS):
+        pipe.randomkey()
+    keys = {key.decode("utf-8", "replace") for key in pipe.execute() if key is not None}
+    if not keys:
+        return {}
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command("MEMORY", "USAGE", key)
+    # keys deleted or expired since sampled fail alone
+    sizes = pipe.execute(raise_on_error=False)
+    sampled = [(key, size) for key, size in zip(keys, sizes) if not isinstance(size, redis.RedisError)]
+    if not sampled:
+        return {}
+
+    scale = client.dbsize() / len(sampled)
+    kinds = {}
+    for key, size in sampled:
+        kind = kinds.setdefault(get_redis_key_kind(key), {"keys": 0, "bytes": 0})
+        kind["keys"] += scale
+        kind["bytes"] += (size or 0) * scale
+    return kinds
+
+
+def read_redis_sizing():
+    try:
+        with open(REDIS_SIZING_FILE) as sizing_file:
+            return json.load(sizing_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_redis_sizing(sizing):
+    try:
+        with open(REDIS_SIZING_FILE, "w") as sizing_file:
+            json.dump(sizing, sizing_file)
+    except OSError as e:
+        logger.warning("Could not save {}: {}".format(REDIS_SIZING_FILE, e))
+
+
+def get_redis_maxmemory(info, previous, server_memory):
+    """
+    Returns the maxmemory Redis should use, from its INFO and the counters saved
+    on the previous start: more memory if keys were evicted while the hit rate
+    was under the floor, back towards the default if it is never filled
+    """
+    options = server_options["Redis"]
+    default = round(server_memory * REDIS_DEFAULT_MEMORY_FRACTION)
+    ceiling = max(default, round(server_memory * options["MAX_MEMORY_FRACTION"]))
+    maxmemory = previous.get("maxmemory") or default
+
+    counters = ("keyspace_hits", "keyspace_misses", "evicted_keys")
+    if previous.get("run_id") == info["run_id"]:
+        hits, misses, evicted = (info[counter] - previous.get(counter, 0) for counter in counters)
+    else:
+        # Redis restarted since the previous start
+        hits, misses, evicted = (info[counter] for counter in counters)
+
+    lookups = hits + misses
+    if lookups >= REDIS_MIN_LOOKUPS:
+        hit_rate = hits / lookups
+        logger.info("Redis hit rate {:.1%} over {} lookups, {} keys evicted".format(hit_rate, lookups, evicted))
+        if evicted and hit_rate < options["HIT_RATE_FLOOR"]:
+            maxmemory = min(ceiling, round(maxmemory * REDIS_GROWTH))
+        elif not evicted and info["used_memory_peak"] * REDIS_GROWTH < maxmemory:
+            maxmemory = max(default, round(info["used_memory_peak"] * REDIS_GROWTH))
+    # never below the memory already used
+    return min(ceiling, max(maxmemory, info["used_memory"] + 2000))
+
+
+def get_redis_maxmemory_policy(info):
+    policy = server_options["Redis"]["MAXMEMORY_POLICY"]
+    if policy != "auto":
+        return policy
+    # LFU keeps the content metadata every learner reads over keys read once,
+    # which LRU evicts them for
+    if tuple(int(number) for number in info["redis_version"].split(".")[:2]) >= (4, 0):
+        return "allkeys-lfu"
+    return "allkeys-lru"
+
+
+def size_redis_cache(client):
+    """
+    Returns the maxmemory and policy Redis should use, and logs the memory used
+    by each kind of key
+    """
+    info = client.info()
+    kinds = {}
+    # every database Kolibri's cache uses, such as built_files'
+    for db_offset in sorted({db_offset for db_offset, _ in REDIS_PURGE_PATTERNS}):
+        db_client = client if db_offset == 0 else get_redis_client(redis_db + db_offset)
+        for kind, sample in sample_redis_keys(db_client).items():
+            total = kinds.setdefault(kind, {"keys": 0, "bytes": 0})
+            total["keys"] += sample["keys"]
+            total["bytes"] += sample["bytes"]
+    for kind, sample in sorted(kinds.items()):
+        logger.info(
+            "Redis keys {}: about {} using {} bytes".format(kind, round(sample["keys"]), round(sample["bytes"]))
+        )
+
+    maxmemory = get_redis_maxmemory(info, read_redis_sizing(), psutil.virtual_memory().total)
+    policy = get_redis_maxmemory_policy(info)
+    save_redis_sizing(
+        {
+            "run_id": info["run_id"],
+            "maxmemory": maxmemory,
+            "keyspace_hits": info["keyspace_hits"],
+            "keyspace_misses": info["keyspace_misses"],
+            "evicted_keys": info["evicted_keys"],
+        }
+    )
+    return maxmemory, policy
 
 
 def enable_redis_cache():
@@ -97,22 +859,37 @@ def enable_redis_cache():
     When multiple processes run the server we need to use
     redis to ensure the cache is shared among them.
     It also limits redis memory usage to avoid server problems
-    if the cache grows too much
+    if the cache grows too much, sizing it from how well it did
+    since the previous start
     """
     update_options_file("Cache", "CACHE_BACKEND", "redis")
-    update_options_file("Cache", "CACHE_REDIS_MAXMEMORY_POLICY", "allkeys-lru")
 
-    delete_redis_cache()
+    client = get_redis_client(redis_db)
     server_memory = psutil.virtual_memory().total
-    max_memory = round(server_memory / 10)
-    if hasattr(process_cache, "get_master_client"):
-        helper = RedisSettingsHelper(process_cache.get_master_client())
-        redis_memory = helper.get_used_memory()
-        if max_memory < redis_memory:
-            max_memory = redis_memory + 2000
+    max_memory = round(server_memory * REDIS_DEFAULT_MEMORY_FRACTION)
+    policy = "allkeys-lru"
+    try:
+        recommended_memory, recommended_policy = size_redis_cache(client)
+        logger.info("Recommended redis maxmemory {} with {}".format(recommended_memory, recommended_policy))
+        if server_options["Redis"]["AUTO_SIZE"]:
+            max_memory, policy = recommended_memory, recommended_policy
+        else:
+            max_memory = max(max_memory, client.info(section="memory")["used_memory"] + 2000)
+    except redis.RedisError as e:
+        logger.warning("Could not size redis: {}".format(e))
 
+    if policy in KOLIBRI_MAXMEMORY_POLICIES:
+        update_options_file("Cache", "CACHE_REDIS_MAXMEMORY_POLICY", policy)
+    else:
+        update_options_file("Cache", "CACHE_REDIS_MAXMEMORY_POLICY", "")
+        try:
+            RedisSettingsHelper(client).set_maxmemory_policy(policy)
+        except redis.RedisError as e:
+            logger.warning("Could not set the redis maxmemory policy: {}".format(e))
     update_options_file("Cache", "CACHE_REDIS_MAXMEMORY", max_memory)
 
+    invalidate_redis_cache()
+
 
 def disable_redis_cache():
     """
@@ -122,24 +899,419 @@ def disable_redis_cache():
     update_options_file("Cache", "CACHE_BACKEND", "memory")
 
 
-def check_redis_service():
+def get_redis_problem(client, location):
     """
-    Checks if redis is running in the system
+    Returns why Redis can not be Kolibri's cache, or None if it can: it must
+    answer quickly, and have room for the cache without running the server
+    out of memory
     """
-    status = False
-    args = ["service", "redis", "status"]
     try:
-        subprocess.check_call(args, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError:
-        pass  # redis is not running
-    except FileNotFoundError:
-        pass  # 'service' is not an available command
-    else:
-        status = True
-    return status
+        latency = measure_redis_latency(client)
+        info = client.info()
+    except redis.RedisError as e:
+        return "could not connect to redis at {}: {}".format(location, e)
 
+    max_latency = server_options["Redis"]["MAX_LATENCY_MS"] / 1000
+    if latency > max_latency:
+        return "redis answers PING in {:.1f} ms, more than {:.1f} ms".format(latency * 1000, max_latency * 1000)
 
-def save_nginx_conf_port(port, zip_port, listen_address="0.0.0.0", nginx_conf=None):
+    used_memory = info["used_memory"]
+    server_memory = psutil.virtual_memory()
+    maxmemory = read_redis_sizing().get("maxmemory") or round(server_memory.total * REDIS_DEFAULT_MEMORY_FRACTION)
+    maxmemory = max(maxmemory, used_memory + 2000)
+    if maxmemory - used_memory > server_memory.available:
+        return "redis could grow by {} MB, but only {} MB of memory are available".format(
+            (maxmemory - used_memory) // (1024 * 1024), server_memory.available // (1024 * 1024)
+        )
+    if get_redis_maxmemory_policy(info) == "noeviction" and used_memory >= maxmemory * (1 - REDIS_MIN_HEADROOM):
+        return "redis uses {} of its {} bytes and evicts no keys".format(used_memory, maxmemory)
+
+    logger.info("Redis answers PING in {:.2f} ms and uses {} bytes".format(latency * 1000, used_memory))
+    return None
+
+
+def check_redis_service(location=None):
+    """
+    Checks if redis is running in the system, at location or the one Kolibri
+    uses, and can be Kolibri's cache
+    """
+    location = location or OPTIONS["Cache"]["CACHE_LOCATION"]
+    problem = get_redis_problem(get_redis_client(redis_db, location, REDIS_PROBE_TIMEOUT), location)
+    if problem is not None:
+        logger.warning("Using the memory cache, as {}".format(problem))
+        return False
+    return True
+
+
+def check_zipcontent_cache():
+    """
+    Checks the zip content cache directory, created by the init script,
+    can be written by the hashi uwsgi workers
+    """
+    if os.access(ZIPCONTENT_CACHE_DIR, os.W_OK | os.X_OK):
+        return True
+    logger.warning("{} is not writable, zip content will be served by uwsgi".format(ZIPCONTENT_CACHE_DIR))
+    return False
+
+
+def get_zipcontent_cache_size():
+    """
+    Returns the maximum size of the zip content cache: a fraction of the disk
+    space available to it, which includes the space it already uses
+    """
+    cache_size = ZipContentCache(ZIPCONTENT_CACHE_DIR).get_size()
+    free_space = shutil.disk_usage(ZIPCONTENT_CACHE_DIR).free
+    return round((free_space + cache_size) * server_options["ZipContent"]["CACHE_DISK_FRACTION"])
+
+
+def get_nginx_cache_locations(path_prefix, socket):
+    """
+    Returns the nginx locations that serve cacheable Kolibri endpoints
+    through the uwsgi_cache zone declared in /etc/kolibri/dist/nginx.conf
+    """
+    locations = ""
+    for location, valid in CACHEABLE_LOCATIONS:
+        locations += (
+            "  location {path_prefix}{location} {{\n"
+            "    include uwsgi_params;\n"
+            "    uwsgi_pass {socket};\n"
+            "    uwsgi_cache uwsgi_cache;\n"
+            "    uwsgi_cache_valid 200 {valid};\n"
+            "    add_header X-Cache-Status $upstream_cache_status;\n"
+            "  }}\n\n"
+        ).format(path_prefix=path_prefix, location=location, socket=socket, valid=valid)
+    return locations
+
+
+def get_static_root():
+    """
+    Returns the directory where Kolibri collects its static files
+    """
+    return os.path.join(KOLIBRI_HOME, "static")
+
+
+def get_content_storage_root():
+    """
+    Returns the directory holding the content files of the imported channels
+    """
+    return os.path.join(content_dir, "storage")
+
+
+def has_nginx_module(module):
+    """
+    Returns whether nginx loads module
+    """
+    for path in glob.glob(os.path.join(NGINX_MODULES_DIR, "*.conf")):
+        try:
+            with open(path) as module_file:
+                if module in module_file.read():
+                    return True
+        except OSError:
+            continue
+    return False
+
+
+def get_nginx_compression_directives():
+    """
+    Returns the server directives compressing responses on the fly
+    """
+    options = server_options["Compression"]
+    if not options["GZIP"]:
+        return ""
+    return (
+        "  gzip on;\n"
+        "  gzip_comp_level {level};\n"
+        "  gzip_min_length {min_length};\n"
+        "  gzip_proxied any;\n"
+        "  gzip_vary on;\n"
+        "  gzip_types {types};\n\n"
+    ).format(
+        level=min(9, max(1, options["GZIP_LEVEL"])),
+        min_length=NGINX_GZIP_MIN_LENGTH,
+        types=" ".join(NGINX_GZIP_TYPES),
+    )
+
+
+def get_nginx_precompressed_directives():
+    """
+    Returns the location directives sending the .gz and .br siblings of
+    files written by kolibri_server_precompress.py, when the client accepts them
+    """
+    if not server_options["Compression"]["PRECOMPRESS"]:
+        return ""
+    directives = "    gzip_static on;\n    gzip_vary on;\n"
+    if has_nginx_module(NGINX_BROTLI_STATIC_MODULE):
+        directives += "    brotli_static on;\n"
+    return directives
+
+
+def get_nginx_static_locations(path_prefix):
+    """
+    Returns the nginx locations that serve Kolibri static files and content
+    storage directly from disk. Files nginx can not find or read, such as the
+    ones living in CONTENT_FALLBACK_DIRS, are still served by uwsgi.
+    """
+    return (
+        "  location {path_prefix}static/ {{\n"
+        "    alias {static_root}/;\n"
+        "    expires 2m;\n"
+        "{precompressed}"
+        '    location ~ "{immutable}" {{\n'
+        "      expires off;\n"
+        '      add_header Cache-Control "public, max-age=31536000, immutable";\n'
+        "    }}\n"
+        "    error_page 403 404 = @kolibri_uwsgi;\n"
+        "  }}\n\n"
+        "  location {path_prefix}content/storage/ {{\n"
+        "    alias {storage_root}/;\n"
+        '    add_header Cache-Control "public, max-age=31536000, immutable";\n'
+        "    error_page 403 404 = @kolibri_uwsgi;\n"
+        "  }}\n\n"
+    ).format(
+        path_prefix=path_prefix,
+        static_root=get_static_root(),
+        storage_root=get_content_storage_root(),
+        immutable=IMMUTABLE_FILE_REGEX,
+        precompressed=get_nginx_precompressed_directives(),
+    )
+
+
+def get_nginx_zipcontent_locations():
+    """
+    Returns the internal nginx location the hashi uwsgi workers redirect to
+    with X-Accel-Redirect once they have copied the requested file into the
+    zip content cache. Headers Kolibri adds to zip content responses, other
+    than the ones nginx keeps from the redirecting response, are set here.
+    """
+    return (
+        "  location {cache_url} {{\n"
+        "    internal;\n"
+        "    alias {cache_dir}/;\n"
+        '    add_header Access-Control-Allow-Origin "*";\n'
+        '    add_header Access-Control-Allow-Methods "GET, OPTIONS";\n'
+        "    add_header Content-Security-Policy \"default-src 'self' 'unsafe-inline' 'unsafe-eval' data: blob:\";\n"
+        "  }}\n\n"
+    ).format(cache_url=ZIPCONTENT_CACHE_URL, cache_dir=ZIPCONTENT_CACHE_DIR)
+
+
+def get_long_request_paths():
+    """
+    Returns the paths below the URL path prefix served by the long uwsgi
+    instance, LONG_REQUEST_PATHS included
+    """
+    paths = list(LONG_REQUEST_LOCATIONS)
+    for path in server_options["uWSGI"]["LONG_REQUEST_PATHS"].split(","):
+        path = path.strip().lstrip("/")
+        if path and path not in paths:
+            paths.append(path)
+    return paths
+
+
+def get_nginx_long_locations(path_prefix):
+    """
+    Returns the nginx locations that send the requests known to run for
+    minutes to the long uwsgi instance, waiting as long as its harakiri
+    """
+    locations = ""
+    for location in get_long_request_paths():
+        locations += (
+            "  location {path_prefix}{location} {{\n"
+            "    include uwsgi_params;\n"
+            "    uwsgi_pass {socket};\n"
+            "    uwsgi_read_timeout {timeout}s;\n"
+            "  }}\n\n"
+        ).format(
+            path_prefix=path_prefix,
+            location=location,
+            socket="unix:{}".format(get_uwsgi_socket("long")),
+            timeout=server_options["uWSGI"]["LONG_HARAKIRI"] + NGINX_READ_TIMEOUT_MARGIN,
+        )
+    return locations
+
+
+def get_uwsgi_instances():
+    """
+    Returns the main uwsgi instances serving Kolibri, INSTANCES of them, by
+    the name of the section of uwsgi.ini each one loads. There are no more
+    than can share the workers the memory of this server allows two by two.
+    """
+    cores = psutil.cpu_count() or 1
+    memory = psutil.virtual_memory().total // (1024 * 1024)
+    max_workers = get_uwsgi_max_workers("main", cores, memory, server_options["uWSGI"]["WORKERS"])
+    instances = max(1, min(server_options["uWSGI"]["INSTANCES"], UWSGI_MAX_INSTANCES, max_workers // 2))
+    return ["main"] + ["main{}".format(number) for number in range(2, instances + 1)]
+
+
+def get_uwsgi_socket(instance):
+    if systemd_socket_dir:
+        return os.path.join(systemd_socket_dir, SYSTEMD_SOCKET.format(instance))
+    if instance == "main":
+        return UWSGI_SOCKET
+    return UWSGI_INSTANCE_SOCKET.format(instance)
+
+
+def get_uwsgi_stats_sockets():
+    """
+    Returns the stats socket of every uwsgi instance run, by instance
+    """
+    stats_sockets = {}
+    for instance in get_uwsgi_instances():
+        if instance == "main":
+            stats_sockets[instance] = UWSGI_STATS_SOCKETS["main"]
+        else:
+            stats_sockets[instance] = UWSGI_INSTANCE_STATS_SOCKET.format(instance)
+    stats_sockets["hashi"] = UWSGI_STATS_SOCKETS["hashi"]
+    if server_options["uWSGI"]["LONG_REQUESTS"]:
+        stats_sockets["long"] = UWSGI_STATS_SOCKETS["long"]
+    return stats_sockets
+
+
+def get_nginx_upstream():
+    """
+    Returns the nginx upstream balancing requests between the main uwsgi
+    instances, to the one with the fewest requests running. An instance
+    refusing connections, while it restarts, is skipped for the others.
+    uwsgi closes its connection after every response, so there are no
+    connections for nginx to keep alive.
+    """
+    servers = ""
+    for instance in get_uwsgi_instances():
+        servers += "  server unix:{} max_fails={} fail_timeout={}s;\n".format(
+            get_uwsgi_socket(instance), NGINX_UPSTREAM_MAX_FAILS, NGINX_UPSTREAM_FAIL_TIMEOUT
+        )
+    return "upstream {} {{\n  least_conn;\n{}}}\n\n".format(NGINX_UPSTREAM, servers)
+
+
+def get_nginx_status_location(listen_address):
+    """
+    Returns the nginx location of the stub_status page read by the metrics
+    exporter, only open to this server
+    """
+    allowed = ["127.0.0.1", "::1"]
+    if listen_address != "0.0.0.0":
+        allowed.append(listen_address)
+    return (
+        "  location = {status_path} {{\n    stub_status;\n    access_log off;\n{allow}    deny all;\n  }}\n\n"
+    ).format(
+        status_path=NGINX_STATUS_PATH,
+        allow="".join("    allow {};\n".format(address) for address in allowed),
+    )
+
+
+def get_nginx_version():
+    """
+    Returns the version of nginx as a tuple of integers, or None if it is unknown
+    """
+    nginx = shutil.which("nginx") or "/usr/sbin/nginx"
+    try:
+        # printed on stderr
+        output = subprocess.check_output([nginx, "-v"], stderr=subprocess.STDOUT, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"nginx/(\d+)\.(\d+)\.(\d+)", output)
+    if match is None:
+        return None
+    return tuple(int(number) for number in match.groups())
+
+
+def check_nginx_worker_connections(nginx_conf=NGINX_MAIN_CONF):
+    """
+    Warns when the worker_connections of nginx, set in its main configuration
+    kolibri-server does not write, are too few for a classroom
+    """
+    try:
+        with open(nginx_conf) as nginx_conf_file:
+            match = re.search(r"^\s*worker_connections\s+(\d+)\s*;", nginx_conf_file.read(), re.MULTILINE)
+    except OSError:
+        return
+    # 512 when not set
+    worker_connections = int(match.group(1)) if match else 512
+    if worker_connections < NGINX_MIN_WORKER_CONNECTIONS:
+        logger.warning(
+            "nginx accepts {} connections per worker, set worker_connections to {} in {} for many clients".format(
+                worker_connections, NGINX_MIN_WORKER_CONNECTIONS, nginx_conf
+            )
+        )
+
+
+def get_nginx_tls():
+    """
+    Returns the certificate and key nginx serves Kolibri with over TLS, or
+    None when they are not both set and found
+    """
+    options = server_options["Nginx"]
+    certificate, key = options["SSL_CERTIFICATE"], options["SSL_CERTIFICATE_KEY"]
+    if not certificate and not key:
+        return None
+    if not (certificate and key and os.path.exists(certificate) and os.path.exists(key)):
+        logger.warning("Serving Kolibri without TLS, as its certificate or key is missing")
+        return None
+    return certificate, key
+
+
+def get_nginx_scheme():
+    """
+    Returns the scheme of the URLs of Kolibri served by nginx
+    """
+    return "https" if get_nginx_tls() is not None else "http"
+
+
+def get_nginx_listen(address_port, tls=None, nginx_version=None):
+    """
+    Returns the listen directive of a server, on a socket of its own in
+    every nginx worker, with the TLS and HTTP/2 directives when tls is set
+    """
+    options = server_options["Nginx"]
+    parameters = ""
+    directives = ""
+    if tls is not None:
+        parameters += " ssl"
+        if options["HTTP2"]:
+            # browsers only speak HTTP/2 over TLS
+            if nginx_version is not None and nginx_version >= NGINX_HTTP2_DIRECTIVE_VERSION:
+                directives += "  http2 on;\n"
+            else:
+                parameters += " http2"
+        directives += (
+            "  ssl_certificate {};\n"
+            "  ssl_certificate_key {};\n"
+            "  ssl_session_cache shared:kolibri_ssl:10m;\n"
+            "  ssl_session_timeout 1d;\n"
+        ).format(tls[0], tls[1])
+    if options["REUSEPORT"]:
+        parameters += " reuseport"
+    return "  listen {}{};\n{}".format(address_port, parameters, directives)
+
+
+def get_nginx_transport_directives(instance):
+    """
+    Returns the server directives keeping client connections open for the
+    many small requests of every page, and reading the responses of a uwsgi
+    instance in memory with buffers as large as its own
+    """
+    options = server_options["Nginx"]
+    buffer_size = UWSGI_BUFFER_SIZE[instance] // 1024
+    buffers = max(4, options["UWSGI_BUFFERS"])
+    return (
+        "  keepalive_timeout {keepalive_timeout}s;\n"
+        "  keepalive_requests {keepalive_requests};\n"
+        "  reset_timedout_connection on;\n"
+        "  uwsgi_buffering on;\n"
+        "  uwsgi_buffer_size {buffer_size}k;\n"
+        "  uwsgi_buffers {buffers} {buffer_size}k;\n"
+        "  uwsgi_busy_buffers_size {busy_buffers_size}k;\n\n"
+    ).format(
+        keepalive_timeout=max(0, options["KEEPALIVE_TIMEOUT"]),
+        keepalive_requests=max(1, options["KEEPALIVE_REQUESTS"]),
+        buffer_size=buffer_size,
+        buffers=buffers,
+        busy_buffers_size=buffer_size * 2,
+    )
+
+
+def save_nginx_conf_port(
+    port, zip_port, listen_address="0.0.0.0", nginx_conf=None, zipcontent_offload=False, long_requests=False
+):
     """
     Adds the port for nginx to run to an existing config file.
     """
@@ -147,6 +1319,8 @@ def save_nginx_conf_port(port, zip_port, listen_address="0.0.0.0", nginx_conf=No
     if nginx_conf is None:
         nginx_conf = os.path.join(KOLIBRI_HOME, "nginx.conf")
 
+    socket = NGINX_UPSTREAM
+
     if listen_address != "0.0.0.0":
         address_port = "{}:{}".format(listen_address, port)
         address_zip_port = "{}:{}".format(listen_address, zip_port)
@@ -154,6 +1328,8 @@ def save_nginx_conf_port(port, zip_port, listen_address="0.0.0.0", nginx_conf=No
         address_port = port
         address_zip_port = zip_port
 
+    tls = get_nginx_tls()
+    nginx_version = get_nginx_version() if tls is not None else None
     configuration = (
         "# This file is maintained AUTOMATICALLY and will be overwritten\n"
         "#\n"
@@ -161,38 +1337,343 @@ def save_nginx_conf_port(port, zip_port, listen_address="0.0.0.0", nginx_conf=No
         "package,\n"
         "# please write custom configurations in /etc/kolibri/nginx.d/\n"
         "\n"
+        "{upstream}"
         "server{{\n"
-        "  listen {port};\n"
+        "{listen}"
+        "{transport_directives}"
+        # Only used by the locations that enable uwsgi_cache. Requests from
+        # logged in users are neither answered from nor stored in the cache,
+        # concurrent misses for the same key wait for a single response, and
+        # stale entries are served while they are being refreshed. Kolibri
+        # answers in the language of the Accept-Language header, normalised
+        # to $lang by the map of /etc/kolibri/dist/nginx.conf, so every
+        # language is cached under a key of its own.
+        "  uwsgi_cache_key $scheme$request_method$host$request_uri$lang;\n"
+        "  uwsgi_cache_bypass $cookie_kolibri $http_authorization;\n"
+        "  uwsgi_no_cache $cookie_kolibri $http_authorization;\n"
+        "  uwsgi_cache_lock on;\n"
+        "  uwsgi_cache_lock_timeout 10s;\n"
+        "  uwsgi_cache_use_stale updating error timeout http_500 http_503;\n"
+        "  uwsgi_cache_background_update on;\n"
+        "  uwsgi_cache_revalidate on;\n"
+        "  uwsgi_read_timeout {read_timeout}s;\n"
+        "  uwsgi_next_upstream_timeout {retry_timeout}s;\n\n"
+        "{file_directives}"
+        "{compression_directives}"
         "  location {path_prefix}favicon.ico {{\n"
         "    empty_gif;\n"
         "  }}\n\n"
+        "{status_location}"
+        "{cache_locations}"
+        "{static_locations}"
+        "{long_locations}"
         "  location {path_prefix} {{\n"
         "    include uwsgi_params;\n"
-        "    uwsgi_pass unix:///tmp/kolibri_uwsgi.sock;\n"
+        "    uwsgi_pass {socket};\n"
         "    proxy_ignore_headers Vary;\n"
         "  }}\n\n"
+        "  location @kolibri_uwsgi {{\n"
+        "    include uwsgi_params;\n"
+        "    uwsgi_pass {socket};\n"
+        "  }}\n\n"
         "  error_page 502 = @error502;\n"
         "  location @error502 {{\n"
         "    ssi on;\n"
         "    internal;\n"
         "    root /usr/share/kolibri/error_pages;\n"
+        "{precompressed}"
         "    rewrite ^(.*)$ $error502 break;\n"
         "  }}\n"
         "}}\n"
         "\n"
         "server{{\n"
-        "  listen {zip_port};\n"
+        "{zip_listen}"
+        "{zip_transport_directives}"
+        "  uwsgi_read_timeout {zip_read_timeout}s;\n\n"
+        "{file_directives}"
+        "{compression_directives}"
+        "{zipcontent_locations}"
         "  location {path_prefix} {{\n"
         "    include uwsgi_params;\n"
-        "    uwsgi_pass unix:///tmp/kolibri_hashi_uwsgi.sock;\n"
+        "    uwsgi_pass unix:{zip_socket};\n"
         "  }}\n"
         "}}\n"
-    ).format(port=address_port, path_prefix=path_prefix, zip_port=address_zip_port)
+    ).format(
+        listen=get_nginx_listen(address_port, tls, nginx_version),
+        zip_listen=get_nginx_listen(address_zip_port, tls, nginx_version),
+        transport_directives=get_nginx_transport_directives("main"),
+        zip_transport_directives=get_nginx_transport_directives("hashi"),
+        path_prefix=path_prefix,
+        upstream=get_nginx_upstream(),
+        socket=socket,
+        zip_socket=get_uwsgi_socket("hashi"),
+        status_location=get_nginx_status_location(listen_address),
+        cache_locations=get_nginx_cache_locations(path_prefix, socket),
+        static_locations=get_nginx_static_locations(path_prefix),
+        long_locations=get_nginx_long_locations(path_prefix) if long_requests else "",
+        read_timeout=server_options["uWSGI"]["HARAKIRI"] + NGINX_READ_TIMEOUT_MARGIN,
+        retry_timeout=NGINX_UPSTREAM_RETRY_TIMEOUT,
+        zip_read_timeout=server_options["uWSGI"]["HASHI_HARAKIRI"] + NGINX_READ_TIMEOUT_MARGIN,
+        file_directives=NGINX_FILE_DIRECTIVES,
+        compression_directives=get_nginx_compression_directives(),
+        precompressed=get_nginx_precompressed_directives(),
+        zipcontent_locations=get_nginx_zipcontent_locations() if zipcontent_offload else "",
+    )
 
     with open(nginx_conf, "w") as nginx_conf_file:
         nginx_conf_file.write(configuration)
 
 
+def get_somaxconn():
+    """
+    Returns the largest listen backlog allowed by the kernel: uwsgi refuses
+    to start with a larger one
+    """
+    try:
+        with open("/proc/sys/net/core/somaxconn") as somaxconn_file:
+            return int(somaxconn_file.read())
+    except (OSError, ValueError):
+        return 128
+
+
+def get_uwsgi_max_workers(instance, cores, memory, workers=0):
+    """
+    Returns the maximum number of workers of a uwsgi instance on a server with
+    this number of cores and MB of memory, or workers when not 0
+    """
+    if workers:
+        return workers
+    by_memory = int(memory * UWSGI_MEMORY_SHARE[instance] // UWSGI_WORKER_MEMORY[instance])
+    return min(cores * UWSGI_WORKERS_PER_CORE[instance], by_memory, UWSGI_MAX_WORKERS)
+
+
+def get_uwsgi_sizing(instance, cores, memory, workers=0, instances=1):
+    """
+    Returns the worker options of a uwsgi instance sized for a server with
+    this number of cores and MB of memory. workers, when not 0, overrides the
+    computed maximum number of workers. When several instances run alike,
+    they share the workers and memory of one, see get_uwsgi_instances.
+    """
+    share = memory * UWSGI_MEMORY_SHARE[instance] / instances
+    workers = max(2, get_uwsgi_max_workers(instance, cores, memory, workers) // instances)
+    cheaper = max(1, min(cores, workers // 4, workers - 1))
+    reload_on_rss = max(UWSGI_WORKER_MEMORY[instance] * 2, min(2048, int(share // workers)))
+    return [
+        ("workers", workers),
+        ("cheaper", cheaper),
+        ("cheaper-initial", min(workers, cheaper + 1)),
+        ("reload-on-rss", reload_on_rss),
+        # Python reserves much more address space than it uses
+        ("limit-as", max(1024, reload_on_rss * 4)),
+        # workers are pinned to cores in turn once they outnumber them
+        ("cpu-affinity", max(1, cores // workers)),
+        ("listen", min(get_somaxconn(), max(100, workers * 32))),
+    ]
+
+
+def get_uwsgi_autoscaling(workers):
+    """
+    Returns the cheaper options of the main uwsgi instance. The busyness
+    algorithm spawns several workers at a time as soon as they are busy for
+    more than BUSYNESS_MAX percent of a CHEAPER_OVERLOAD seconds cycle, so a
+    whole class logging in at once does not wait for workers spawned one by
+    one, and stops them once they have been idle for IDLE_TIME seconds.
+    """
+    options = server_options["uWSGI"]
+    step = options["CHEAPER_STEP"] or max(1, workers // 4)
+    overload = max(1, options["CHEAPER_OVERLOAD"])
+    autoscaling = [
+        ("cheaper-step", step),
+        ("cheaper-overload", overload),
+    ]
+    if options["CHEAPER_ALGO"] != "busyness":
+        return [("cheaper-algo", options["CHEAPER_ALGO"])] + autoscaling
+    if not os.path.exists(os.path.join(UWSGI_PLUGINS_DIR, "cheaper_busyness_plugin.so")):
+        logger.warning("The cheaper_busyness uwsgi plugin is not installed, using the spare algorithm")
+        return [("cheaper-algo", "spare")] + autoscaling
+
+    return (
+        [
+            ("plugin", "cheaper_busyness"),
+            ("cheaper-algo", "busyness"),
+        ]
+        + autoscaling
+        + [
+            ("cheaper-busyness-min", options["BUSYNESS_MIN"]),
+            ("cheaper-busyness-max", options["BUSYNESS_MAX"]),
+            ("cheaper-busyness-multiplier", max(1, options["IDLE_TIME"] // overload)),
+            # The listen queue is only measured on TCP sockets by stock
+            # kernels, so these have no effect on the default unix socket
+            ("cheaper-busyness-backlog-alert", options["BACKLOG_ALERT"]),
+            ("cheaper-busyness-backlog-step", step),
+            ("cheaper-busyness-backlog-nonzero", 10),
+        ]
+    )
+
+
+def get_uwsgi_version():
+    """
+    Returns the version of uwsgi as a tuple of integers, or None if it is unknown
+    """
+    try:
+        output = subprocess.check_output(["uwsgi", "--version"], universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.match(r"(\d+)\.(\d+)\.(\d+)", output.strip())
+    if match is None:
+        return None
+    return tuple(int(number) for number in match.groups())
+
+
+def get_uwsgi_recycling(workers):
+    """
+    Returns the options that stagger the recycling of the workers of an
+    instance, so workers started together are not all replaced at once
+    """
+    version = get_uwsgi_version()
+    if version is None or version < UWSGI_STAGGERING_VERSION:
+        return []
+    return [
+        ("max-requests-delta", max(1, UWSGI_MAX_REQUESTS // workers)),
+        ("max-worker-lifetime-delta", max(10, UWSGI_MAX_WORKER_LIFETIME // workers)),
+    ]
+
+
+def get_uwsgi_profiling():
+    """
+    Returns the uwsgi options logging the requests of the main uwsgi instance
+    slower than SLOW_REQUEST_SECONDS, with samples of their stacks
+    """
+    profiling = server_options["Profiling"]
+    if not profiling["SLOW_REQUESTS"] or profiling["SLOW_REQUEST_SECONDS"] <= 0:
+        return []
+    logger.info("Logging requests slower than {}s to {}".format(profiling["SLOW_REQUEST_SECONDS"], SLOW_REQUEST_LOG))
+    return [
+        ("env", "KOLIBRI_SERVER_SLOW_REQUEST_SECONDS={}".format(profiling["SLOW_REQUEST_SECONDS"])),
+        ("env", "KOLIBRI_SERVER_SLOW_REQUEST_INTERVAL={}".format(max(profiling["SAMPLE_INTERVAL_MS"], 1) / 1000)),
+        ("env", "KOLIBRI_SERVER_SLOW_REQUEST_LOG={}".format(SLOW_REQUEST_LOG)),
+        ("env", "KOLIBRI_SERVER_SLOW_REQUEST_LOG_SIZE={}".format(profiling["LOG_SIZE"] * 1024 * 1024)),
+        ("env", "KOLIBRI_SERVER_SLOW_REQUEST_LOG_BACKUPS={}".format(max(profiling["LOG_BACKUPS"], 1))),
+    ]
+
+
+def get_uwsgi_systemd_options(instance):
+    """
+    Returns the options of a uwsgi instance started by systemd, which only
+    loads its section of uwsgi.ini: the configuration of the package, and a
+    log of its own. systemd keeps listening on its socket, which uwsgi must
+    not remove when it stops.
+    """
+    if not systemd_socket_dir:
+        return []
+    log = "uwsgi.log" if instance == "main" else "{}_uwsgi.log".format(instance)
+    return [
+        ("ini", UWSGI_DIST_CONF.get(instance, UWSGI_MAIN_DIST_CONF)),
+        ("vacuum", "false"),
+        ("logto", os.path.join(KOLIBRI_HOME, "logs", log)),
+        ("env", "KOLIBRI_HOME={}".format(KOLIBRI_HOME)),
+    ]
+
+
+def get_uwsgi_options(zipcontent_offload=False, redis_cache=False):
+    """
+    Returns the uwsgi options computed for this server, by uwsgi instance
+    """
+    server_dir = os.path.dirname(os.path.abspath(__file__))
+    cores = psutil.cpu_count() or 1
+    memory = psutil.virtual_memory().total // (1024 * 1024)
+    logger.info("Sizing uwsgi workers for {} cores and {} MB of memory".format(cores, memory))
+
+    instances = get_uwsgi_instances()
+    main_options = get_uwsgi_sizing("main", cores, memory, server_options["uWSGI"]["WORKERS"], len(instances))
+    main_options += get_uwsgi_autoscaling(dict(main_options)["workers"])
+    main_options.append(("pythonpath", server_dir))
+    # which reports how long workers take to be ready in both modes
+    main_options.append(("module", "kolibri_server_wsgi:application"))
+    if server_options["uWSGI"]["WARM_START"]:
+        main_options += [
+            ("lazy-apps", "false"),
+            ("env", "KOLIBRI_SERVER_STACK_DUMP_FILE={}".format(STACK_DUMP_FILE)),
+        ]
+        main_options += get_uwsgi_profiling()
+    else:
+        main_options += [
+            # every worker imports Kolibri itself once forked
+            ("lazy-apps", "true"),
+            ("env", "KOLIBRI_SERVER_WARM_START=false"),
+        ]
+        if server_options["Profiling"]["SLOW_REQUESTS"]:
+            logger.warning("Slow requests are only logged when uwsgi workers are warm started")
+    local_cache_size = server_options["Redis"]["LOCAL_CACHE_SIZE"] * 1024 * 1024
+    if redis_cache and local_cache_size:
+        main_options += [
+            ("env", "DJANGO_SETTINGS_MODULE=kolibri_server_settings"),
+            ("env", "KOLIBRI_SERVER_LOCAL_CACHE_SIZE={}".format(local_cache_size)),
+            ("env", "KOLIBRI_SERVER_LOCAL_CACHE_TTL={}".format(server_options["Redis"]["LOCAL_CACHE_TTL"])),
+        ]
+    if len(instances) < server_options["uWSGI"]["INSTANCES"]:
+        logger.warning(
+            "Running {} uwsgi instances for Kolibri instead of {}: at most {}, with two workers each".format(
+                len(instances), server_options["uWSGI"]["INSTANCES"], UWSGI_MAX_INSTANCES
+            )
+        )
+    elif len(instances) > 1:
+        logger.info("Running {} uwsgi instances for Kolibri".format(len(instances)))
+
+    # every main instance runs alike
+    uwsgi_options = {instance: list(main_options) for instance in instances}
+    uwsgi_options["hashi"] = get_uwsgi_sizing("hashi", cores, memory, server_options["uWSGI"]["HASHI_WORKERS"])
+    if server_options["uWSGI"]["LONG_REQUESTS"]:
+        uwsgi_options["long"] = get_uwsgi_sizing("long", cores, memory, server_options["uWSGI"]["LONG_WORKERS"])
+    harakiri = {
+        "hashi": server_options["uWSGI"]["HASHI_HARAKIRI"],
+        "long": server_options["uWSGI"]["LONG_HARAKIRI"],
+    }
+    stats_sockets = get_uwsgi_stats_sockets()
+    for instance in uwsgi_options:
+        # on a socket of its own
+        uwsgi_options[instance][:0] = get_uwsgi_systemd_options(instance) + [("socket", get_uwsgi_socket(instance))]
+        uwsgi_options[instance] += get_uwsgi_recycling(dict(uwsgi_options[instance])["workers"])
+        # read by the metrics exporter, with the RSS of every worker
+        uwsgi_options[instance] += [("stats", stats_sockets[instance]), ("memory-report", "true")]
+        # the request a worker was killed for is logged
+        instance_harakiri = harakiri.get(instance, server_options["uWSGI"]["HARAKIRI"])
+        uwsgi_options[instance] += [("harakiri", max(1, instance_harakiri)), ("harakiri-verbose", "true")]
+    if zipcontent_offload:
+        uwsgi_options["hashi"] += [
+            ("pythonpath", server_dir),
+            ("module", "kolibri_server_zipcontent:application"),
+            ("env", "KOLIBRI_SERVER_ZIPCONTENT_CACHE={}".format(ZIPCONTENT_CACHE_DIR)),
+            ("env", "KOLIBRI_SERVER_ZIPCONTENT_URL={}".format(ZIPCONTENT_CACHE_URL)),
+            ("env", "KOLIBRI_SERVER_ZIPCONTENT_CACHE_SIZE={}".format(get_zipcontent_cache_size())),
+        ]
+    return uwsgi_options
+
+
+def save_uwsgi_conf(uwsgi_options, uwsgi_conf=None):
+    """
+    Writes the uwsgi options computed for this server. Each uwsgi instance
+    loads its own section of this file after /etc/kolibri/dist/*uwsgi.ini
+    """
+
+    if uwsgi_conf is None:
+        uwsgi_conf = os.path.join(KOLIBRI_HOME, "uwsgi.ini")
+
+    configuration = (
+        "# This file is maintained AUTOMATICALLY and will be overwritten\n"
+        "#\n"
+        "# Do not edit this file. If you are using the kolibri-server package,\n"
+        "# please write custom configurations in /etc/kolibri/kolibri-server.ini\n"
+    )
+    for section, options in uwsgi_options.items():
+        configuration += "\n[{}]\n".format(section)
+        for key, value in options:
+            configuration += "{} = {}\n".format(key, value)
+
+    with open(uwsgi_conf, "w") as uwsgi_conf_file:
+        uwsgi_conf_file.write(configuration)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tool to configure kolibri-server")
     parser.add_argument(
@@ -210,16 +1691,29 @@ if __name__ == "__main__":
         help="Port to run hashi iframes used when installing/reconfiguring kolibri-server package",
     )
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
     if args.debconfport:  # To be executed only when installing/reconfiguring the Debian package
         set_port(args.debconfport)
         if args.debconfzipport:
             set_zip_content_port(args.debconfzipport)
 
     else:
-        if check_redis_service():
+        redis_location, redis_tcp_location = get_redis_connection()
+        redis_cache = check_redis_service(redis_location)
+        if redis_cache:
+            save_redis_connection(redis_location, redis_tcp_location)
             enable_redis_cache()
         else:
             disable_redis_cache()
-        save_nginx_conf_port(port, zip_content_port, listen_address)
+        zipcontent_offload = server_options["ZipContent"]["OFFLOAD"] and check_zipcontent_cache()
+        check_nginx_worker_connections()
+        save_nginx_conf_port(
+            port,
+            zip_content_port,
+            listen_address,
+            zipcontent_offload=zipcontent_offload,
+            long_requests=server_options["uWSGI"]["LONG_REQUESTS"],
+        )
+        save_uwsgi_conf(get_uwsgi_options(zipcontent_offload, redis_cache))
         # Let's update debconf, just in case the user has changed the port in options.ini:
         set_debconf_ports(port, zip_content_port)
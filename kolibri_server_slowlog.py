@@ -0,0 +1,249 @@
+"""
+Slow request log and stack dumps of the uwsgi workers serving Kolibri.
+
+SlowRequestLog wraps the WSGI application: a thread of every worker samples
+the Python stack of the requests running for longer than a threshold, and
+when they end, their method, path, status, duration and most frequent
+stacks are appended as a JSON line to a log rotated by size. A request still
+running at twice, four times... the threshold is logged too, unfinished, so
+the requests killed by harakiri leave a trace.
+
+StackDumper lets a thread of every worker wait for DUMP_SIGNAL, and append
+the stacks of all the threads of the worker to a file when it comes. uwsgi
+signals are only delivered to a worker between two requests, so a Unix
+signal is used instead, which reaches a worker stuck in a request; the uwsgi
+option py-callos-afterfork lets workers handle it.
+
+This module must not depend on Kolibri or Django, to be tested on its own.
+"""
+
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+# Sent to the workers by `service kolibri-server dump-stacks`, and ignored by
+# processes not handling it
+DUMP_SIGNAL = signal.SIGURG
+
+# Deepest stack kept, from the innermost frame
+MAX_STACK_DEPTH = 40
+
+# Number of distinct stacks logged with a slow request, most frequent first
+MAX_STACKS = 5
+
+
+class RotatingLog(object):
+    """
+    Log file appended to by all the workers, rotated to path.1, path.2...
+    when it grows larger than max_size bytes
+    """
+
+    def __init__(self, path, max_size, backups):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+
+    def rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, number)):
+                os.replace("{}.{}".format(self.path, number), "{}.{}".format(self.path, number + 1))
+        os.replace(self.path, "{}.1".format(self.path))
+
+    def write(self, text):
+        while True:
+            with open(self.path, "a") as log_file:
+                # other workers wait for the file to be rotated and written
+                fcntl.flock(log_file, fcntl.LOCK_EX)
+                stat = os.fstat(log_file.fileno())
+                if not os.path.exists(self.path) or not os.path.samestat(stat, os.stat(self.path)):
+                    # rotated by another worker meanwhile
+                    continue
+                if stat.st_size and stat.st_size + len(text) > self.max_size:
+                    self.rotate()
+                    continue
+                log_file.write(text)
+                return
+
+
+def get_stack(frame):
+    """
+    Returns the stack of frame as "file:line function" strings, innermost last
+    """
+    return tuple(
+        "{}:{} {}".format(summary.filename, summary.lineno, summary.name)
+        for summary in traceback.extract_stack(frame, limit=MAX_STACK_DEPTH)
+    )
+
+
+class Request(object):
+    def __init__(self, environ):
+        self.thread_id = threading.get_ident()
+        self.start = time.monotonic()
+        self.method = environ.get("REQUEST_METHOD", "")
+        self.path = environ.get("PATH_INFO", "")
+        self.query = environ.get("QUERY_STRING", "")
+        self.status = None
+        self.stacks = Counter()
+        self.next_report = None
+
+    def get_record(self, duration, finished):
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "pid": os.getpid(),
+            "method": self.method,
+            "path": self.path,
+            "query": self.query,
+            "status": self.status,
+            "seconds": round(duration, 3),
+            "finished": finished,
+            "samples": sum(self.stacks.values()),
+            "stacks": [
+                {"samples": count, "stack": list(stack)} for stack, count in self.stacks.most_common(MAX_STACKS)
+            ],
+        }
+
+
+class ResponseIterable(object):
+    """
+    Response of the application, calling on_close once it is sent
+    """
+
+    def __init__(self, result, on_close):
+        self.result = result
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.on_close()
+
+
+class SlowRequestLog(object):
+    def __init__(self, application, log, threshold, interval):
+        self.application = application
+        self.log = log
+        self.threshold = threshold
+        self.interval = interval
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        request.next_report = request.start + self.threshold * 2
+        with self.lock:
+            self.requests[request.thread_id] = request
+
+        def start_response_status(status, headers, exc_info=None):
+            request.status = int(status.split(" ", 1)[0])
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.application(environ, start_response_status)
+        except BaseException:
+            self.finish(request)
+            raise
+        return ResponseIterable(result, lambda: self.finish(request))
+
+    def finish(self, request):
+        with self.lock:
+            self.requests.pop(request.thread_id, None)
+        duration = time.monotonic() - request.start
+        if duration >= self.threshold:
+            self.write(request.get_record(duration, True))
+
+    def write(self, record):
+        try:
+            self.log.write(json.dumps(record) + "\n")
+        except OSError as e:
+            sys.stderr.write("Could not write the slow request log: {}\n".format(e))
+
+    def sample(self):
+        """
+        Samples the stacks of the requests running for longer than threshold,
+        and logs those running for twice as long as when they were last logged
+        """
+        now = time.monotonic()
+        with self.lock:
+            requests = [request for request in self.requests.values() if now - request.start >= self.threshold]
+        if not requests:
+            return
+        frames = sys._current_frames()
+        for request in requests:
+            frame = frames.get(request.thread_id)
+            if frame is not None:
+                request.stacks[get_stack(frame)] += 1
+            if now >= request.next_report:
+                request.next_report = request.start + (now - request.start) * 2
+                self.write(request.get_record(now - request.start, False))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        """
+        Starts sampling, in every worker once forked
+        """
+        self.thread = threading.Thread(target=self.run, name="kolibri-server-slowlog", daemon=True)
+        self.thread.start()
+
+
+def format_stacks(frames, worker_id=None):
+    """
+    Returns the stacks of frames, by thread id, as a Python traceback
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = [
+        "--- {} worker {} pid {}\n".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S%z"), worker_id if worker_id is not None else "-", os.getpid()
+        )
+    ]
+    for thread_id, frame in sorted(frames.items()):
+        lines.append('Thread {} "{}":\n'.format(thread_id, names.get(thread_id, "")))
+        lines.extend(traceback.format_stack(frame, limit=MAX_STACK_DEPTH))
+    return "".join(lines) + "\n"
+
+
+class StackDumper(object):
+    def __init__(self, path, worker_id=None):
+        self.path = path
+        self.worker_id = worker_id
+        self.thread = None
+
+    def dump(self):
+        frames = sys._current_frames()
+        frames.pop(threading.get_ident(), None)
+        with open(self.path, "a") as dump_file:
+            fcntl.flock(dump_file, fcntl.LOCK_EX)
+            dump_file.write(format_stacks(frames, self.worker_id))
+
+    def run(self):
+        while True:
+            signal.sigwait({DUMP_SIGNAL})
+            try:
+                self.dump()
+            except OSError as e:
+                sys.stderr.write("Could not dump the stacks: {}\n".format(e))
+
+    def start(self):
+        """
+        Waits for DUMP_SIGNAL in a thread of its own. The signal is blocked in
+        the calling thread, which must be the main thread of the worker, so
+        threads started afterwards block it too and only this one receives it
+        """
+        signal.pthread_sigmask(signal.SIG_BLOCK, {DUMP_SIGNAL})
+        self.thread = threading.Thread(target=self.run, name="kolibri-server-stackdump", daemon=True)
+        self.thread.start()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""
+Runs the uwsgi instances of kolibri-server-native.target that are configured,
+and only those.
+
+kolibri_server_setup.py writes a section of $KOLIBRI_HOME/uwsgi.ini for every
+uwsgi instance: main and hashi, which the target always wants, long unless
+LONG_REQUESTS is false, and main2, main3... with INSTANCES in [uWSGI] of
+/etc/kolibri/kolibri-server.ini. Once it wrote them,
+kolibri-server-setup.service runs this as root, which starts the socket and
+service units of the other instances configured and stops those of the
+instances no longer configured. They are part of the target, so they stop
+and restart with it:
+
+    /usr/share/kolibri-server/kolibri_server_units.py $KOLIBRI_HOME/uwsgi.ini
+"""
+
+import argparse
+import configparser
+import logging
+import subprocess
+import sys
+
+logger = logging.getLogger("kolibri_server_units")
+
+# Units of every uwsgi instance, and the instances kolibri-server-native.target
+# wants itself
+SYSTEMD_UNIT_PREFIX = "kolibri-server-uwsgi@"
+SYSTEMD_UNITS = ("kolibri-server-uwsgi@{}.socket", "kolibri-server-uwsgi@{}.service")
+TARGET_INSTANCES = ("main", "hashi")
+
+
+def get_configured_instances(uwsgi_conf):
+    """
+    Returns the uwsgi instances with a section in uwsgi_conf
+    """
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    if not parser.read(uwsgi_conf):
+        raise OSError("Could not read {}".format(uwsgi_conf))
+    return parser.sections()
+
+
+def get_running_instances():
+    """
+    Returns the uwsgi instances whose socket or service unit is active
+    """
+    output = subprocess.check_output(
+        ["systemctl", "list-units", "--plain", "--no-legend", "--state=active", SYSTEMD_UNIT_PREFIX + "*"],
+        universal_newlines=True,
+    )
+    instances = []
+    for line in output.splitlines():
+        # failed units are marked by a bullet before their name
+        for field in line.split():
+            if field.startswith(SYSTEMD_UNIT_PREFIX):
+                instance = field[len(SYSTEMD_UNIT_PREFIX) :].rsplit(".", 1)[0]
+                if instance not in instances:
+                    instances.append(instance)
+                break
+    return instances
+
+
+def get_units(instances):
+    return [unit.format(instance) for instance in instances for unit in SYSTEMD_UNITS]
+
+
+def update_units(configured, running):
+    """
+    Starts the instances configured besides those of the target and not
+    running yet, and stops those running but no longer configured
+    """
+    started = [instance for instance in configured if instance not in TARGET_INSTANCES and instance not in running]
+    stopped = [instance for instance in running if instance not in configured]
+    if started:
+        logger.info("Starting the uwsgi instances {}".format(", ".join(started)))
+        subprocess.check_call(["systemctl", "--no-block", "start"] + get_units(started))
+    if stopped:
+        logger.info("Stopping the uwsgi instances {}".format(", ".join(stopped)))
+        subprocess.check_call(["systemctl", "--no-block", "stop"] + get_units(stopped))
+    return started, stopped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the uwsgi instances of kolibri-server-native.target configured")
+    parser.add_argument("uwsgi_conf", help="uwsgi.ini written by kolibri_server_setup.py")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    try:
+        update_units(get_configured_instances(args.uwsgi_conf), get_running_instances())
+    except (OSError, configparser.Error, subprocess.CalledProcessError) as e:
+        sys.exit(str(e))
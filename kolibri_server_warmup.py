@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""
+Warms up the caches of kolibri-server after it starts.
+
+Once the uwsgi workers answer through nginx, the pages and API endpoints
+learners request first are fetched from nginx on localhost: the home page in
+every language mapped in /etc/kolibri/dist/nginx.conf, the list of channels,
+the content tree of every channel, the JS and CSS bundles, and the paths of
+PATHS in [Warmup] of /etc/kolibri/kolibri-server.ini. This fills Redis, the
+nginx cache and the page cache before the first learners arrive.
+
+Requests are sent anonymously, with CONCURRENCY of them at once, and warming
+stops after TIMEOUT seconds whatever is left, so it never delays the service
+for long. The init script runs it in the background on every start, unless
+ENABLED is false. It can also be run by hand as the user running Kolibri:
+
+    /usr/share/kolibri-server/kolibri_server_warmup.py
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import ssl
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("kolibri_server_warmup")
+
+NGINX_CONF = "/etc/kolibri/dist/nginx.conf"
+
+# Entry of the map of the Accept-Language header in nginx.conf
+NGINX_LANGUAGE_REGEX = re.compile(r"^\s*~\^(\S+)\s+\S+;", re.MULTILINE)
+
+# Static files fetched, largest first: the bundles of the Kolibri plugins
+STATIC_EXTENSIONS = (".js", ".css")
+MAX_STATIC_FILES = 100
+
+# Seconds between two checks of the workers while they start
+READY_INTERVAL = 1
+
+# Sent with the checks, so nginx passes them to uwsgi instead of answering
+# from its cache, which it does with stale responses while uwsgi is down.
+# kolibri_server_setup.py has nginx bypass its cache for Kolibri sessions.
+READY_HEADERS = {"Cookie": "kolibri=kolibri-server-warmup"}
+
+
+def get_languages(nginx_conf=NGINX_CONF):
+    """
+    Returns the languages of the Accept-Language map of nginx.conf
+    """
+    try:
+        with open(nginx_conf) as nginx_conf_file:
+            configuration = nginx_conf_file.read()
+    except OSError as e:
+        logger.warning("Could not read the languages of {}: {}".format(nginx_conf, e))
+        return ["en"]
+    languages = []
+    for language in NGINX_LANGUAGE_REGEX.findall(configuration):
+        if language not in languages:
+            languages.append(language)
+    return languages or ["en"]
+
+
+def get_static_paths(static_root, path_prefix):
+    """
+    Returns the paths of the largest bundles collected by Kolibri
+    """
+    files = []
+    for root, _, filenames in os.walk(static_root):
+        for filename in filenames:
+            if filename.endswith(STATIC_EXTENSIONS):
+                path = os.path.join(root, filename)
+                try:
+                    files.append((os.path.getsize(path), os.path.relpath(path, static_root)))
+                except OSError:
+                    continue
+    files.sort(reverse=True)
+    return ["{}static/{}".format(path_prefix, name) for _, name in files[:MAX_STATIC_FILES]]
+
+
+def get_channel_paths(channels, path_prefix):
+    """
+    Returns the paths of the content trees of the channels listed by
+    api/content/channel/
+    """
+    paths = []
+    for channel in channels:
+        if not isinstance(channel, dict) or not channel.get("root"):
+            continue
+        paths.append("{}api/content/contentnode_tree/{}/".format(path_prefix, channel["root"]))
+        paths.append("{}api/content/contentnode/?parent={}".format(path_prefix, channel["root"]))
+    return paths
+
+
+class Warmup(object):
+    def __init__(self, port, path_prefix="/", concurrency=4, timeout=120, host="127.0.0.1", scheme="http"):
+        self.base_url = "{}://{}:{}".format(scheme, host, port)
+        self.context = None
+        if scheme == "https":
+            # nginx on this server, whose certificate is for the name clients use
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        self.path_prefix = path_prefix
+        self.concurrency = concurrency
+        self.deadline = time.monotonic() + timeout
+        self.fetched = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def fetch(self, path, language=None):
+        """
+        Returns the body of the response to a GET request for path, or None
+        if it failed or the time is up
+        """
+        timeout = self.remaining()
+        if timeout <= 0:
+            self.skipped += 1
+            return None
+        headers = {"Accept-Language": language} if language else {}
+        request = urllib.request.Request(self.base_url + path, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout, context=self.context) as response:
+                body = response.read()
+        except (OSError, ValueError) as e:
+            logger.debug("Could not warm up {}: {}".format(path, e))
+            self.failed += 1
+            return None
+        self.fetched += 1
+        return body
+
+    def wait_ready(self):
+        """
+        Returns whether the uwsgi workers answered before the time is up:
+        nginx answers 502 until they do
+        """
+        url = "{}{}api/public/info/".format(self.base_url, self.path_prefix)
+        request = urllib.request.Request(url, headers=READY_HEADERS)
+        while self.remaining() > 0:
+            try:
+                with urllib.request.urlopen(request, timeout=max(self.remaining(), 0.1), context=self.context):
+                    return True
+            except (OSError, ValueError):
+                time.sleep(min(READY_INTERVAL, max(self.remaining(), 0)))
+        return False
+
+    def fetch_all(self, requests):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(lambda request: self.fetch(*request), requests))
+
+    def run(self, languages, static_paths=(), extra_paths=()):
+        """
+        Warms up the caches, and returns whether every request was sent in time
+        """
+        prefix = self.path_prefix
+        requests = [(prefix, language) for language in languages]
+        requests.append((prefix + "api/public/info/", None))
+        requests.append((prefix + "api/content/channel/?available=true", None))
+        channels_index = len(requests) - 1
+        requests += [(path, None) for path in extra_paths]
+        channels = self.fetch_all(requests)[channels_index]
+        try:
+            channels = json.loads(channels.decode("utf-8")) if channels else []
+        except ValueError:
+            channels = []
+        if isinstance(channels, list):
+            self.fetch_all([(path, None) for path in get_channel_paths(channels, prefix)])
+        self.fetch_all([(path, None) for path in static_paths])
+        return not self.skipped
+
+
+if __name__ == "__main__":
+    # reads the options of Kolibri and kolibri-server when imported, which
+    # the tests of this module do without
+    import kolibri_server_setup as setup
+
+    parser = argparse.ArgumentParser(description="Warm up the caches of kolibri-server")
+    parser.add_argument("--timeout", type=float, help="Seconds after which warming stops")
+    parser.add_argument("--concurrency", type=int, help="Number of requests sent at once")
+    parser.add_argument("--force", action="store_true", help="Warm up even if disabled in kolibri-server.ini")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    options = setup.server_options["Warmup"]
+    if not options["ENABLED"] and not args.force:
+        logger.info("Cache warm-up is disabled")
+        sys.exit(0)
+
+    start = time.monotonic()
+    path_prefix = setup.path_prefix.rstrip("/") + "/"
+    warmup = Warmup(
+        setup.port,
+        path_prefix,
+        args.concurrency or options["CONCURRENCY"],
+        args.timeout or options["TIMEOUT"],
+        # nginx only listens on LISTEN_ADDRESS when it is not every address
+        setup.listen_address if setup.listen_address != "0.0.0.0" else "127.0.0.1",
+        setup.get_nginx_scheme(),
+    )
+    if not warmup.wait_ready():
+        logger.warning("Kolibri did not answer in {:.0f}s, not warming up its caches".format(time.monotonic() - start))
+        sys.exit(1)
+    complete = warmup.run(
+        get_languages(),
+        get_static_paths(setup.get_static_root(), path_prefix),
+        [path.strip() for path in options["PATHS"].split(",") if path.strip()],
+    )
+    logger.info(
+        "Warmed up {} paths in {:.1f}s, {} failed{}".format(
+            warmup.fetched,
+            time.monotonic() - start,
+            warmup.failed,
+            "" if complete else ", {} skipped when the time was up".format(warmup.skipped),
+        )
+    )
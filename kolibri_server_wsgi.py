@@ -0,0 +1,182 @@
+"""
+WSGI application for the main uwsgi instance, warmed up in the uwsgi master
+unless WARM_START is off in kolibri-server.ini, when every worker imports it
+once forked instead (lazy-apps).
+
+uwsgi imports this module once in the master and forks the workers from it,
+so everything Kolibri initialises here is shared by the workers copy-on-write
+instead of being loaded again by every new worker: its Django apps and
+plugins, its URLconf with every view and serializer it imports, and the
+translation catalogs of its languages. Database and cache connections are
+closed before forking, as they can not be shared between processes.
+
+When a worker answers its first request, the time from the start of the
+master and from its own fork until it accepted requests, the time that request
+took, its RSS and the part of it that is private to the worker are logged, in
+both modes, to compare cold and warm starts. Every worker then dumps its stacks when asked to, and samples the
+stacks of its slow requests if kolibri_server_setup.py enabled it, see
+kolibri_server_slowlog.
+"""
+
+import gc
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.urls import get_resolver
+from django.utils import translation
+from kolibri.deployment.default.wsgi import application
+from kolibri.utils import pskolibri
+
+from kolibri_server_slowlog import RotatingLog
+from kolibri_server_slowlog import SlowRequestLog
+from kolibri_server_slowlog import StackDumper
+
+try:
+    import uwsgi
+except ImportError:
+    # not running under uwsgi
+    uwsgi = None
+
+logger = logging.getLogger(__name__)
+
+# All set by kolibri_server_setup.py in the generated uwsgi.ini
+WARM_START = os.environ.get("KOLIBRI_SERVER_WARM_START", "true") == "true"
+STACK_DUMP_FILE = os.environ.get("KOLIBRI_SERVER_STACK_DUMP_FILE", "")
+SLOW_REQUEST_SECONDS = float(os.environ.get("KOLIBRI_SERVER_SLOW_REQUEST_SECONDS", "0"))
+SLOW_REQUEST_INTERVAL = float(os.environ.get("KOLIBRI_SERVER_SLOW_REQUEST_INTERVAL", "0.1"))
+SLOW_REQUEST_LOG = os.environ.get("KOLIBRI_SERVER_SLOW_REQUEST_LOG", "")
+SLOW_REQUEST_LOG_SIZE = int(os.environ.get("KOLIBRI_SERVER_SLOW_REQUEST_LOG_SIZE", "0"))
+SLOW_REQUEST_LOG_BACKUPS = int(os.environ.get("KOLIBRI_SERVER_SLOW_REQUEST_LOG_BACKUPS", "5"))
+
+
+def warm_up():
+    start = time.time()
+    # Resolving the URLconf imports the urls of every plugin and their views
+    get_resolver().url_patterns
+    for language, _ in settings.LANGUAGES:
+        translation.activate(language)
+    translation.deactivate()
+
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+    # Objects created so far are never freed, so the garbage collector must
+    # not write to their pages when the workers run it
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    logger.info("Kolibri warmed up in {:.2f}s".format(time.time() - start))
+
+
+def get_private_memory():
+    """
+    Returns the memory in bytes not shared with any other process, or None
+    if the kernel does not report it
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            return sum(
+                int(line.split()[1]) * 1024 for line in smaps if line.startswith(("Private_Clean:", "Private_Dirty:"))
+            )
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_process_age(pid="self"):
+    """
+    Returns the seconds elapsed since a process, this one by default, was forked
+    """
+    with open("/proc/{}/stat".format(pid)) as stat_file:
+        # the command name, between parentheses, can hold spaces
+        start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime") as uptime_file:
+        uptime = float(uptime_file.read().split()[0])
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def format_age(age):
+    return "{:.0f} ms".format(age * 1000) if age is not None else "an unknown time"
+
+
+def report_worker(master_age, ready_age, first_request_time):
+    rss = pskolibri.Process(os.getpid()).memory_info().rss
+    private = get_private_memory()
+    logger.info(
+        "Worker {} ({} start) accepting {} after the master started and {} after fork, "
+        "first request in {:.0f} ms, RSS {:.1f} MB, {} private".format(
+            uwsgi.worker_id(),
+            "warm" if WARM_START else "cold",
+            format_age(master_age),
+            format_age(ready_age),
+            first_request_time * 1000,
+            rss / 1024 / 1024,
+            "{:.1f} MB".format(private / 1024 / 1024) if private is not None else "unknown",
+        )
+    )
+
+
+class FirstRequestReport(object):
+    """
+    Reports how long the worker took to be ready once it answered its first
+    request, which also loads what Kolibri only initialises on demand
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.master_age = None
+        self.ready_age = None
+        self.reported = False
+
+    def __call__(self, environ, start_response):
+        if self.reported:
+            return self.application(environ, start_response)
+        self.reported = True
+        start = time.time()
+        try:
+            return self.application(environ, start_response)
+        finally:
+            report_worker(self.master_age, self.ready_age, time.time() - start)
+
+
+def start_worker():
+    try:
+        first_request_report.ready_age = get_process_age()
+        # which includes the warm up of the master, or the import of Kolibri
+        # by a cold started worker
+        first_request_report.master_age = get_process_age(uwsgi.masterpid())
+    except (OSError, ValueError, IndexError):
+        pass
+    # first, so the threads started afterwards do not receive its signal
+    if STACK_DUMP_FILE:
+        StackDumper(STACK_DUMP_FILE, uwsgi.worker_id()).start()
+    if slow_request_log is not None:
+        slow_request_log.start()
+
+
+if WARM_START:
+    warm_up()
+
+slow_request_log = None
+if SLOW_REQUEST_SECONDS and SLOW_REQUEST_LOG:
+    slow_request_log = SlowRequestLog(
+        application,
+        RotatingLog(SLOW_REQUEST_LOG, SLOW_REQUEST_LOG_SIZE, SLOW_REQUEST_LOG_BACKUPS),
+        SLOW_REQUEST_SECONDS,
+        SLOW_REQUEST_INTERVAL,
+    )
+    application = slow_request_log
+
+# forked workers inherit it before they answer any request
+first_request_report = FirstRequestReport(application)
+application = first_request_report
+
+if uwsgi is not None:
+    if uwsgi.worker_id():
+        # imported by a worker once forked, with lazy-apps
+        start_worker()
+    else:
+        uwsgi.post_fork_hook = start_worker
@@ -0,0 +1,358 @@
+"""
+Disk cache of the files embedded in zip content archives.
+
+Files are extracted under a directory named after the archive, which is
+content addressed, so nginx can send them without decompressing anything.
+Each archive gets an index of its members, with the offset of their data in
+the archive, so members are extracted without reading the zip directory again.
+Archives are extracted member by member as they are requested and, once hot,
+a batch of their other members at a time along with the requested one, until
+they are extracted in full. The least recently used archives are evicted when the cache grows
+over its maximum size.
+
+This module must not depend on Kolibri: kolibri_server_setup.py uses it to
+size the cache before Kolibri is running.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Kolibri rewrites these files when serving them, so they are never cached
+REWRITTEN_EXTENSIONS = ("htm", "html")
+
+# Number of members extracted one by one before extracting a whole archive
+HOT_ARCHIVE_MISSES = 3
+
+# A whole archive is only extracted if it takes at most this fraction of the cache
+MAX_ARCHIVE_FRACTION = 0.25
+
+# Bytes of the other members of a hot archive extracted by a request at most,
+# so it does not wait for a whole large archive
+HOT_ARCHIVE_BATCH_SIZE = 4 * 1024 * 1024
+
+# Eviction stops once the cache is back under this fraction of its maximum size
+EVICTION_TARGET = 0.9
+
+# Seconds between two eviction checks of the same process
+EVICTION_INTERVAL = 10
+
+# Seconds between two updates of the last access time of an archive
+TOUCH_INTERVAL = 60
+
+CHUNK_SIZE = 64 * 1024
+
+# Local file header of a zip member, see zipfile.structFileHeader
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+
+def is_rewritten(embedded_filepath):
+    return embedded_filepath.endswith(REWRITTEN_EXTENSIONS)
+
+
+def is_safe(embedded_filepath):
+    """
+    Checks a member name can not resolve to a path outside of its archive directory
+    """
+    return (
+        os.path.normpath(embedded_filepath) == embedded_filepath
+        and not embedded_filepath.startswith(("..", "/"))
+        and "\0" not in embedded_filepath
+    )
+
+
+def _write_atomically(path, chunks, mode=0o644, replace=True):
+    """
+    Writes the chunks to path so readers never see a partial file. Unless
+    replace, an existing file is kept. Returns whether path was written.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for chunk in chunks:
+                tmp_file.write(chunk)
+        # readable by nginx
+        os.chmod(tmp_path, mode)
+        if replace:
+            os.replace(tmp_path, path)
+            return True
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            # written meanwhile by another worker
+            return False
+        finally:
+            os.unlink(tmp_path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _read_member(zip_path, entry, member):
+    """
+    Yields the uncompressed content of a member described by an index entry
+    """
+    offset, compress_type, compress_size, file_size, crc = entry
+    if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(zip_path) as zf, zf.open(member) as member_file:
+            yield from iter(lambda: member_file.read(CHUNK_SIZE), b"")
+        return
+
+    decompressor = zlib.decompressobj(-15) if compress_type == zipfile.ZIP_DEFLATED else None
+    with open(zip_path, "rb") as zip_file:
+        zip_file.seek(offset)
+        header = LOCAL_HEADER.unpack(zip_file.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("Bad local header for {} in {}".format(member, zip_path))
+        # skip the file name and extra field
+        zip_file.seek(header[10] + header[11], os.SEEK_CUR)
+        remaining = compress_size
+        checksum = 0
+        while remaining:
+            data = zip_file.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise zipfile.BadZipFile("Truncated {} in {}".format(member, zip_path))
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            checksum = zlib.crc32(data, checksum)
+            yield data
+        if decompressor is not None:
+            data = decompressor.flush()
+            checksum = zlib.crc32(data, checksum)
+            yield data
+    if checksum != crc:
+        raise zipfile.BadZipFile("Bad CRC for {} in {}".format(member, zip_path))
+
+
+class ZipContentCache(object):
+    def __init__(self, cache_dir, max_size=0):
+        """
+        :param max_size: maximum size in bytes of the extracted files, 0 for no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._last_eviction = 0
+
+    def _archive_path(self, zipped_filename):
+        return os.path.join(self.cache_dir, zipped_filename)
+
+    def _index_path(self, zipped_filename):
+        return os.path.join(self.cache_dir, zipped_filename + ".index")
+
+    def _stats_path(self, zipped_filename):
+        return os.path.join(self.cache_dir, zipped_filename + ".stats")
+
+    def member_path(self, zipped_filename, embedded_filepath):
+        return os.path.join(self._archive_path(zipped_filename), embedded_filepath)
+
+    def lookup(self, zipped_filename, embedded_filepath):
+        """
+        Returns the path of an extracted member, or None if it is not cached
+        """
+        path = self.member_path(zipped_filename, embedded_filepath)
+        if not os.path.isfile(path):
+            return None
+        self._touch(zipped_filename)
+        return path
+
+    def _touch(self, zipped_filename):
+        stats_path = self._stats_path(zipped_filename)
+        now = time.time()
+        try:
+            if now - os.stat(stats_path).st_mtime > TOUCH_INTERVAL:
+                os.utime(stats_path, (now, now))
+        except OSError:
+            pass
+
+    def get_index(self, zip_path, zipped_filename):
+        """
+        Returns the members of an archive, building its index the first time
+        """
+        index_path = self._index_path(zipped_filename)
+        try:
+            with open(index_path) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            pass
+        index = {}
+        with zipfile.ZipFile(zip_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or info.flag_bits & 0x1:
+                    # directories and encrypted members
+                    continue
+                index[info.filename] = [
+                    info.header_offset,
+                    info.compress_type,
+                    info.compress_size,
+                    info.file_size,
+                    info.CRC,
+                ]
+        _write_atomically(index_path, [json.dumps(index).encode("utf-8")])
+        return index
+
+    def get_stats(self, zipped_filename):
+        try:
+            with open(self._stats_path(zipped_filename)) as stats_file:
+                return json.load(stats_file)
+        except (OSError, ValueError):
+            return {"size": 0, "misses": 0, "complete": False}
+
+    def _update_stats(self, zipped_filename, size, misses=0, complete=False):
+        """
+        Adds to the stats of an archive, and returns them. Every worker
+        updates them, so they are read and written under a lock on the cache
+        directory.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd = os.open(self.cache_dir, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stats = self.get_stats(zipped_filename)
+            stats["size"] += size
+            stats["misses"] += misses
+            stats["complete"] = stats["complete"] or complete
+            _write_atomically(self._stats_path(zipped_filename), [json.dumps(stats).encode("utf-8")])
+        finally:
+            os.close(fd)
+        return stats
+
+    def _extract_member(self, zip_path, zipped_filename, member, entry):
+        """
+        Extracts a member unless it already is, and returns the bytes it adds
+        to the cache
+        """
+        path = self.member_path(zipped_filename, member)
+        if os.path.isfile(path):
+            return 0
+        if not _write_atomically(path, _read_member(zip_path, entry, member), replace=False):
+            return 0
+        return entry[3]
+
+    def extract(self, zip_path, zipped_filename, embedded_filepath):
+        """
+        Extracts a member of an archive, and a batch of its other members if
+        it is hot. Returns the path of the extracted member, or None if the archive has
+        no such member.
+        """
+        if is_rewritten(embedded_filepath) or not is_safe(embedded_filepath):
+            return None
+        index = self.get_index(zip_path, zipped_filename)
+        entry = index.get(embedded_filepath)
+        if entry is None:
+            return None
+
+        size = self._extract_member(zip_path, zipped_filename, embedded_filepath, entry)
+        stats = self._update_stats(zipped_filename, size, misses=1)
+        if stats["misses"] >= HOT_ARCHIVE_MISSES and not stats["complete"] and self._fits(index):
+            size, complete = self._extract_archive(zip_path, zipped_filename, index, HOT_ARCHIVE_BATCH_SIZE)
+            self._update_stats(zipped_filename, size, complete=complete)
+
+        self.evict(keep=zipped_filename)
+        return self.member_path(zipped_filename, embedded_filepath)
+
+    def _fits(self, index):
+        if not self.max_size:
+            return True
+        size = sum(entry[3] for member, entry in index.items() if not is_rewritten(member))
+        return size <= self.max_size * MAX_ARCHIVE_FRACTION
+
+    def _extract_archive(self, zip_path, zipped_filename, index, batch_size=0):
+        """
+        Extracts the members of an archive not extracted yet, stopping once
+        batch_size bytes were, 0 for no limit. Returns the bytes added to the
+        cache and whether the whole archive is extracted.
+        """
+        size = 0
+        extracted = 0
+        for member, entry in index.items():
+            if is_rewritten(member) or not is_safe(member):
+                continue
+            if os.path.isfile(self.member_path(zipped_filename, member)):
+                continue
+            if batch_size and extracted >= batch_size:
+                return size, False
+            size += self._extract_member(zip_path, zipped_filename, member, entry)
+            extracted += entry[3]
+        return size, True
+
+    def get_archives(self):
+        """
+        Returns (last access time, archive name, extracted size) of every archive in the cache
+        """
+        archives = []
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return archives
+        for entry in entries:
+            if not entry.name.endswith(".stats"):
+                continue
+            zipped_filename = entry.name[: -len(".stats")]
+            try:
+                last_access = entry.stat().st_mtime
+            except OSError:
+                continue
+            archives.append((last_access, zipped_filename, self.get_stats(zipped_filename)["size"]))
+        return archives
+
+    def get_size(self):
+        return sum(size for _, _, size in self.get_archives())
+
+    def remove(self, zipped_filename):
+        """
+        Removes an archive from the cache. Its directory is renamed first, so
+        nothing is served from a partially deleted archive.
+        """
+        for path in (self._stats_path(zipped_filename), self._index_path(zipped_filename)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        archive_path = self._archive_path(zipped_filename)
+        evicted_path = os.path.join(self.cache_dir, ".evicted-{}-{}".format(zipped_filename, os.getpid()))
+        try:
+            os.rename(archive_path, evicted_path)
+        except OSError:
+            return
+        shutil.rmtree(evicted_path, ignore_errors=True)
+
+    def evict(self, keep=None, force=False):
+        """
+        Removes the least recently used archives until the cache is under its
+        maximum size. Unless forced, the cache is checked at most every
+        EVICTION_INTERVAL seconds.
+        """
+        if not self.max_size:
+            return
+        now = time.time()
+        if not force and now - self._last_eviction < EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+
+        archives = self.get_archives()
+        size = sum(archive_size for _, _, archive_size in archives)
+        if size <= self.max_size:
+            return
+        for _, zipped_filename, archive_size in sorted(archives):
+            if zipped_filename == keep:
+                continue
+            logger.info("Evicting {} from the zip content cache".format(zipped_filename))
+            self.remove(zipped_filename)
+            size -= archive_size
+            if size <= self.max_size * EVICTION_TARGET:
+                break
@@ -0,0 +1,116 @@
+"""
+WSGI application for the hashi uwsgi instance that lets nginx send the files
+embedded in zip content.
+
+Embedded files Kolibri does not rewrite are extracted once to the zip content
+cache, see kolibri_server_zipcache, and every request for them is answered
+with an X-Accel-Redirect to the internal nginx location serving that
+directory, so workers never decompress or stream them. Any other request is
+handled by Kolibri's zip content application.
+"""
+
+import logging
+import mimetypes
+import os
+import re
+import time
+import zipfile
+from email.utils import formatdate
+from urllib.parse import quote
+
+from kolibri.core.content.errors import InvalidStorageFilenameError
+from kolibri.core.content.utils.paths import get_content_storage_file_path
+from kolibri.core.content.utils.paths import get_zip_content_base_path
+from kolibri.deployment.default.alt_wsgi import alt_application
+
+from kolibri_server_zipcache import ZipContentCache
+from kolibri_server_zipcache import is_rewritten
+from kolibri_server_zipcache import is_safe
+
+logger = logging.getLogger(__name__)
+
+# All set by kolibri_server_setup.py in the generated uwsgi.ini
+CACHE_DIR = os.environ.get("KOLIBRI_SERVER_ZIPCONTENT_CACHE", "")
+CACHE_URL = os.environ.get("KOLIBRI_SERVER_ZIPCONTENT_URL", "")
+CACHE_SIZE = int(os.environ.get("KOLIBRI_SERVER_ZIPCONTENT_CACHE_SIZE", "0"))
+
+# Same lifetime Kolibri gives to zip content responses
+YEAR_IN_SECONDS = 60 * 60 * 24 * 365
+
+# Same archives Kolibri's zip content application serves, so nginx never
+# sends a file it would refuse
+path_regex = re.compile(
+    r"^{}(?P<zipped_filename>[a-f0-9]{{32}}\.zip)/(?P<embedded_filepath>.*)$".format(
+        re.escape(get_zip_content_base_path())
+    )
+)
+
+zipcontent_cache = ZipContentCache(CACHE_DIR, max_size=CACHE_SIZE)
+
+
+def parse_path(path_info):
+    """
+    Returns the archive and the embedded file requested by path_info, or None
+    if the request can not be served from the cache
+    """
+    match = path_regex.match(path_info)
+    if match is None:
+        return None
+    zipped_filename, embedded_filepath = match.groups()
+    # Same normalization Kolibri applies before looking the file up
+    if embedded_filepath.startswith("/"):
+        embedded_filepath = embedded_filepath[1:]
+    embedded_filepath = embedded_filepath.replace("//", "/")
+    if not embedded_filepath or embedded_filepath.endswith("/"):
+        # index.html, which Kolibri rewrites
+        return None
+    if is_rewritten(embedded_filepath) or not is_safe(embedded_filepath):
+        return None
+    return zipped_filename, embedded_filepath
+
+
+def get_cached_file(zipped_filename, embedded_filepath):
+    """
+    Returns the path of the embedded file in the cache, extracting it if
+    needed, or None if Kolibri has to answer the request
+    """
+    path = zipcontent_cache.lookup(zipped_filename, embedded_filepath)
+    if path is not None:
+        return path
+    try:
+        zipped_path = get_content_storage_file_path(zipped_filename)
+    except InvalidStorageFilenameError:
+        return None
+    if not os.path.exists(zipped_path):
+        return None
+    try:
+        return zipcontent_cache.extract(zipped_path, zipped_filename, embedded_filepath)
+    except (OSError, zipfile.BadZipFile, ValueError) as e:
+        logger.warning("Could not extract {} from {}: {}".format(embedded_filepath, zipped_filename, e))
+        return None
+
+
+def application(environ, start_response):
+    request = None
+    # Kolibri answers any revalidation with a 304 without opening the archive
+    if CACHE_DIR and environ.get("REQUEST_METHOD") == "GET" and not environ.get("HTTP_IF_MODIFIED_SINCE"):
+        try:
+            # PATH_INFO holds the UTF-8 bytes of the path decoded as latin-1
+            path_info = environ.get("PATH_INFO", "").encode("latin-1").decode("utf-8")
+        except UnicodeError:
+            path_info = ""
+        request = parse_path(path_info)
+    if request is None or get_cached_file(*request) is None:
+        return alt_application(environ, start_response)
+
+    zipped_filename, embedded_filepath = request
+    # nginx keeps these headers from the redirecting response, and adds the
+    # ones Kolibri sets on every zip content response itself
+    headers = [
+        ("Content-Type", mimetypes.guess_type(embedded_filepath)[0] or "application/octet-stream"),
+        ("Cache-Control", "max-age={}".format(YEAR_IN_SECONDS)),
+        ("Expires", formatdate(time.time() + YEAR_IN_SECONDS, usegmt=True)),
+        ("X-Accel-Redirect", "{}{}/{}".format(CACHE_URL, zipped_filename, quote(embedded_filepath))),
+    ]
+    start_response("200 OK", headers)
+    return []
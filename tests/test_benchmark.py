@@ -0,0 +1,155 @@
+"""Tests for kolibri_server_benchmark.py."""
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_benchmark
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_benchmark import Connection
+from kolibri_server_benchmark import Stats
+from kolibri_server_benchmark import count_uwsgi_workers
+from kolibri_server_benchmark import parse_weights
+from kolibri_server_benchmark import percentile
+
+RESPONSES = {
+    b"/length": b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nSet-Cookie: kolibri=abc; Path=/\r\n\r\nhello",
+    b"/chunked": b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nhel\r\n2\r\nlo\r\n0\r\n\r\n",
+    b"/cookie": None,
+}
+
+
+def run_server(test):
+    """
+    Runs test with the port of an HTTP server answering RESPONSES, and the
+    number of connections it accepted
+    """
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                headers.append(line)
+            path = request_line.split()[1]
+            response = RESPONSES[path]
+            if response is None:
+                cookie = b"".join(line for line in headers if line.lower().startswith(b"cookie:")).strip()
+                response = b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(cookie)).encode() + b"\r\n\r\n" + cookie
+            writer.write(response)
+            await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await test(port, connections)
+        finally:
+            server.close()
+            await server.wait_closed()
+            # let the handlers see their connections closed
+            await asyncio.sleep(0.01)
+
+    return asyncio.run(main())
+
+
+# --- Statistics tests ---
+
+
+class TestStats:
+    def test_percentile_uses_nearest_rank(self):
+        values = list(range(1, 101))
+        assert percentile(values, 0.5) == 50
+        assert percentile(values, 0.99) == 99
+        assert percentile([], 0.5) is None
+
+    def test_summary_counts_errors(self):
+        stats = Stats()
+        stats.record("GET api/", 0.1)
+        stats.record("GET api/", 0.3, error=True)
+        summary = stats.summary(2)
+        assert summary["GET api/"]["errors"] == 1
+        assert summary["all"]["requests"] == 2
+        assert summary["all"]["rps"] == 1
+        assert summary["GET api/"]["p99"] == pytest.approx(300)
+
+    def test_scenarios_can_be_disabled(self):
+        weights = parse_weights(["video=0", "html5=5"])
+        assert "video" not in weights
+        assert weights["html5"] == 5
+
+    def test_unknown_scenario_is_rejected(self):
+        with pytest.raises(ValueError):
+            parse_weights(["teach=1"])
+
+
+# --- Connection tests ---
+
+
+class TestConnection:
+    def test_connection_is_kept_alive(self):
+        async def test(port, connections):
+            connection = Connection(port, {})
+            first = await connection.request("GET", "/length")
+            second = await connection.request("GET", "/chunked")
+            connection.close()
+            return first[2], second[2], len(connections)
+
+        assert run_server(test) == (b"hello", b"hello", 1)
+
+    def test_cookies_are_sent_back(self):
+        async def test(port, connections):
+            cookies = {}
+            connection = Connection(port, cookies)
+            await connection.request("GET", "/length")
+            _, _, body = await connection.request("GET", "/cookie")
+            connection.close()
+            return cookies, body
+
+        assert run_server(test) == ({"kolibri": "abc"}, b"Cookie: kolibri=abc")
+
+
+# --- uwsgi worker tests ---
+
+
+class TestWorkers:
+    def test_running_workers_are_counted_by_instance(self, tmp_path):
+        path = str(tmp_path / "stats.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        stats = {
+            "workers": [
+                {"id": 1, "pid": 101, "status": "busy"},
+                {"id": 2, "pid": 102, "status": "idle"},
+                {"id": 3, "pid": 0, "status": "cheap"},
+            ]
+        }
+
+        def answer():
+            connection, _ = server.accept()
+            connection.sendall(json.dumps(stats).encode())
+            connection.close()
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        try:
+            workers = count_uwsgi_workers({"main2": path, "hashi": str(tmp_path / "missing.sock")})
+        finally:
+            thread.join()
+            server.close()
+        assert workers == {"main2": 2}
@@ -0,0 +1,151 @@
+"""Tests for kolibri_server_cache.py."""
+
+import os
+import sys
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_cache
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# the cache backend extends django-redis-cache, which Kolibri ships, with
+# Django, in kolibri/dist: importing kolibri puts it on the path
+pytest.importorskip("kolibri")
+pytest.importorskip("django")
+redis_cache = pytest.importorskip("redis_cache")
+
+import kolibri_server_cache  # noqa: E402
+from kolibri_server_cache import TwoTierRedisCache  # noqa: E402
+
+CONTENT_KEY = "views.decorators.cache.cache_page.content"
+
+
+class FakeRedis(object):
+    """
+    Redis shared by every worker, behind the cache API of django-redis-cache
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.reads = []
+
+    def install(self, monkeypatch):
+        fake = self
+
+        def init(cache, server, params):
+            pass
+
+        def get(cache, key, default=None, version=None):
+            fake.reads.append(key)
+            return fake.data.get(key, default)
+
+        def get_many(cache, keys, version=None):
+            fake.reads.extend(keys)
+            return {key: fake.data[key] for key in keys if key in fake.data}
+
+        def set(cache, key, value, timeout=None, version=None):
+            fake.data[key] = value
+            return True
+
+        def delete(cache, key, version=None):
+            return fake.data.pop(key, None) is not None
+
+        def clear(cache, version=None):
+            fake.data.clear()
+
+        methods = {"__init__": init, "get": get, "get_many": get_many, "set": set, "delete": delete, "clear": clear}
+        for name, method in methods.items():
+            monkeypatch.setattr(redis_cache.RedisCache, name, method)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    # also read by the local cache, for its TTL
+    monkeypatch.setattr(kolibri_server_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    fake.install(monkeypatch)
+    fake.data.update({"content_cache_key": 1.0, "device_settings_cache_key": "settings"})
+    return fake
+
+
+@pytest.fixture
+def cache(monkeypatch, redis, clock):
+    monkeypatch.setattr(kolibri_server_cache, "LOCAL_CACHE_SIZE", 1024 * 1024)
+    monkeypatch.setattr(kolibri_server_cache, "LOCAL_CACHE_TTL", 10)
+    return TwoTierRedisCache("localhost:6379", {})
+
+
+class TestTwoTierRedisCache:
+    def test_local_keys_are_read_from_redis_once(self, cache, redis):
+        redis.data[CONTENT_KEY] = {"results": [1, 2]}
+        assert cache.get(CONTENT_KEY) == {"results": [1, 2]}
+        assert cache.get(CONTENT_KEY) == {"results": [1, 2]}
+        assert redis.reads.count(CONTENT_KEY) == 1
+
+    def test_other_keys_are_always_read_from_redis(self, cache, redis):
+        redis.data["session"] = "value"
+        cache.get("session")
+        cache.get("session")
+        assert redis.reads.count("session") == 2
+
+    def test_missing_keys_fall_back_to_redis_every_time(self, cache, redis):
+        assert cache.get(CONTENT_KEY, "default") == "default"
+        redis.data[CONTENT_KEY] = "cached since"
+        assert cache.get(CONTENT_KEY) == "cached since"
+        assert redis.reads.count(CONTENT_KEY) == 2
+
+    def test_generation_keys_are_read_at_most_every_interval(self, cache, redis, clock):
+        assert cache.get("content_cache_key") == 1.0
+        redis.data["content_cache_key"] = 2.0
+        assert cache.get("content_cache_key") == 1.0
+        clock[0] += kolibri_server_cache.GENERATION_INTERVAL
+        assert cache.get("content_cache_key") == 2.0
+
+    def test_local_values_are_stale_until_the_generation_is_read(self, cache, redis, clock):
+        redis.data[CONTENT_KEY] = "old"
+        cache.get(CONTENT_KEY)
+        # channels updated by another process
+        redis.data.update({CONTENT_KEY: "new", "content_cache_key": 2.0})
+        assert cache.get(CONTENT_KEY) == "old"
+        clock[0] += kolibri_server_cache.GENERATION_INTERVAL
+        assert cache.get(CONTENT_KEY) == "new"
+        assert cache.get(CONTENT_KEY) == "new"
+        assert redis.reads.count(CONTENT_KEY) == 2
+
+    def test_device_settings_change_drops_local_values(self, cache, redis, clock):
+        redis.data["CHANNEL_STATS_CACHED_KEYS_abc"] = "old"
+        cache.get("CHANNEL_STATS_CACHED_KEYS_abc")
+        redis.data.update({"CHANNEL_STATS_CACHED_KEYS_abc": "new", "device_settings_cache_key": "saved"})
+        clock[0] += kolibri_server_cache.GENERATION_INTERVAL
+        assert cache.get("CHANNEL_STATS_CACHED_KEYS_abc") == "new"
+
+    def test_invalidation_by_another_worker_is_seen(self, cache, redis, clock):
+        redis.data[CONTENT_KEY] = "old"
+        cache.get(CONTENT_KEY)
+        # sharing the same Redis
+        other = TwoTierRedisCache("localhost:6379", {})
+        other.set(CONTENT_KEY, "new")
+        other.set("content_cache_key", 2.0)
+        clock[0] += kolibri_server_cache.GENERATION_INTERVAL
+        assert cache.get(CONTENT_KEY) == "new"
+
+    def test_own_writes_are_read_back_at_once(self, cache, redis):
+        redis.data[CONTENT_KEY] = "old"
+        cache.get(CONTENT_KEY)
+        cache.set(CONTENT_KEY, "new")
+        assert cache.get(CONTENT_KEY) == "new"
+        cache.set("content_cache_key", 2.0)
+        assert cache.get("content_cache_key") == 2.0
+        cache.delete(CONTENT_KEY)
+        assert cache.get(CONTENT_KEY) is None
+
+    def test_values_are_not_shared_between_callers(self, cache, redis):
+        redis.data[CONTENT_KEY] = {"results": []}
+        cache.get(CONTENT_KEY)["results"].append(1)
+        assert cache.get(CONTENT_KEY) == {"results": []}
@@ -0,0 +1,54 @@
+"""Tests for kolibri_server_localcache.py."""
+
+import os
+import sys
+
+# Add the repository root to path so we can import kolibri_server_localcache
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import kolibri_server_localcache
+from kolibri_server_localcache import LocalCache
+
+
+class TestLocalCache:
+    def test_value_is_returned(self):
+        cache = LocalCache(100, 10)
+        cache.set("key", b"value")
+        assert cache.get("key") == b"value"
+        assert cache.get("missing") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_least_recently_used_value_is_evicted(self):
+        cache = LocalCache(10, 10)
+        cache.set("a", b"aaaa")
+        cache.set("b", b"bbbb")
+        cache.get("a")
+        cache.set("c", b"cccc")
+        assert cache.get("b") is None
+        assert cache.get("a") == b"aaaa"
+        assert cache.size == 8
+
+    def test_value_larger_than_cache_is_not_kept(self):
+        cache = LocalCache(4, 10)
+        cache.set("a", b"aaa")
+        cache.set("a", b"aaaaa")
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_value_expires(self, monkeypatch):
+        cache = LocalCache(100, 10)
+        now = [1000.0]
+        monkeypatch.setattr(kolibri_server_localcache.time, "monotonic", lambda: now[0])
+        cache.set("key", b"value")
+        now[0] += 11
+        assert cache.get("key") is None
+        assert cache.size == 0
+
+    def test_new_generation_drops_values(self):
+        cache = LocalCache(100, 10)
+        cache.set_generation(("1.0", "settings"))
+        cache.set("key", b"value")
+        cache.set_generation(("1.0", "settings"))
+        assert cache.get("key") == b"value"
+        cache.set_generation(("2.0", "settings"))
+        assert cache.get("key") is None
@@ -0,0 +1,113 @@
+"""Tests for kolibri_server_logstats.py."""
+
+import gzip
+import os
+import sys
+
+# Add the repository root to path so we can import kolibri_server_logstats
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import kolibri_server_logstats
+from kolibri_server_logstats import LogStats
+from kolibri_server_logstats import Sketch
+from kolibri_server_logstats import follow
+from kolibri_server_logstats import get_log_files
+from kolibri_server_logstats import get_route
+from kolibri_server_logstats import open_log
+from kolibri_server_logstats import parse_line
+
+LINE = (
+    '10.0.0.2 - - [18/Oct/2026:10:00:00 +0000] "GET /api/content/contentnode/?parent=abc HTTP/1.1" 200 512 '
+    '"-" "Mozilla/5.0" 0.120 0.118 .'
+)
+
+
+class TestLogStats:
+    def test_ids_are_replaced_in_routes(self):
+        assert (
+            get_route("GET", "/api/content/contentnode/0123456789abcdef0123456789abcdef/?b=1&a=2&b=3")
+            == "GET /api/content/contentnode/{id}/?a&b"
+        )
+        assert get_route("GET", "/content/storage/a/b/ab12.mp4") == "GET /content/storage/*"
+        assert get_route("GET", "/zipcontent/ab12.zip/index.html") == "GET /zipcontent/{archive}/*"
+        assert get_route("GET", "/en/static/coach/app.js") == "GET /en/static/coach/*"
+        assert get_route("POST", "/api/logger/attemptlog/12/") == "POST /api/logger/attemptlog/{n}/"
+
+    def test_line_is_parsed(self):
+        entry = parse_line(LINE)
+        assert entry["route"] == "GET /api/content/contentnode/?parent"
+        assert entry["status"] == "200"
+        assert entry["cache_status"] == "-"
+        assert entry["request_time"] == 0.12
+        assert entry["upstream_time"] == 0.118
+        assert parse_line("not a log line") is None
+
+    def test_upstream_times_and_cache_status_are_parsed(self):
+        entry = parse_line(LINE.replace("0.118 .", "0.050, 0.060 . HIT"))
+        assert entry["cache_status"] == "HIT"
+        assert abs(entry["upstream_time"] - 0.11) < 1e-9
+        assert parse_line(LINE.replace("0.118 .", "- . HIT"))["upstream_time"] is None
+        # internally redirected to another location
+        entry = parse_line(LINE.replace("0.118 .", "0.050, 0.060 : 0.010 ."))
+        assert abs(entry["upstream_time"] - 0.12) < 1e-9
+
+    def test_sketch_quantiles_are_accurate(self):
+        sketch = Sketch()
+        for value in range(1, 1001):
+            sketch.add(value / 1000)
+        for fraction in (0.5, 0.95, 0.99):
+            exact = fraction * 999 / 1000 + 0.001
+            assert abs(sketch.quantile(fraction) - exact) <= 0.02 * exact
+        assert len(sketch.buckets) < 200
+        assert Sketch().quantile(0.5) is None
+
+    def test_routes_over_the_limit_are_other(self):
+        stats = LogStats(max_routes=2)
+        for path in ("/a/", "/b/", "/c/", "/d/", "/a/"):
+            stats.add_line(LINE.replace("/api/content/contentnode/?parent=abc", path))
+        stats.add_line("garbage")
+        summary = stats.summary()
+        assert sorted(summary) == ["GET /a/", "GET /b/", "other"]
+        assert summary["GET /a/"]["requests"] == 2
+        assert summary["other"]["requests"] == 2
+        assert summary["other"]["statuses"] == {"2xx": 2}
+        assert stats.skipped == 1
+
+    def test_rotated_logs_are_read_oldest_first(self, tmp_path):
+        path = str(tmp_path / "kolibri_uwsgi.log")
+        for name in ("kolibri_uwsgi.log", "kolibri_uwsgi.log.1", "kolibri_uwsgi.log.10.gz"):
+            open(str(tmp_path / name), "w").close()
+        with gzip.open(path + ".2.gz", "wt") as log_file:
+            log_file.write(LINE + "\n")
+        assert get_log_files(path) == [path + ".10.gz", path + ".2.gz", path + ".1", path]
+        with open_log(path + ".2.gz") as log_file:
+            assert parse_line(log_file.readline()) is not None
+
+    def test_followed_log_is_opened_again_when_rotated(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(kolibri_server_logstats, "FOLLOW_POLL_INTERVAL", 0)
+        path = str(tmp_path / "kolibri_uwsgi.log")
+
+        def write(line, log_path=path, mode="a"):
+            with open(log_path, mode) as log_file:
+                log_file.write(line + "\n")
+
+        write("before", mode="w")
+        lines = []
+        reports = follow(path, 0, lambda line: lines.append(line.strip()))
+        next(reports)
+        write("first")
+        next(reports)
+        assert lines == ["first"]
+        # moved away by logrotate, written to by nginx until it reopens its logs
+        os.rename(path, path + ".1")
+        write("late", path + ".1")
+        write("new")
+        next(reports)
+        assert lines == ["first", "late", "new"]
+        # copytruncate
+        open(path, "w").close()
+        next(reports)
+        write("short")
+        next(reports)
+        assert lines == ["first", "late", "new", "short"]
+        reports.close()
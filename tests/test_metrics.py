@@ -0,0 +1,95 @@
+"""Tests for kolibri_server_metrics.py."""
+
+import json
+import os
+import socket
+import sys
+import threading
+
+# Add the repository root to path so we can import kolibri_server_metrics
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_metrics import Exporter
+from kolibri_server_metrics import Metrics
+from kolibri_server_metrics import add_redis_metrics
+from kolibri_server_metrics import add_uwsgi_metrics
+from kolibri_server_metrics import parse_stub_status
+from kolibri_server_metrics import read_uwsgi_stats
+
+STUB_STATUS = """Active connections: 3
+server accepts handled requests
+ 10 9 42
+Reading: 0 Writing: 1 Waiting: 2
+"""
+
+UWSGI_STATS = {
+    "listen_queue": 4,
+    "listen_queue_errors": 1,
+    "workers": [
+        {"id": 1, "status": "busy", "requests": 100, "avg_rt": 25000, "rss": 200000000, "respawn_count": 2},
+        {"id": 2, "status": "idle", "requests": 50, "avg_rt": 15000, "rss": 150000000, "respawn_count": 1},
+        {"id": 3, "status": "cheap", "requests": 0, "avg_rt": 0, "rss": 0, "respawn_count": 1},
+    ],
+}
+
+
+def serve_stats(path, stats):
+    """
+    Answers a single connection to a unix socket at path like the uwsgi stats server
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def answer():
+        connection, _ = server.accept()
+        connection.sendall(json.dumps(stats).encode())
+        connection.close()
+        server.close()
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    return thread
+
+
+class TestMetrics:
+    def test_stub_status_is_parsed(self):
+        assert parse_stub_status(STUB_STATUS) == {
+            "active": 3,
+            "accepts": 10,
+            "handled": 9,
+            "requests": 42,
+            "reading": 0,
+            "writing": 1,
+            "waiting": 2,
+        }
+        assert parse_stub_status("<html>502</html>") is None
+
+    def test_uwsgi_workers_are_reported(self):
+        metrics = Metrics()
+        add_uwsgi_metrics(metrics, "main", UWSGI_STATS)
+        text = metrics.render()
+        assert 'kolibri_server_uwsgi_listen_queue{pool="main"} 4\n' in text
+        assert 'kolibri_server_uwsgi_workers{pool="main",status="busy"} 1\n' in text
+        assert 'kolibri_server_uwsgi_workers{pool="main",status="cheap"} 1\n' in text
+        assert 'kolibri_server_uwsgi_worker_avg_response_seconds{pool="main",worker="1"} 0.025\n' in text
+        assert 'worker="3"' not in text
+        assert text.count("# TYPE kolibri_server_uwsgi_worker_requests_total counter\n") == 1
+
+    def test_redis_hit_ratio_is_reported(self):
+        metrics = Metrics()
+        add_redis_metrics(metrics, {"keyspace_hits": 90, "keyspace_misses": 10, "evicted_keys": 5})
+        assert "kolibri_server_redis_hit_ratio 0.9\n" in metrics.render()
+
+    def test_stats_socket_is_read(self, tmp_path):
+        path = str(tmp_path / "stats.sock")
+        thread = serve_stats(path, UWSGI_STATS)
+        assert read_uwsgi_stats(path) == UWSGI_STATS
+        thread.join()
+
+    def test_unavailable_sources_are_down(self, tmp_path):
+        exporter = Exporter("http://127.0.0.1:1/status", None, {"main": str(tmp_path / "missing.sock")})
+        text = exporter.collect()
+        assert 'kolibri_server_uwsgi_up{pool="main"} 0\n' in text
+        assert "kolibri_server_nginx_up 0\n" in text
+        assert "kolibri_server_redis_up 0\n" in text
@@ -0,0 +1,61 @@
+"""Tests for kolibri_server_precompress.py."""
+
+import gzip
+import os
+import sys
+
+# Add the repository root to path so we can import kolibri_server_precompress
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_precompress import get_files
+from kolibri_server_precompress import precompress
+
+BUNDLE = b"function kolibri() { return 'learn'; }\n" * 200
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as output_file:
+        output_file.write(data)
+
+
+class TestPrecompress:
+    def test_text_files_are_compressed(self, tmp_path):
+        write(str(tmp_path / "learn" / "app.js"), BUNDLE)
+        write(str(tmp_path / "learn" / "small.css"), b"body {}")
+        write(str(tmp_path / "learn" / "logo.png"), os.urandom(4096))
+        write(str(tmp_path / "loading.html"), b"<!--# echo var='lang' -->" + BUNDLE)
+        assert get_files(str(tmp_path)) == ["learn/app.js", "loading.html"]
+
+        assert precompress(str(tmp_path), workers=1) == (2, 0)
+        with gzip.open(str(tmp_path / "learn" / "app.js.gz")) as compressed_file:
+            assert compressed_file.read() == BUNDLE
+        assert (
+            os.stat(str(tmp_path / "learn" / "app.js.gz")).st_mtime
+            == os.stat(str(tmp_path / "learn" / "app.js")).st_mtime
+        )
+        # nginx would not run its server side includes
+        assert not os.path.exists(str(tmp_path / "loading.html.gz"))
+
+    def test_incompressible_files_are_not_kept(self, tmp_path):
+        write(str(tmp_path / "font.ttf"), os.urandom(4096))
+        precompress(str(tmp_path), workers=1)
+        assert not os.path.exists(str(tmp_path / "font.ttf.gz"))
+
+    def test_unchanged_files_are_skipped(self, tmp_path):
+        manifest = str(tmp_path / "manifest.json")
+        static = tmp_path / "static"
+        write(str(static / "app.js"), BUNDLE)
+        write(str(static / "old.js"), BUNDLE)
+        assert precompress(str(static), manifest, workers=1) == (2, 0)
+
+        # copied again with the same content, and removed
+        os.utime(str(static / "app.js"), (1, 1))
+        os.remove(str(static / "old.js"))
+        assert precompress(str(static), manifest, workers=1) == (0, 1)
+        assert not os.path.exists(str(static / "old.js.gz"))
+
+        write(str(static / "app.js"), BUNDLE + b"// changed\n")
+        assert precompress(str(static), manifest, workers=1) == (1, 0)
+        with gzip.open(str(static / "app.js.gz")) as compressed_file:
+            assert compressed_file.read().endswith(b"// changed\n")
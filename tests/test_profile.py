@@ -0,0 +1,50 @@
+"""Tests for kolibri_server_profile.py."""
+
+import os
+import sys
+
+# Add the repository root to path so we can import kolibri_server_profile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_profile import parse_import_times
+from kolibri_server_profile import rank
+from kolibri_server_profile import request
+
+IMPORT_TIME_OUTPUT = [
+    "import time: self [us] | cumulative | imported package",
+    "import time:       258 |        258 |   _io",
+    "import time:       120 |        120 |     django.utils",
+    "import time:      1500 |       1620 |   django",
+    "Some warning printed while importing",
+]
+
+
+# --- Import time tests ---
+
+
+class TestParseImportTimes:
+    def test_imports_are_parsed(self):
+        imports = parse_import_times(IMPORT_TIME_OUTPUT)
+        assert imports[2] == {"module": "django", "self_us": 1500, "cumulative_us": 1620}
+
+    def test_other_lines_are_ignored(self):
+        assert len(parse_import_times(IMPORT_TIME_OUTPUT)) == 3
+
+    def test_rank_keeps_slowest(self):
+        imports = parse_import_times(IMPORT_TIME_OUTPUT)
+        assert [entry["module"] for entry in rank(imports, "self_us", 2)] == ["django", "_io"]
+
+
+# --- Request tests ---
+
+
+class TestRequest:
+    def test_status_is_reported(self):
+        def application(environ, start_response):
+            start_response("404 Not Found", [])
+            return [environ["PATH_INFO"].encode()]
+
+        result = request(application, "/api/public/info/")
+        assert result["status"] == "404 Not Found"
+        assert result["path"] == "/api/public/info/"
+        assert result["seconds"] >= 0
@@ -0,0 +1,115 @@
+"""Tests for kolibri_server_reload.py."""
+
+import os
+import signal
+import subprocess
+import sys
+
+# Add the repository root to path so we can import kolibri_server_reload
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import kolibri_server_reload
+from kolibri_server_reload import get_instances
+from kolibri_server_reload import get_master_pid
+from kolibri_server_reload import get_pidfile
+from kolibri_server_reload import get_reload_progress
+from kolibri_server_reload import get_systemd_pid
+from kolibri_server_reload import reload
+from kolibri_server_reload import reload_instance
+
+UWSGI_CONF = """# This file is maintained AUTOMATICALLY and will be overwritten
+
+[main]
+socket = /tmp/kolibri_uwsgi.sock
+env = KOLIBRI_SERVER_LOCAL_CACHE_SIZE=1000
+env = KOLIBRI_SERVER_LOCAL_CACHE_TTL=5
+stats = /tmp/kolibri_uwsgi_stats.sock
+
+[main2]
+socket = /tmp/kolibri_main2_uwsgi.sock
+stats = /tmp/kolibri_main2_uwsgi_stats.sock
+
+[hashi]
+stats = /tmp/kolibri_hashi_uwsgi_stats.sock
+"""
+
+
+class TestReload:
+    def test_instances_are_read_in_order(self, tmp_path):
+        uwsgi_conf = str(tmp_path / "uwsgi.ini")
+        with open(uwsgi_conf, "w") as conf_file:
+            conf_file.write(UWSGI_CONF)
+        assert get_instances(uwsgi_conf) == [
+            ("main", "/tmp/kolibri_uwsgi_stats.sock"),
+            ("main2", "/tmp/kolibri_main2_uwsgi_stats.sock"),
+            ("hashi", "/tmp/kolibri_hashi_uwsgi_stats.sock"),
+        ]
+        assert get_pidfile("main", "/run") == "/run/uwsgi.pid"
+        assert get_pidfile("main2", "/run") == "/run/uwsgi_main2.pid"
+
+    def test_only_new_workers_accepting_requests_are_ready(self):
+        stats = {
+            "workers": [
+                {"id": 1, "pid": 101, "accepting": 1, "last_spawn": 1000},
+                {"id": 2, "pid": 202, "accepting": 1, "last_spawn": 2000},
+                {"id": 3, "pid": 203, "accepting": 0, "last_spawn": 2000},
+                {"id": 4, "pid": 0, "accepting": 0, "last_spawn": 0},
+            ]
+        }
+        assert get_reload_progress(stats, {101, 102, 0}, 1999.5) == (2, 1, 3)
+        # respawned before the reload started
+        assert get_reload_progress(stats, {101}, 2001) == (0, 0, 3)
+
+    def test_instances_not_running_are_skipped(self, tmp_path):
+        with open(str(tmp_path / "uwsgi.pid"), "w") as pid_file:
+            pid_file.write("not a pid\n")
+        assert get_master_pid(str(tmp_path / "uwsgi.pid")) is None
+        assert get_master_pid(str(tmp_path / "uwsgi_hashi.pid")) is None
+        assert reload([("main", "/nonexistent"), ("hashi", "/nonexistent")], str(tmp_path), 1)
+
+    def test_single_main_instance_is_warned_about(self, tmp_path, caplog):
+        assert reload([("main", "/nonexistent"), ("hashi", "/nonexistent")], str(tmp_path), 1)
+        assert "A single uwsgi instance serves Kolibri" in caplog.text
+        caplog.clear()
+        assert reload([("main", "/nonexistent"), ("main2", "/nonexistent")], str(tmp_path), 1)
+        assert "A single uwsgi instance serves Kolibri" not in caplog.text
+
+    def test_instance_stopped_meanwhile_is_skipped(self, monkeypatch):
+        def kill(pid, sig):
+            raise ProcessLookupError(pid)
+
+        monkeypatch.setattr(kolibri_server_reload.os, "kill", kill)
+        assert reload_instance("main", 123456, "/nonexistent", 1)
+
+    def test_instances_left_once_reloading_took_too_long(self, tmp_path, monkeypatch):
+        signals = []
+
+        def kill(pid, sig):
+            signals.append(sig)
+
+        monkeypatch.setattr(kolibri_server_reload.os, "kill", kill)
+        with open(str(tmp_path / "uwsgi.pid"), "w") as pid_file:
+            pid_file.write("123456\n")
+        assert not reload([("main", "/nonexistent")], str(tmp_path), 1, total_timeout=0)
+        assert signal.SIGHUP not in signals
+
+    def test_systemd_pid_is_the_main_pid_of_the_unit(self, monkeypatch):
+        commands = []
+
+        def check_output(command):
+            commands.append(command)
+            return b"1234\n"
+
+        monkeypatch.setattr(kolibri_server_reload.subprocess, "check_output", check_output)
+        assert get_systemd_pid("main2") == 1234
+        assert commands[0][-1] == "kolibri-server-uwsgi@main2.service"
+        # stopped
+        monkeypatch.setattr(kolibri_server_reload.subprocess, "check_output", lambda command: b"0\n")
+        assert get_systemd_pid("main2") is None
+
+    def test_no_systemd_pid_without_systemd(self, monkeypatch):
+        def check_output(command):
+            raise subprocess.CalledProcessError(1, command)
+
+        monkeypatch.setattr(kolibri_server_reload.subprocess, "check_output", check_output)
+        assert get_systemd_pid("main") is None
@@ -0,0 +1,429 @@
+"""Tests for kolibri_server_setup.py."""
+
+import fnmatch
+import os
+import sys
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_setup
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# reads the options of Kolibri when imported
+pytest.importorskip("kolibri")
+
+import kolibri_server_setup  # noqa: E402
+from kolibri_server_setup import delete_redis_keys  # noqa: E402
+from kolibri_server_setup import get_invalidated_patterns  # noqa: E402
+from kolibri_server_setup import get_nginx_long_locations  # noqa: E402
+from kolibri_server_setup import get_redis_maxmemory  # noqa: E402
+from kolibri_server_setup import get_systemd_socket_dir  # noqa: E402
+from kolibri_server_setup import get_uwsgi_autoscaling  # noqa: E402
+from kolibri_server_setup import get_uwsgi_max_workers  # noqa: E402
+from kolibri_server_setup import get_uwsgi_sizing  # noqa: E402
+from kolibri_server_setup import get_uwsgi_socket  # noqa: E402
+from kolibri_server_setup import get_uwsgi_systemd_options  # noqa: E402
+
+
+@pytest.fixture
+def native(monkeypatch):
+    monkeypatch.setattr(kolibri_server_setup, "systemd_socket_dir", "/run/kolibri-server")
+
+
+@pytest.fixture
+def init_script(monkeypatch):
+    monkeypatch.setattr(kolibri_server_setup, "systemd_socket_dir", "")
+
+
+class TestSystemdSockets:
+    def test_sockets_are_in_tmp_under_the_init_script(self, init_script):
+        assert get_uwsgi_socket("main") == "/tmp/kolibri_uwsgi.sock"
+        assert get_uwsgi_socket("main2") == "/tmp/kolibri_main2_uwsgi.sock"
+        assert get_uwsgi_systemd_options("main") == []
+
+    def test_sockets_are_those_systemd_listens_on(self, native):
+        assert get_uwsgi_socket("main") == "/run/kolibri-server/main_uwsgi.sock"
+        assert get_uwsgi_socket("hashi") == "/run/kolibri-server/hashi_uwsgi.sock"
+
+    def test_instances_started_by_systemd_load_their_configuration(self, native):
+        options = get_uwsgi_systemd_options("main2")
+        assert ("ini", "/etc/kolibri/dist/uwsgi.ini") in options
+        assert ("vacuum", "false") in options
+        assert ("logto", os.path.join(kolibri_server_setup.KOLIBRI_HOME, "logs", "main2_uwsgi.log")) in options
+        options = dict(get_uwsgi_systemd_options("long"))
+        assert options["ini"] == "/etc/kolibri/dist/long_uwsgi.ini"
+        assert options["logto"] == os.path.join(kolibri_server_setup.KOLIBRI_HOME, "logs", "long_uwsgi.log")
+        assert dict(get_uwsgi_systemd_options("main"))["logto"].endswith("/uwsgi.log")
+
+    def test_socket_dir_is_set_by_the_setup_unit(self, monkeypatch):
+        monkeypatch.setenv("KOLIBRI_SERVER_SOCKET_DIR", "/run/elsewhere")
+        assert get_systemd_socket_dir() == "/run/elsewhere"
+
+    def test_socket_dir_follows_the_native_target(self, monkeypatch):
+        monkeypatch.delenv("KOLIBRI_SERVER_SOCKET_DIR", raising=False)
+        commands = []
+
+        def call(command, **kwargs):
+            commands.append(command)
+            return 0
+
+        monkeypatch.setattr(kolibri_server_setup.subprocess, "call", call)
+        assert get_systemd_socket_dir() == "/run/kolibri-server"
+        assert commands == [["systemctl", "is-active", "--quiet", "kolibri-server-native.target"]]
+        monkeypatch.setattr(kolibri_server_setup.subprocess, "call", lambda command, **kwargs: 3)
+        assert get_systemd_socket_dir() == ""
+
+    def test_no_socket_dir_without_systemd(self, monkeypatch):
+        monkeypatch.delenv("KOLIBRI_SERVER_SOCKET_DIR", raising=False)
+
+        def call(command, **kwargs):
+            raise FileNotFoundError(command[0])
+
+        monkeypatch.setattr(kolibri_server_setup.subprocess, "call", call)
+        assert get_systemd_socket_dir() == ""
+
+
+class TestUwsgiSizing:
+    @pytest.fixture(autouse=True)
+    def somaxconn(self, monkeypatch):
+        monkeypatch.setattr(kolibri_server_setup, "get_somaxconn", lambda: 4096)
+
+    def test_workers_are_clamped_to_the_cores(self):
+        # 8 GB would allow 20 main workers
+        assert get_uwsgi_max_workers("main", 4, 8192) == 16
+        assert get_uwsgi_max_workers("hashi", 4, 8192) == 8
+        assert get_uwsgi_max_workers("long", 4, 8192) == 4
+
+    def test_workers_are_clamped_to_the_memory(self):
+        # 8 cores would allow 32 main workers
+        assert get_uwsgi_max_workers("main", 8, 2048) == 5
+        assert get_uwsgi_max_workers("hashi", 8, 2048) == 2
+
+    def test_workers_are_clamped_to_the_maximum(self):
+        assert get_uwsgi_max_workers("main", 64, 1024 * 1024) == kolibri_server_setup.UWSGI_MAX_WORKERS
+
+    def test_configured_workers_are_kept(self):
+        assert get_uwsgi_max_workers("main", 1, 512, workers=12) == 12
+
+    def test_sizing_of_a_four_core_server(self):
+        sizing = dict(get_uwsgi_sizing("main", 4, 8192))
+        assert sizing["workers"] == 16
+        assert sizing["cheaper"] == 4
+        assert sizing["cheaper-initial"] == 5
+        assert sizing["reload-on-rss"] == 400
+        assert sizing["limit-as"] == 1600
+        assert sizing["cpu-affinity"] == 1
+        assert sizing["listen"] == 512
+
+    def test_small_server_keeps_two_workers(self):
+        sizing = dict(get_uwsgi_sizing("main", 1, 512))
+        assert sizing["workers"] == 2
+        assert sizing["cheaper"] == 1
+        assert sizing["cheaper-initial"] == 2
+
+    def test_instances_share_the_workers(self):
+        sizing = dict(get_uwsgi_sizing("main", 4, 8192, instances=2))
+        assert sizing["workers"] == 8
+        assert sizing["cheaper"] == 2
+        assert sizing["reload-on-rss"] == 400
+
+    def test_listen_queue_is_clamped_to_somaxconn(self, monkeypatch):
+        monkeypatch.setattr(kolibri_server_setup, "get_somaxconn", lambda: 128)
+        assert dict(get_uwsgi_sizing("main", 4, 8192))["listen"] == 128
+
+
+class TestUwsgiAutoscaling:
+    @pytest.fixture
+    def options(self, monkeypatch):
+        options = dict(kolibri_server_setup.SERVER_OPTION_DEFAULTS["uWSGI"])
+        monkeypatch.setitem(kolibri_server_setup.server_options, "uWSGI", options)
+        return options
+
+    @pytest.fixture
+    def plugins_dir(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(kolibri_server_setup, "UWSGI_PLUGINS_DIR", str(tmp_path))
+        return tmp_path
+
+    @pytest.fixture
+    def busyness_plugin(self, plugins_dir):
+        (plugins_dir / "cheaper_busyness_plugin.so").write_bytes(b"")
+
+    def test_busyness_algorithm_when_its_plugin_is_installed(self, options, busyness_plugin):
+        autoscaling = get_uwsgi_autoscaling(16)
+        assert autoscaling[:2] == [("plugin", "cheaper_busyness"), ("cheaper-algo", "busyness")]
+        autoscaling = dict(autoscaling)
+        assert autoscaling["cheaper-step"] == 4
+        assert autoscaling["cheaper-overload"] == 2
+        assert autoscaling["cheaper-busyness-min"] == 25
+        assert autoscaling["cheaper-busyness-max"] == 50
+        # idle for 60 seconds of 2 second cycles
+        assert autoscaling["cheaper-busyness-multiplier"] == 30
+        assert autoscaling["cheaper-busyness-backlog-step"] == 4
+
+    def test_spare_algorithm_without_the_plugin(self, options, plugins_dir):
+        assert get_uwsgi_autoscaling(16) == [
+            ("cheaper-algo", "spare"),
+            ("cheaper-step", 4),
+            ("cheaper-overload", 2),
+        ]
+
+    def test_configured_algorithm_is_kept(self, options, busyness_plugin):
+        options.update({"CHEAPER_ALGO": "backlog", "CHEAPER_STEP": 3, "CHEAPER_OVERLOAD": 0})
+        assert get_uwsgi_autoscaling(16) == [
+            ("cheaper-algo", "backlog"),
+            ("cheaper-step", 3),
+            ("cheaper-overload", 1),
+        ]
+
+    def test_few_workers_spawn_one_at_a_time(self, options, busyness_plugin):
+        assert dict(get_uwsgi_autoscaling(2))["cheaper-step"] == 1
+
+
+class TestWarmStart:
+    @pytest.fixture
+    def options(self, monkeypatch, init_script):
+        options = dict(kolibri_server_setup.SERVER_OPTION_DEFAULTS["uWSGI"])
+        monkeypatch.setitem(kolibri_server_setup.server_options, "uWSGI", options)
+        return options
+
+    def test_warm_workers_are_forked_from_the_master(self, options):
+        main_options = kolibri_server_setup.get_uwsgi_options()["main"]
+        assert ("lazy-apps", "false") in main_options
+        assert ("env", "KOLIBRI_SERVER_WARM_START=false") not in main_options
+
+    def test_cold_workers_import_kolibri_themselves(self, options):
+        options["WARM_START"] = False
+        main_options = kolibri_server_setup.get_uwsgi_options()["main"]
+        assert ("lazy-apps", "true") in main_options
+        assert ("env", "KOLIBRI_SERVER_WARM_START=false") in main_options
+
+
+class FakeRedis(object):
+    """
+    Redis database whose SCAN returns count keys at a time, in a pipeline or not
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        # SCAN returns every key present from start to end, even if others are deleted
+        self.order = sorted(keys)
+        self.round_trips = 0
+
+    def scan(self, cursor, match=None, count=10):
+        self.round_trips += 1
+        return self._scan(cursor, match, count)
+
+    def _scan(self, cursor, match, count):
+        keys = self.order[cursor : cursor + count]
+        cursor = cursor + count if cursor + count < len(self.order) else 0
+        return cursor, [key for key in keys if key in self.keys and fnmatch.fnmatchcase(key, match)]
+
+    def unlink(self, *keys):
+        self.round_trips += 1
+        return self._unlink(keys)
+
+    def _unlink(self, keys):
+        deleted = len(self.keys & set(keys))
+        self.keys -= set(keys)
+        return deleted
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def scan(self, cursor, match=None, count=10):
+        self.commands.append(lambda: self.client._scan(cursor, match, count))
+
+    def unlink(self, *keys):
+        self.commands.append(lambda: self.client._unlink(keys))
+
+    def execute(self):
+        self.client.round_trips += 1
+        return [command() for command in self.commands]
+
+
+class TestDeleteRedisKeys:
+    @pytest.fixture(autouse=True)
+    def scan_count(self, monkeypatch):
+        monkeypatch.setattr(kolibri_server_setup, "REDIS_SCAN_COUNT", 10)
+
+    def test_matching_keys_are_deleted_in_batches(self):
+        pages = [":1:views.decorators.cache.{}".format(i) for i in range(25)]
+        client = FakeRedis(pages + [":1:session_a", ":1:session_b"])
+        assert delete_redis_keys(client, ":1:views.decorators.*") == 25
+        assert client.keys == {":1:session_a", ":1:session_b"}
+        # a scan, each batch unlinked along with the scan for the next, and
+        # the last batch
+        assert client.round_trips == 4
+
+    def test_scan_goes_on_past_batches_without_matches(self):
+        others = [":1:a{:02d}".format(i) for i in range(20)]
+        client = FakeRedis(others + [":1:z_dataset"])
+        assert delete_redis_keys(client, ":1:*_dataset") == 1
+        assert client.keys == set(others)
+
+    def test_nothing_matches(self):
+        client = FakeRedis([":1:session"])
+        assert delete_redis_keys(client, ":1:views.decorators.*") == 0
+        assert client.keys == {":1:session"}
+
+    def test_key_without_wildcard_is_unlinked_directly(self):
+        client = FakeRedis([":1:content_cache_key", ":1:session"])
+        assert delete_redis_keys(client, ":1:content_cache_key") == 1
+        assert client.keys == {":1:session"}
+        assert client.round_trips == 1
+
+
+class TestRedisMaxmemory:
+    # 10 MB server: 1 MB by default, 2.5 MB at most
+    SERVER_MEMORY = 10000000
+
+    @pytest.fixture(autouse=True)
+    def options(self, monkeypatch):
+        options = dict(kolibri_server_setup.SERVER_OPTION_DEFAULTS["Redis"])
+        monkeypatch.setitem(kolibri_server_setup.server_options, "Redis", options)
+        return options
+
+    def get_info(self, hits, misses, evicted, peak=500000, used=100000, run_id="run"):
+        return {
+            "run_id": run_id,
+            "keyspace_hits": hits,
+            "keyspace_misses": misses,
+            "evicted_keys": evicted,
+            "used_memory_peak": peak,
+            "used_memory": used,
+        }
+
+    def get_previous(self, maxmemory, hits=0, misses=0, evicted=0):
+        return {
+            "run_id": "run",
+            "maxmemory": maxmemory,
+            "keyspace_hits": hits,
+            "keyspace_misses": misses,
+            "evicted_keys": evicted,
+        }
+
+    def test_default_on_the_first_start(self):
+        assert get_redis_maxmemory(self.get_info(0, 0, 0), {}, self.SERVER_MEMORY) == 1000000
+
+    def test_grows_when_keys_are_evicted_under_the_hit_rate_floor(self):
+        previous = self.get_previous(1000000, hits=1000, misses=1000, evicted=5)
+        info = self.get_info(hits=1800, misses=1200, evicted=15, peak=1000000)
+        # 80% hit rate since the previous start
+        assert get_redis_maxmemory(info, previous, self.SERVER_MEMORY) == 1500000
+
+    def test_growth_stops_at_the_ceiling(self):
+        info = self.get_info(hits=800, misses=200, evicted=10, peak=2000000)
+        assert get_redis_maxmemory(info, self.get_previous(2000000), self.SERVER_MEMORY) == 2500000
+
+    def test_kept_when_the_hit_rate_is_over_the_floor(self):
+        info = self.get_info(hits=950, misses=50, evicted=10, peak=1000000)
+        assert get_redis_maxmemory(info, self.get_previous(1000000), self.SERVER_MEMORY) == 1000000
+
+    def test_kept_with_too_few_lookups(self):
+        info = self.get_info(hits=100, misses=800, evicted=10, peak=1000000)
+        assert get_redis_maxmemory(info, self.get_previous(1000000), self.SERVER_MEMORY) == 1000000
+
+    def test_shrinks_when_never_filled(self):
+        info = self.get_info(hits=800, misses=200, evicted=0, peak=1200000)
+        assert get_redis_maxmemory(info, self.get_previous(2500000), self.SERVER_MEMORY) == 1800000
+
+    def test_shrinks_back_to_the_default_at_most(self):
+        info = self.get_info(hits=800, misses=200, evicted=0, peak=100000)
+        assert get_redis_maxmemory(info, self.get_previous(2500000), self.SERVER_MEMORY) == 1000000
+
+    def test_counters_are_not_diffed_across_a_redis_restart(self):
+        previous = self.get_previous(1000000, hits=5000, misses=100, evicted=0)
+        info = self.get_info(hits=800, misses=200, evicted=10, peak=1000000, run_id="restarted")
+        assert get_redis_maxmemory(info, previous, self.SERVER_MEMORY) == 1500000
+
+    def test_never_below_the_memory_used(self):
+        info = self.get_info(hits=0, misses=0, evicted=0, used=1200000)
+        assert get_redis_maxmemory(info, self.get_previous(1000000), self.SERVER_MEMORY) == 1202000
+
+
+class TestInvalidatedPatterns:
+    @pytest.fixture
+    def previous(self):
+        return {
+            "kolibri_version": "0.16.0",
+            "content_cache_key": "a1",
+            "channels": {"c1": "1:2023-01-01", "c2": "4:2023-02-01"},
+            "device_settings": "d1",
+        }
+
+    def changed(self, previous, **changes):
+        fingerprint = dict(previous)
+        fingerprint.update(changes)
+        return fingerprint
+
+    def test_nothing_changed(self, previous):
+        assert get_invalidated_patterns(previous, dict(previous)) == []
+
+    def test_new_kolibri_version_purges_everything(self, previous):
+        fingerprint = self.changed(previous, kolibri_version="0.17.0")
+        assert get_invalidated_patterns(previous, fingerprint) == list(kolibri_server_setup.REDIS_PURGE_PATTERNS)
+
+    def test_only_the_updated_channel_is_invalidated(self, previous):
+        fingerprint = self.changed(
+            previous, content_cache_key="a2", channels={"c1": "1:2023-01-01", "c2": "5:2023-03-01"}
+        )
+        assert get_invalidated_patterns(previous, fingerprint) == [
+            (0, ":1:views.decorators.*"),
+            (0, ":1:content_cache_key"),
+            (0, ":1:CHANNEL_STATS_CACHED_KEYS_c2"),
+        ]
+
+    def test_imported_and_deleted_channels_are_invalidated(self, previous):
+        fingerprint = self.changed(previous, channels={"c2": "4:2023-02-01", "c3": "1:2023-03-01"})
+        patterns = get_invalidated_patterns(previous, fingerprint)
+        assert (0, ":1:CHANNEL_STATS_CACHED_KEYS_c1") in patterns
+        assert (0, ":1:CHANNEL_STATS_CACHED_KEYS_c3") in patterns
+        assert (0, ":1:CHANNEL_STATS_CACHED_KEYS_c2") not in patterns
+
+    def test_unreadable_channels_invalidate_every_channel(self, previous):
+        fingerprint = self.changed(previous, channels=None)
+        assert (0, ":1:CHANNEL_STATS_CACHED_KEYS*") in get_invalidated_patterns(previous, fingerprint)
+
+    def test_device_settings_change(self, previous):
+        fingerprint = self.changed(previous, device_settings="d2")
+        assert get_invalidated_patterns(previous, fingerprint) == [
+            (0, ":1:views.decorators.*"),
+            (0, ":1:device_settings_cache_key"),
+        ]
+
+    def test_patterns_are_not_repeated(self, previous):
+        fingerprint = self.changed(previous, content_cache_key="a2", device_settings="d2")
+        patterns = get_invalidated_patterns(previous, fingerprint)
+        assert patterns.count((0, ":1:views.decorators.*")) == 1
+        assert (0, ":1:device_settings_cache_key") in patterns
+        assert (0, ":1:*_dataset") not in patterns
+
+
+class TestLongRequests:
+    @pytest.fixture
+    def options(self, monkeypatch, init_script):
+        options = dict(kolibri_server_setup.SERVER_OPTION_DEFAULTS["uWSGI"])
+        monkeypatch.setitem(kolibri_server_setup.server_options, "uWSGI", options)
+        return options
+
+    def test_known_long_requests_go_to_the_long_instance(self, options):
+        locations = get_nginx_long_locations("/")
+        for location in ("/api/morango/", "/facility/api/downloadcsvfile/", "/coach/api/classsummary/"):
+            assert "  location {} {{\n".format(location) in locations
+        assert locations.count("uwsgi_pass unix:/tmp/kolibri_long_uwsgi.sock;") == 3
+        assert locations.count("uwsgi_read_timeout 1805s;") == 3
+
+    def test_locations_are_below_the_url_path_prefix(self, options):
+        assert "  location /kolibri/coach/api/classsummary/ {\n" in get_nginx_long_locations("/kolibri/")
+
+    def test_configured_paths_are_added_once(self, options):
+        options["LONG_REQUEST_PATHS"] = "/api/auth/membership/, api/morango/"
+        locations = get_nginx_long_locations("/")
+        assert "  location /api/auth/membership/ {\n" in locations
+        assert locations.count("location /api/morango/ ") == 1
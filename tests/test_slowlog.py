@@ -0,0 +1,93 @@
+"""Tests for kolibri_server_slowlog.py."""
+
+import json
+import os
+import sys
+import threading
+import time
+
+# Add the repository root to path so we can import kolibri_server_slowlog
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_slowlog import RotatingLog
+from kolibri_server_slowlog import SlowRequestLog
+from kolibri_server_slowlog import StackDumper
+
+
+def slow_view(seconds):
+    time.sleep(seconds)
+
+
+def application(environ, start_response):
+    slow_view(float(environ["QUERY_STRING"] or 0))
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+
+def call(slow_log, query=""):
+    """
+    Serves a request like uwsgi, closing its response once sent
+    """
+    response = slow_log({"REQUEST_METHOD": "GET", "PATH_INFO": "/api/test/", "QUERY_STRING": query}, lambda *args: None)
+    body = b"".join(response)
+    response.close()
+    return body
+
+
+def read_records(path):
+    with open(path) as log_file:
+        return [json.loads(line) for line in log_file]
+
+
+class TestSlowRequestLog:
+    def test_slow_request_is_logged_with_its_stack(self, tmp_path):
+        path = str(tmp_path / "slow.log")
+        slow_log = SlowRequestLog(application, RotatingLog(path, 1000000, 2), 0.1, 0.01)
+        slow_log.start()
+        assert call(slow_log, "0.05") == b"ok"
+        assert not os.path.exists(path)
+        call(slow_log, "0.3")
+        records = read_records(path)
+        assert records[-1]["finished"]
+        assert records[-1]["path"] == "/api/test/"
+        assert records[-1]["status"] == 200
+        assert records[-1]["seconds"] >= 0.3
+        assert records[-1]["samples"] > 0
+        assert records[-1]["stacks"][0]["stack"][-1].endswith(" slow_view")
+
+    def test_running_request_is_logged(self, tmp_path):
+        path = str(tmp_path / "slow.log")
+        slow_log = SlowRequestLog(application, RotatingLog(path, 1000000, 2), 0.05, 0.01)
+        slow_log.start()
+        call(slow_log, "0.3")
+        records = read_records(path)
+        assert records[-1]["finished"]
+        assert not records[0]["finished"]
+        assert records[0]["status"] is None
+
+    def test_log_is_rotated(self, tmp_path):
+        path = str(tmp_path / "slow.log")
+        log = RotatingLog(path, 10, 2)
+        for line in ("aaaaaa\n", "bbbbbb\n", "cccccc\n", "dddddd\n"):
+            log.write(line)
+        assert open(path).read() == "dddddd\n"
+        assert open(path + ".1").read() == "cccccc\n"
+        assert open(path + ".2").read() == "bbbbbb\n"
+        assert not os.path.exists(path + ".3")
+
+
+class TestStackDumper:
+    def test_stacks_of_other_threads_are_dumped(self, tmp_path):
+        path = str(tmp_path / "stacks.log")
+        done = threading.Event()
+        thread = threading.Thread(target=done.wait, name="busy")
+        thread.start()
+        try:
+            StackDumper(path, 3).dump()
+        finally:
+            done.set()
+            thread.join()
+        dump = open(path).read()
+        assert " worker 3 pid {}\n".format(os.getpid()) in dump
+        assert '"busy"' in dump
+        assert "in wait" in dump
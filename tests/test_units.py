@@ -0,0 +1,102 @@
+"""Tests for kolibri_server_units.py."""
+
+import os
+import sys
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_units
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import kolibri_server_units
+from kolibri_server_units import get_configured_instances
+from kolibri_server_units import get_running_instances
+from kolibri_server_units import update_units
+
+UWSGI_CONF = """# This file is maintained AUTOMATICALLY and will be overwritten
+
+[main]
+socket = /run/kolibri-server/main_uwsgi.sock
+
+[main2]
+socket = /run/kolibri-server/main2_uwsgi.sock
+
+[hashi]
+socket = /run/kolibri-server/hashi_uwsgi.sock
+
+[long]
+socket = /run/kolibri-server/long_uwsgi.sock
+"""
+
+LIST_UNITS = """kolibri-server-uwsgi@hashi.service  loaded active running hashi uwsgi instance of kolibri-server
+kolibri-server-uwsgi@hashi.socket   loaded active listening Socket of the hashi uwsgi instance of kolibri-server
+kolibri-server-uwsgi@main.service   loaded active running main uwsgi instance of kolibri-server
+kolibri-server-uwsgi@main3.socket   loaded active listening Socket of the main3 uwsgi instance of kolibri-server
+● kolibri-server-uwsgi@long.service loaded active running long uwsgi instance of kolibri-server
+"""
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    commands = []
+
+    def check_call(command):
+        commands.append(command)
+        return 0
+
+    monkeypatch.setattr(kolibri_server_units.subprocess, "check_call", check_call)
+    return commands
+
+
+class TestUnits:
+    def test_instances_are_read_from_the_sections(self, tmp_path):
+        uwsgi_conf = tmp_path / "uwsgi.ini"
+        uwsgi_conf.write_text(UWSGI_CONF)
+        assert get_configured_instances(str(uwsgi_conf)) == ["main", "main2", "hashi", "long"]
+
+    def test_missing_configuration_is_an_error(self, tmp_path):
+        with pytest.raises(OSError):
+            get_configured_instances(str(tmp_path / "uwsgi.ini"))
+
+    def test_running_instances_are_read_from_systemd(self, monkeypatch):
+        commands = []
+
+        def check_output(command, universal_newlines=False):
+            commands.append(command)
+            return LIST_UNITS
+
+        monkeypatch.setattr(kolibri_server_units.subprocess, "check_output", check_output)
+        assert get_running_instances() == ["hashi", "main", "main3", "long"]
+        assert commands[0][-1] == "kolibri-server-uwsgi@*"
+
+    def test_other_instances_configured_are_started(self, commands):
+        started, stopped = update_units(["main", "main2", "hashi", "long"], ["main", "hashi", "long"])
+        assert (started, stopped) == (["main2"], [])
+        assert commands == [
+            [
+                "systemctl",
+                "--no-block",
+                "start",
+                "kolibri-server-uwsgi@main2.socket",
+                "kolibri-server-uwsgi@main2.service",
+            ]
+        ]
+
+    def test_instances_no_longer_configured_are_stopped(self, commands):
+        started, stopped = update_units(["main", "hashi"], ["main", "hashi", "main3", "long"])
+        assert (started, stopped) == ([], ["main3", "long"])
+        assert commands == [
+            [
+                "systemctl",
+                "--no-block",
+                "stop",
+                "kolibri-server-uwsgi@main3.socket",
+                "kolibri-server-uwsgi@main3.service",
+                "kolibri-server-uwsgi@long.socket",
+                "kolibri-server-uwsgi@long.service",
+            ]
+        ]
+
+    def test_nothing_to_do(self, commands):
+        assert update_units(["main", "hashi", "long"], ["main", "hashi", "long"]) == ([], [])
+        assert commands == []
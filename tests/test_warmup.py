@@ -0,0 +1,121 @@
+"""Tests for kolibri_server_warmup.py."""
+
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_warmup
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kolibri_server_warmup import Warmup
+from kolibri_server_warmup import get_channel_paths
+from kolibri_server_warmup import get_languages
+from kolibri_server_warmup import get_static_paths
+
+NGINX_CONF = """
+    map $http_accept_language $lang {
+        default en;
+        ~^es es;
+        ~^en en;
+        ~^es-419 la;
+        ~^es es;
+    }
+"""
+
+CHANNELS = [{"id": "c1", "root": "r1"}, {"id": "c2", "root": None}]
+
+
+@pytest.fixture
+def server():
+    """
+    Runs an HTTP server listing CHANNELS, and yields its port, the requests
+    it received and their cookies
+    """
+    received = []
+    cookies = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received.append((self.path, self.headers.get("Accept-Language")))
+            cookies.append(self.headers.get("Cookie"))
+            body = json.dumps(CHANNELS).encode() if self.path.startswith("/api/content/channel/") else b"{}"
+            self.send_response(404 if self.path == "/missing" else 200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        yield httpd.server_address[1], received, cookies
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+# --- Path tests ---
+
+
+class TestPaths:
+    def test_languages_are_read_from_nginx_map(self, tmp_path):
+        nginx_conf = tmp_path / "nginx.conf"
+        nginx_conf.write_text(NGINX_CONF)
+        assert get_languages(str(nginx_conf)) == ["es", "en", "es-419"]
+
+    def test_missing_nginx_conf_warms_english(self, tmp_path):
+        assert get_languages(str(tmp_path / "missing.conf")) == ["en"]
+
+    def test_largest_bundles_come_first(self, tmp_path):
+        (tmp_path / "plugin").mkdir()
+        (tmp_path / "plugin" / "app.js").write_text("x" * 10)
+        (tmp_path / "plugin" / "vendor.js").write_text("x" * 100)
+        (tmp_path / "plugin" / "logo.png").write_text("x" * 1000)
+        assert get_static_paths(str(tmp_path), "/kolibri/") == [
+            "/kolibri/static/plugin/vendor.js",
+            "/kolibri/static/plugin/app.js",
+        ]
+
+    def test_channels_without_root_are_skipped(self):
+        assert get_channel_paths(CHANNELS, "/") == [
+            "/api/content/contentnode_tree/r1/",
+            "/api/content/contentnode/?parent=r1",
+        ]
+
+
+# --- Warm-up tests ---
+
+
+class TestWarmup:
+    def test_channel_trees_are_fetched(self, server):
+        port, received, _ = server
+        warmup = Warmup(port, timeout=10)
+        assert warmup.wait_ready()
+        assert warmup.run(["es"], ["/static/app.js"], ["/missing"])
+        assert ("/", "es") in received
+        assert ("/api/content/contentnode_tree/r1/", None) in received
+        assert ("/static/app.js", None) in received
+        assert warmup.failed == 1
+
+    def test_ready_check_bypasses_the_nginx_cache(self, server):
+        port, received, cookies = server
+        assert Warmup(port, timeout=10).wait_ready()
+        assert received == [("/api/public/info/", None)]
+        assert cookies == ["kolibri=kolibri-server-warmup"]
+
+    def test_requests_stop_when_time_is_up(self, server):
+        port, received, _ = server
+        warmup = Warmup(port, timeout=0)
+        assert not warmup.wait_ready()
+        assert not warmup.run(["en"])
+        assert received == []
+        assert warmup.skipped == 3
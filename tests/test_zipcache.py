@@ -0,0 +1,195 @@
+"""Tests for kolibri_server_zipcache.py."""
+
+import multiprocessing
+import os
+import sys
+import zipfile
+
+import pytest
+
+# Add the repository root to path so we can import kolibri_server_zipcache
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import kolibri_server_zipcache
+from kolibri_server_zipcache import ZipContentCache
+from kolibri_server_zipcache import is_rewritten
+from kolibri_server_zipcache import is_safe
+
+ZIPPED_FILENAME = "0123456789abcdef0123456789abcdef.zip"
+
+MEMBERS = {
+    "index.html": b"<html></html>",
+    "js/app.js": b"console.log('hashi');" * 100,
+    "css/app.css": b"body { margin: 0; }",
+    "images/logo.png": bytes(range(256)) * 10,
+}
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    path = tmp_path / ZIPPED_FILENAME
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, content in MEMBERS.items():
+            compress_type = zipfile.ZIP_STORED if name.endswith(".png") else zipfile.ZIP_DEFLATED
+            zf.writestr(name, content, compress_type=compress_type)
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ZipContentCache(str(tmp_path / "cache"))
+
+
+# --- Member name tests ---
+
+
+class TestMemberNames:
+    def test_html_is_rewritten(self):
+        assert is_rewritten("index.html")
+        assert is_rewritten("legacy/page.htm")
+
+    def test_assets_are_not_rewritten(self):
+        assert not is_rewritten("js/app.js")
+
+    def test_relative_paths_are_safe(self):
+        assert is_safe("js/app.js")
+
+    def test_parent_paths_are_not_safe(self):
+        assert not is_safe("../app.js")
+        assert not is_safe("js/../../app.js")
+
+    def test_absolute_paths_are_not_safe(self):
+        assert not is_safe("/etc/passwd")
+
+
+# --- Extraction tests ---
+
+
+class TestExtract:
+    def test_deflated_member_is_extracted(self, cache, zip_path):
+        path = cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        with open(path, "rb") as f:
+            assert f.read() == MEMBERS["js/app.js"]
+
+    def test_stored_member_is_extracted(self, cache, zip_path):
+        path = cache.extract(zip_path, ZIPPED_FILENAME, "images/logo.png")
+        with open(path, "rb") as f:
+            assert f.read() == MEMBERS["images/logo.png"]
+
+    def test_extracted_member_is_readable_by_others(self, cache, zip_path):
+        path = cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert os.stat(path).st_mode & 0o004
+
+    def test_missing_member_returns_none(self, cache, zip_path):
+        assert cache.extract(zip_path, ZIPPED_FILENAME, "js/missing.js") is None
+
+    def test_rewritten_member_is_not_extracted(self, cache, zip_path):
+        assert cache.extract(zip_path, ZIPPED_FILENAME, "index.html") is None
+
+    def test_lookup_finds_extracted_member(self, cache, zip_path):
+        assert cache.lookup(ZIPPED_FILENAME, "js/app.js") is None
+        path = cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert cache.lookup(ZIPPED_FILENAME, "js/app.js") == path
+
+    def test_index_records_member_offsets(self, cache, zip_path):
+        index = cache.get_index(zip_path, ZIPPED_FILENAME)
+        with zipfile.ZipFile(zip_path) as zf:
+            assert index["js/app.js"][0] == zf.getinfo("js/app.js").header_offset
+
+    def test_index_is_reused(self, cache, zip_path):
+        cache.get_index(zip_path, ZIPPED_FILENAME)
+        os.unlink(zip_path)
+        assert "js/app.js" in cache.get_index(zip_path, ZIPPED_FILENAME)
+
+    def test_corrupted_member_is_not_cached(self, cache, zip_path):
+        index = cache.get_index(zip_path, ZIPPED_FILENAME)
+        index["js/app.js"][4] ^= 0xFFFFFFFF
+        entry = index["js/app.js"]
+        with pytest.raises(zipfile.BadZipFile):
+            cache._extract_member(zip_path, ZIPPED_FILENAME, "js/app.js", entry)
+        assert cache.lookup(ZIPPED_FILENAME, "js/app.js") is None
+
+    def test_hot_archive_is_extracted_whole(self, cache, zip_path, monkeypatch):
+        monkeypatch.setattr(kolibri_server_zipcache, "HOT_ARCHIVE_MISSES", 2)
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert cache.lookup(ZIPPED_FILENAME, "css/app.css") is None
+        cache.extract(zip_path, ZIPPED_FILENAME, "images/logo.png")
+        assert cache.lookup(ZIPPED_FILENAME, "css/app.css") is not None
+        assert cache.lookup(ZIPPED_FILENAME, "index.html") is None
+        assert cache.get_stats(ZIPPED_FILENAME)["complete"]
+
+    def test_hot_archive_is_extracted_in_batches(self, cache, zip_path, monkeypatch):
+        monkeypatch.setattr(kolibri_server_zipcache, "HOT_ARCHIVE_MISSES", 1)
+        monkeypatch.setattr(kolibri_server_zipcache, "HOT_ARCHIVE_BATCH_SIZE", 1)
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert not cache.get_stats(ZIPPED_FILENAME)["complete"]
+        assert cache.lookup(ZIPPED_FILENAME, "images/logo.png") is None
+        cache.extract(zip_path, ZIPPED_FILENAME, "images/logo.png")
+        assert cache.lookup(ZIPPED_FILENAME, "css/app.css") is not None
+        assert cache.get_stats(ZIPPED_FILENAME)["complete"]
+        assert cache.get_size() == sum(len(content) for name, content in MEMBERS.items() if not is_rewritten(name))
+
+    def test_workers_do_not_lose_counts(self, cache, zip_path, monkeypatch):
+        monkeypatch.setattr(kolibri_server_zipcache, "HOT_ARCHIVE_MISSES", 1000)
+
+        def extract(member):
+            for _ in range(50):
+                cache.extract(zip_path, ZIPPED_FILENAME, member)
+
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=extract, args=(member,)) for member in ("js/app.js", "css/app.css")]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats = cache.get_stats(ZIPPED_FILENAME)
+        assert stats["misses"] == 100
+        assert stats["size"] == len(MEMBERS["js/app.js"]) + len(MEMBERS["css/app.css"])
+
+
+# --- Eviction tests ---
+
+
+class TestEvict:
+    def make_archive(self, tmp_path, name):
+        path = tmp_path / name
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("data.bin", b"x" * 1000)
+        return str(path)
+
+    def test_size_counts_extracted_members(self, cache, zip_path):
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert cache.get_size() == len(MEMBERS["js/app.js"])
+
+    def test_member_extracted_again_is_counted_once(self, cache, zip_path):
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        assert cache.get_size() == len(MEMBERS["js/app.js"])
+
+    def test_least_recently_used_archive_is_evicted(self, tmp_path):
+        cache = ZipContentCache(str(tmp_path / "cache"), max_size=2500)
+        names = ["{}.zip".format(str(i) * 32) for i in range(3)]
+        for age, name in enumerate(names):
+            cache.extract(self.make_archive(tmp_path, name), name, "data.bin")
+            stats_path = cache._stats_path(name)
+            os.utime(stats_path, (1000 - age, 1000 - age))
+        archive = self.make_archive(tmp_path, "{}.zip".format("9" * 32))
+        cache.extract(archive, "{}.zip".format("9" * 32), "data.bin")
+        cache.evict(force=True)
+        assert cache.lookup(names[0], "data.bin") is not None
+        assert cache.lookup(names[2], "data.bin") is None
+        assert cache.get_size() <= 2500
+
+    def test_unbounded_cache_is_never_evicted(self, tmp_path):
+        cache = ZipContentCache(str(tmp_path / "cache"))
+        for i in range(3):
+            name = "{}.zip".format(str(i) * 32)
+            cache.extract(self.make_archive(tmp_path, name), name, "data.bin")
+        cache.evict(force=True)
+        assert cache.get_size() == 3000
+
+    def test_remove_deletes_archive(self, cache, zip_path):
+        cache.extract(zip_path, ZIPPED_FILENAME, "js/app.js")
+        cache.remove(ZIPPED_FILENAME)
+        assert cache.lookup(ZIPPED_FILENAME, "js/app.js") is None
+        assert os.listdir(cache.cache_dir) == []